@@ -0,0 +1,541 @@
+import glob
+import heapq
+import json
+import math
+import os
+import re
+import tempfile
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from crypto_balancer.dummy_exchange import DummyExchange
+from crypto_balancer.portfolio import ArrayPortfolio, conversion_routes
+from crypto_balancer.simple_balancer import SimpleBalancer
+from itertools import product
+from operator import itemgetter
+
+# Characters of a candle file to read at a time when streaming it
+CHUNK_SIZE = 1 << 16
+
+# What comes between the candles in a file of them
+BETWEEN_CANDLES = re.compile(r'[\s,\[\]]*')
+
+# Ticks to look ahead at first when fast forwarding, doubling each time
+# there's no crossing, so a rebalance soon after costs little to find
+FAST_FORWARD_TICKS = 32
+
+
+LIMITS = {'BNB/BTC': {'amount': {'max': 90000000.0, 'min': 0.01},
+                      'cost': {'max': None, 'min': 0.001},
+                      'price': {'max': None, 'min': None}},
+          'BNB/ETH': {'amount': {'max': 90000000.0, 'min': 0.01},
+                      'cost': {'max': None, 'min': 0.01},
+                      'price': {'max': None, 'min': None}},
+          'BNB/USD': {'amount': {'max': 10000000.0, 'min': 0.01},
+                       'cost': {'max': None, 'min': 10.0},
+                       'price': {'max': None, 'min': None}},
+          'BTC/USD': {'amount': {'max': 10000000.0, 'min': 1e-06},
+                       'cost': {'max': None, 'min': 10.0},
+                       'price': {'max': None, 'min': None}},
+          'ETH/BTC': {'amount': {'max': 100000.0, 'min': 0.001},
+                      'cost': {'max': None, 'min': 0.001},
+                      'price': {'max': None, 'min': None}},
+          'ETH/USD': {'amount': {'max': 10000000.0, 'min': 1e-05},
+                       'cost': {'max': None, 'min': 10.0},
+                       'price': {'max': None, 'min': None}},
+          'XRP/BNB': {'amount': {'max': 90000000.0, 'min': 0.1},
+                      'cost': {'max': None, 'min': 1.0},
+                      'price': {'max': None, 'min': None}},
+          'XRP/BTC': {'amount': {'max': 90000000.0, 'min': 1.0},
+                      'cost': {'max': None, 'min': 0.001},
+                      'price': {'max': None, 'min': None}},
+          'XRP/ETH': {'amount': {'max': 90000000.0, 'min': 1.0},
+                      'cost': {'max': None, 'min': 0.01},
+                      'price': {'max': None, 'min': None}},
+          'XRP/USD': {'amount': {'max': 90000000.0, 'min': 0.1},
+                       'cost': {'max': None, 'min': 1.0},
+                       'price': {'max': None, 'min': None}},
+          'XLM/USD': {'amount': {'max': 90000000.0, 'min': 0.1},
+                       'cost': {'max': None, 'min': 1.0},
+                       'price': {'max': None, 'min': None}},
+          'XLM/XRP': {'amount': {'max': 90000000.0, 'min': 0.1},
+                      'cost': {'max': None, 'min': 1.0},
+                      'price': {'max': None, 'min': None}}}
+
+
+def forward_fill(prices):
+    # Each gap takes the last price before it, down each column. Gaps at
+    # the top of a column, before the pair has any price, are left as NaN.
+    ticks = np.arange(len(prices))[:, None]
+    last = np.where(np.isnan(prices), 0, ticks)
+    np.maximum.accumulate(last, axis=0, out=last)
+    return prices[last, np.arange(prices.shape[1])]
+
+
+def pair_from_filename(path):
+    # Candle files are named after their pair, like XRP-USD.json
+    filename = path.split('/')[-1]
+    pair = filename.split('.')[0]
+    return pair.replace('-', '/')
+
+
+def make_rates(prices):
+    # Rates laid out as an exchange has them from (pair, price), as
+    # DummyExchange makes them from a single price, leaving out NaNs
+    rates = {}
+    for pair, price in prices:
+        if not math.isnan(price):
+            rates[pair] = {'mid': price,
+                           'high': price * 1.001,
+                           'low': price * 0.999, }
+    return rates
+
+
+def read_candles(path, chunk_size=CHUNK_SIZE):
+    """ The candles in a JSON file of them one at a time, reading it a
+    chunk at a time, so only a chunk is held however big the file is. """
+    decoder = json.JSONDecoder()
+    buf = ''
+    with open(path, 'r') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            buf += chunk
+            pos = 0
+            while True:
+                pos = BETWEEN_CANDLES.match(buf, pos).end()
+                try:
+                    candle, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    # The rest of the candle is in the next chunk
+                    break
+                yield candle
+                pos = end
+            buf = buf[pos:]
+            if not chunk:
+                break
+    if buf:
+        raise ValueError("Can't read candles from {} at: {}"
+                         .format(path, buf[:20]))
+
+
+def merge_candles(paths, chunk_size=CHUNK_SIZE):
+    """ (time, prices) for each time any of the candle files has a candle,
+    in time order, merging the files as they're read rather than loading
+    them. prices is a dict of the latest close of each pair that has
+    started, so gaps are forward filled. The same dict is updated in place
+    for each time, so copy it to keep it. Each file must be in time order,
+    and where one has more than one candle at a time the first is used. """
+    def closes(path):
+        pair = pair_from_filename(path)
+        for candle in read_candles(path, chunk_size):
+            yield candle['time'], pair, float(candle['close'])
+
+    streams = [closes(path) for path in paths]
+    prices = {}
+    current = None
+    seen = set()
+    for time, pair, close in heapq.merge(*streams, key=itemgetter(0)):
+        if time != current:
+            if current is not None:
+                yield current, prices
+            current = time
+            seen.clear()
+        if pair not in seen:
+            prices[pair] = close
+            seen.add(pair)
+    if current is not None:
+        yield current, prices
+
+
+class PriceHistory():
+    """ The closing price of every pair at every tick, as one contiguous
+    (ticks x pairs) array with the gaps forward filled, and the time of
+    each tick. """
+
+    def __init__(self, times, pairs, prices):
+        self.times = np.asarray(times, dtype=np.int64)
+        self.pairs = list(pairs)
+        self.prices = np.ascontiguousarray(prices, dtype=np.float64)
+        self.index = {pair: i for i, pair in enumerate(self.pairs)}
+        # The .npy file the prices are mapped from, if they are
+        self.prices_file = None
+        self._quote_prices = {}
+
+    @classmethod
+    def from_candles(cls, candles):
+        # candles is a dict from pair to a list of candles, each a dict
+        # with at least time and close. Where a pair has more than one
+        # candle at a time, the first one is used.
+        pairs = sorted(candles)
+        columns = []
+        for pair in pairs:
+            times = np.array([x['time'] for x in candles[pair]],
+                             dtype=np.int64)
+            closes = np.array([x['close'] for x in candles[pair]],
+                              dtype=np.float64)
+            times, first = np.unique(times, return_index=True)
+            columns.append((times, closes[first]))
+
+        if columns:
+            times = np.unique(np.concatenate([x[0] for x in columns]))
+        else:
+            times = np.zeros(0, dtype=np.int64)
+        prices = np.full((len(times), len(pairs)), np.nan)
+        for j, (pair_times, closes) in enumerate(columns):
+            prices[np.searchsorted(times, pair_times), j] = closes
+        return cls(times, pairs, forward_fill(prices))
+
+    @classmethod
+    def from_files(cls, filenames, cache_dir=None):
+        """ One JSON file of candles per pair, named like XRP-USD.json.
+        Given a cache directory, the prices are saved there the first time,
+        and mapped straight back in after that without parsing anything
+        until one of the files changes. """
+        paths = sorted(glob.glob(filenames))
+        if cache_dir is not None:
+            sources = []
+            for path in paths:
+                stat = os.stat(path)
+                sources.append([path, stat.st_size, stat.st_mtime_ns])
+            history = cls.load(cache_dir, sources)
+            if history is not None:
+                return history
+
+        candles = {}
+        for path in paths:
+            with open(path, 'r') as f:
+                candles[pair_from_filename(path)] = json.load(f)
+        history = cls.from_candles(candles)
+
+        if cache_dir is not None:
+            history.save(cache_dir, sources)
+            history = cls.load(cache_dir, sources)
+        return history
+
+    def save(self, directory, sources=None):
+        # The times and prices as .npy arrays, and the pairs along with
+        # what they were made from in history.json. That goes last, so a
+        # cache that was only partly written is never used. Each file is
+        # written to one side and renamed into place, so histories already
+        # mapping the old arrays keep seeing them unchanged.
+        os.makedirs(directory, exist_ok=True)
+        meta = os.path.join(directory, 'history.json')
+        if os.path.exists(meta):
+            os.remove(meta)
+        for name, array in [('times.npy', self.times),
+                            ('prices.npy', self.prices)]:
+            path = os.path.join(directory, name)
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, array)
+            os.replace(path + '.tmp', path)
+        with open(meta + '.tmp', 'w') as f:
+            json.dump({'pairs': self.pairs, 'sources': sources}, f)
+        os.replace(meta + '.tmp', meta)
+
+    @classmethod
+    def load(cls, directory, sources=None):
+        # A history saved to the directory with the arrays mapped rather
+        # than read in, or None if there isn't one or, given the sources,
+        # it was made from something else
+        try:
+            with open(os.path.join(directory, 'history.json')) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        if sources is not None and meta['sources'] != sources:
+            return None
+
+        prices_file = os.path.join(directory, 'prices.npy')
+        times = np.load(os.path.join(directory, 'times.npy'))
+        prices = np.load(prices_file, mmap_mode='r')
+        history = cls(times, meta['pairs'], prices)
+        history.prices_file = prices_file
+        return history
+
+    def __len__(self):
+        return len(self.prices)
+
+    def rates(self, tick):
+        return make_rates(zip(self.pairs, self.prices[tick].tolist()))
+
+    def quote_prices(self, currencies, quote_currency):
+        """ The price of each of the currencies (columns) in the quote
+        currency at every tick (rows), converting through other currencies
+        the same way as Portfolio does from the rates at that tick. NaN
+        where the rates don't reach a currency. Kept for the next backtest
+        of the same currencies, so it mustn't be changed. """
+        key = (tuple(currencies), quote_currency)
+        res = self._quote_prices.get(key)
+        if res is not None:
+            return res
+
+        res = np.full((len(self), len(currencies)), np.nan)
+
+        # Which pairs have a price only changes when one starts trading,
+        # so work the routes out once for each run of ticks between those
+        valid = self.prices > 0
+        changes = np.flatnonzero((valid[1:] != valid[:-1]).any(axis=1)) + 1
+        bounds = [0] + changes.tolist() + [len(self)]
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            if start == stop:
+                continue
+            pairs = [pair for pair, ok in zip(self.pairs, valid[start])
+                     if ok]
+            conversions = {quote_currency: np.ones(stop - start)}
+            for cur, (pair, inv, prev) in \
+                    conversion_routes(pairs, quote_currency).items():
+                mid = self.prices[start:stop, self.index[pair]]
+                conversions[cur] = (1.0 / mid if inv else mid) \
+                    * conversions[prev]
+            for i, cur in enumerate(currencies):
+                if cur in conversions:
+                    res[start:stop, i] = conversions[cur]
+
+        res.flags.writeable = False
+        self._quote_prices[key] = res
+        return res
+
+
+class HistoryExchange(DummyExchange):
+    """ Exchange that trades at the prices of one tick of a PriceHistory at
+    a time. The rates are only made into a dict when they're asked for. """
+
+    def __init__(self, history, balances, fee=0.001, limits=LIMITS,
+                 tick=0):
+        self.name = 'HistoryExchange'
+        self.history = history
+        self._currencies = sorted(set(cur for pair in history.pairs
+                                      for cur in pair.split('/')))
+        self._balances = balances
+        self._fee = fee
+        self._limits = limits
+        self.seek(tick)
+
+    def seek(self, tick):
+        self.tick_index = tick
+        self._rates = None
+
+    def tick(self):
+        if self.tick_index + 1 >= len(self.history):
+            raise StopIteration
+        self.seek(self.tick_index + 1)
+
+    @property
+    def pairs(self):
+        return self.history.pairs
+
+    @property
+    def rates(self):
+        if self._rates is None:
+            self._rates = self.history.rates(self.tick_index)
+        return self._rates
+
+    @property
+    def limits(self):
+        return self._limits
+
+
+class Backtest():
+    """ Runs a portfolio over a PriceHistory, rebalancing whenever it has
+    drifted further than the threshold from its targets.
+
+    Between rebalances the amounts held don't change, so the drift at each
+    tick is worked out straight from them and a row of the quote price
+    array, much as ArrayPortfolio works it out. The exchange, portfolio and
+    rates the balancer needs are only brought up to date on the ticks that
+    rebalance.
+
+    With fast_forward, the drift over the ticks after each rebalance is
+    worked out in one go, and the run jumps straight to the first tick
+    that crosses the threshold rather than checking each in turn. Either
+    way the same ticks rebalance. """
+
+    def __init__(self, history, targets, balances, threshold=1.0,
+                 quote_currency='USDT', balancer=None, max_orders=2,
+                 initial_max_orders=4, mode='mid', fee=0.001, limits=LIMITS,
+                 portfolio_class=ArrayPortfolio, fast_forward=True):
+        self.history = history
+        self.targets = targets
+        self.balances = balances
+        self.threshold = threshold
+        self.quote_currency = quote_currency
+        self.balancer = balancer or SimpleBalancer()
+        self.max_orders = max_orders
+        self.initial_max_orders = initial_max_orders
+        self.mode = mode
+        self.fee = fee
+        self.limits = limits
+        self.portfolio_class = portfolio_class
+        self.fast_forward = fast_forward
+
+        self.currencies = list(targets)
+        self.target_vector = np.array([targets[cur] for cur in targets],
+                                      dtype=float) / 100.0
+        self.quote_prices = history.quote_prices(self.currencies,
+                                                 quote_currency)
+
+    def first_tick(self):
+        # The first tick with a price for everything that's wanted or held
+        needed = [i for i, cur in enumerate(self.currencies)
+                  if self.targets[cur] or self.balances.get(cur)]
+        priced = np.isfinite(self.quote_prices[:, needed]).all(axis=1)
+        if not priced.any():
+            raise ValueError("No tick has a price for all of {} in {}"
+                             .format(", ".join(self.currencies),
+                                     self.quote_currency))
+        return int(priced.argmax())
+
+    def run(self, start=None, stop=None):
+        first = self.first_tick()
+        start = first if start is None else max(start, first)
+        stop = len(self.history) if stop is None else stop
+        quote_prices = self.quote_prices
+        if np.isnan(quote_prices[start:stop]).any():
+            # Currencies with no price that aren't wanted or held count
+            # for nothing
+            quote_prices = np.nan_to_num(quote_prices, nan=0.0)
+        target_vector = self.target_vector
+        threshold = self.threshold
+
+        def max_error(held, tick):
+            values = held * quote_prices[tick]
+            total = values.sum()
+            if not total:
+                return 0.0
+            errors = (total * target_vector - values) / total * 100.0
+            return np.abs(errors).max()
+
+        def max_errors(held, start, stop):
+            # max_error at every tick from start to stop at once
+            values = held * quote_prices[start:stop]
+            totals = values.sum(axis=1)[:, None]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                errors = (totals * target_vector - values) / totals * 100.0
+            errors = np.abs(errors).max(axis=1)
+            errors[totals[:, 0] == 0] = 0.0
+            return errors
+
+        def next_crossing(held, tick):
+            # The first tick from this one that drifts past the threshold
+            ahead = FAST_FORWARD_TICKS
+            while tick < stop:
+                end = min(tick + ahead, stop)
+                crossed = np.flatnonzero(max_errors(held, tick, end)
+                                         > threshold)
+                if len(crossed):
+                    return tick + int(crossed[0])
+                tick = end
+                ahead *= 2
+            return None
+
+        exchange = HistoryExchange(self.history, dict(self.balances),
+                                   self.fee, self.limits, start)
+        portfolio = self.portfolio_class.make_portfolio(
+            self.targets, exchange, self.threshold, self.quote_currency)
+        res = {'start': start,
+               'stop': stop,
+               'num_trades': 0,
+               'num_rebalances': 0, }
+
+        def rebalance(tick, max_orders):
+            exchange.seek(tick)
+            portfolio.sync_balances()
+            portfolio.sync_rates()
+            orders = self.balancer.balance(portfolio, exchange,
+                                           max_orders=max_orders,
+                                           mode=self.mode)
+            num_trades = 0
+            for order in orders['orders']:
+                try:
+                    exchange.execute_order(order)
+                    num_trades += 1
+                except ValueError:
+                    pass
+            res['num_trades'] += num_trades
+            res['num_rebalances'] += 1
+            return num_trades
+
+        def holdings():
+            return np.array([exchange.balances[cur]
+                             for cur in self.currencies], dtype=float)
+
+        # Get close to the targets to start with
+        held = holdings()
+        while max_error(held, start) > threshold:
+            if not rebalance(start, self.initial_max_orders):
+                break
+            held = holdings()
+        initial = held
+
+        if self.fast_forward:
+            tick = next_crossing(held, start)
+            while tick is not None:
+                rebalance(tick, self.max_orders)
+                held = holdings()
+                tick = next_crossing(held, tick + 1)
+        else:
+            for tick in range(start, stop):
+                if max_error(held, tick) > threshold:
+                    rebalance(tick, self.max_orders)
+                    held = holdings()
+
+        last = max(stop - 1, start)
+        res.update({
+            'initial_valuation': float((initial *
+                                        quote_prices[start]).sum()),
+            'final_valuation': float((held * quote_prices[last]).sum()),
+            'hold_valuation': float((initial * quote_prices[last]).sum()),
+            'final_balances': dict(exchange.balances),
+        })
+        return res
+
+
+# The history a sweep worker maps in once, for each config it runs
+_history = None
+
+
+def attach_history(path, times, pairs):
+    # Runs once in each worker of a sweep. The prices are mapped from the
+    # file the sweep wrote them to, so every worker shares the same pages
+    # rather than having its own copy pickled across.
+    global _history
+    _history = PriceHistory(times, pairs, np.load(path, mmap_mode='r'))
+
+
+def run_config(config):
+    return Backtest(_history, **config).run()
+
+
+def grid(**settings):
+    """ Every combination of the values given for each setting, as a list of
+    dicts of arguments to Backtest, such as
+    grid(threshold=[1.0, 2.0], max_orders=[2, 4], targets=[...]). """
+    names = list(settings)
+    return [dict(zip(names, values))
+            for values in product(*[settings[name] for name in names])]
+
+
+def sweep(history, configs, workers=None):
+    """ Runs a Backtest of the history for each config, a dict of the
+    arguments to Backtest after the history, spread over a pool of worker
+    processes. The prices are only loaded once, and the workers map them
+    from one file rather than parsing the data again. Returns a row for each
+    config, in the same order, of the config along with its results. """
+    configs = list(configs)
+    if workers == 1:
+        results = [Backtest(history, **config).run() for config in configs]
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            # A history from the cache is already in a file to map
+            path = history.prices_file
+            if path is None:
+                path = os.path.join(directory, 'prices.npy')
+                np.save(path, history.prices)
+            with ProcessPoolExecutor(max_workers=workers,
+                                     initializer=attach_history,
+                                     initargs=(path, history.times,
+                                               history.pairs)) as executor:
+                results = list(executor.map(run_config, configs))
+    return [dict(config, **result)
+            for config, result in zip(configs, results)]
@@ -1,83 +1,57 @@
 import glob
-import json
-import pandas as pd
 
+from crypto_balancer.backtest_engine import CHUNK_SIZE, LIMITS, \
+    HistoryExchange, PriceHistory, make_rates, merge_candles, \
+    pair_from_filename
 from crypto_balancer.dummy_exchange import DummyExchange
 
 
-LIMITS = {'BNB/BTC': {'amount': {'max': 90000000.0, 'min': 0.01},
-                      'cost': {'max': None, 'min': 0.001},
-                      'price': {'max': None, 'min': None}},
-          'BNB/ETH': {'amount': {'max': 90000000.0, 'min': 0.01},
-                      'cost': {'max': None, 'min': 0.01},
-                      'price': {'max': None, 'min': None}},
-          'BNB/USD': {'amount': {'max': 10000000.0, 'min': 0.01},
-                       'cost': {'max': None, 'min': 10.0},
-                       'price': {'max': None, 'min': None}},
-          'BTC/USD': {'amount': {'max': 10000000.0, 'min': 1e-06},
-                       'cost': {'max': None, 'min': 10.0},
-                       'price': {'max': None, 'min': None}},
-          'ETH/BTC': {'amount': {'max': 100000.0, 'min': 0.001},
-                      'cost': {'max': None, 'min': 0.001},
-                      'price': {'max': None, 'min': None}},
-          'ETH/USD': {'amount': {'max': 10000000.0, 'min': 1e-05},
-                       'cost': {'max': None, 'min': 10.0},
-                       'price': {'max': None, 'min': None}},
-          'XRP/BNB': {'amount': {'max': 90000000.0, 'min': 0.1},
-                      'cost': {'max': None, 'min': 1.0},
-                      'price': {'max': None, 'min': None}},
-          'XRP/BTC': {'amount': {'max': 90000000.0, 'min': 1.0},
-                      'cost': {'max': None, 'min': 0.001},
-                      'price': {'max': None, 'min': None}},
-          'XRP/ETH': {'amount': {'max': 90000000.0, 'min': 1.0},
-                      'cost': {'max': None, 'min': 0.01},
-                      'price': {'max': None, 'min': None}},
-          'XRP/USD': {'amount': {'max': 90000000.0, 'min': 0.1},
-                       'cost': {'max': None, 'min': 1.0},
-                       'price': {'max': None, 'min': None}},
-          'XLM/USD': {'amount': {'max': 90000000.0, 'min': 0.1},
-                       'cost': {'max': None, 'min': 1.0},
-                       'price': {'max': None, 'min': None}},
-          'XLM/XRP': {'amount': {'max': 90000000.0, 'min': 0.1},
-                      'cost': {'max': None, 'min': 1.0},
-                      'price': {'max': None, 'min': None}}}
+class BacktestExchange(HistoryExchange):
+    """ HistoryExchange over the candle files matching filenames, one per
+    pair. With a cache directory they're only parsed the first time, and
+    mapped straight in from the cache after that until they change. """
 
-
-class BacktestExchange(DummyExchange):
-    
-    def __init__(self, filenames, balances, fee=0.001):
+    def __init__(self, filenames, balances, fee=0.001, cache_dir=None):
+        history = PriceHistory.from_files(filenames, cache_dir)
+        super().__init__(history, balances, fee)
         self.name = 'BacktestExchange'
-        self._currencies = balances.keys()
 
-        final_df = pd.DataFrame()
-        for path in glob.glob(filenames):
-            filename = path.split('/')[-1]
-            pair = filename.split('.')[0]
-            pair = pair.replace('-','/')
-            self.pairs.append(pair)
-            data = json.load(open(path, 'r'))#['Data']
-            df = pd.DataFrame(data)
-            df.set_index(pd.to_datetime(df['time'], unit='s'), inplace=True)
-            df = df[~df.index.duplicated()]
-            final_df[pair] = df['close']
-#            print('loaded', pair)
 
-        final_df.fillna(method='ffill', inplace=True)
-#        self._iter = final_df['2018-01-08':].iterrows()
-#        self._iter = final_df['2017-09-11':].iterrows()
-#        self._iter = final_df[:'2018-12-30'].iterrows()
-#        self._iter = final_df['2018-09-11':'2018-12-30'].iterrows()
-        self._iter = final_df.iterrows()
-        self._rates = {}
-        
+class StreamingBacktestExchange(DummyExchange):
+    """ Exchange with the same ticks and rates as BacktestExchange, but
+    which merges the candle files as it goes rather than loading them
+    first, so it only ever holds a chunk of each file however long the
+    history is. It can only go forwards. """
+
+    def __init__(self, filenames, balances, fee=0.001, limits=LIMITS,
+                 chunk_size=CHUNK_SIZE):
+        self.name = 'StreamingBacktestExchange'
+        paths = sorted(glob.glob(filenames))
+        self._pairs = [pair_from_filename(path) for path in paths]
+        self._currencies = sorted(set(cur for pair in self._pairs
+                                      for cur in pair.split('/')))
         self._balances = balances
         self._fee = fee
-
+        self._limits = limits
+        self._stream = merge_candles(paths, chunk_size)
+        self.tick_index = -1
         self.tick()
 
     def tick(self):
-        self._rates = dict(next(self._iter)[1])
+        self.time, self._prices = next(self._stream)
+        self.tick_index += 1
+        self._rates = None
+
+    @property
+    def pairs(self):
+        return self._pairs
+
+    @property
+    def rates(self):
+        if self._rates is None:
+            self._rates = make_rates(self._prices.items())
+        return self._rates
 
     @property
     def limits(self):
-        return LIMITS
+        return self._limits
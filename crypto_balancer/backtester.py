@@ -1,6 +1,5 @@
-from crypto_balancer.backtest_exchange import BacktestExchange
-from crypto_balancer.simple_balancer import SimpleBalancer
-from crypto_balancer.portfolio import Portfolio
+from crypto_balancer.backtest_engine import PriceHistory, grid, sweep
+
 
 if __name__ == '__main__':
     Xbalances = {'XRP':3269.878282,
@@ -39,58 +38,17 @@ if __name__ == '__main__':
     targets = {'XRP': 80,
                'USD': 20, }
     
-    for t in range(10,100,10):
-        threshold = t / 10.0
-        exchange = BacktestExchange('/Development/crypto_balancer/data/*.json', balances.copy())
-        portfolio = Portfolio.make_portfolio(targets, exchange, threshold, quote_currency="USD")
-        balancer = SimpleBalancer()
-        num_trades = 0
-
-        while portfolio.needs_balancing:
-            res = balancer.balance(portfolio,
-                                   exchange,
-                                   accuracy=True,
-                                   max_orders=4)
-            for order in res['orders']:
-                try:
-                    r = exchange.execute_order(order)
-                    num_trades += 1
-                except ValueError:
-                    pass
-
-            portfolio.sync_balances()
-            
-        initial_portfolio = portfolio.copy()
-        
-        while True:
-
-            if portfolio.needs_balancing:
-                res = balancer.balance(portfolio,
-                                       exchange,
-                                       accuracy=True,
-                                       max_orders=2)
-                for order in res['orders']:
-                    try:
-                        r = exchange.execute_order(order)
-                        num_trades += 1
-                    except ValueError:
-                        pass
-
-                portfolio.sync_balances()
-                
-            try:
-                exchange.tick()
-            except StopIteration:
-                break
-            portfolio.sync_rates()
-
-        print("Threshold:", threshold)
-        print("Initial value:", initial_portfolio.valuation_quote)
-        print("Final value: ", portfolio.valuation_quote)
-
-        portfolio.balances = initial_portfolio.balances
-
-        print("B&H value: ", portfolio.valuation_quote)
-        print("Number of trades: ", num_trades)
+    data_dir = '/Development/crypto_balancer/data'
+    history = PriceHistory.from_files(data_dir + '/*.json',
+                                      cache_dir=data_dir + '/cache')
+    configs = grid(targets=[targets],
+                   balances=[balances],
+                   threshold=[t / 10.0 for t in range(10,100,10)],
+                   quote_currency=["USD"])
+    for res in sweep(history, configs):
+        print("Threshold:", res['threshold'])
+        print("Initial value:", res['initial_valuation'])
+        print("Final value: ", res['final_valuation'])
+        print("B&H value: ", res['hold_valuation'])
+        print("Number of trades: ", res['num_trades'])
         print()
-    
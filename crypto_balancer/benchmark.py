@@ -0,0 +1,176 @@
+import random
+import time
+import tracemalloc
+
+from crypto_balancer.dummy_exchange import DummyExchange
+from crypto_balancer.order import Order
+from crypto_balancer.simple_balancer import SimpleBalancer, SearchSpace, \
+    Attempt
+from crypto_balancer.portfolio import Portfolio
+
+
+def random_case(rng, currencies, quote_currency='USDT'):
+    rates = {}
+    prices = {cur: rng.uniform(0.05, 5000.0) for cur in currencies}
+    prices[quote_currency] = 1.0
+    for cur in currencies:
+        if cur != quote_currency:
+            rates["{}/{}".format(cur, quote_currency)] = prices[cur]
+    # Throw in some cross pairs so there is more than one route
+    for a, b in rng.sample([(a, b) for a in currencies for b in currencies
+                            if a < b and quote_currency not in (a, b)],
+                           len(currencies)):
+        rates["{}/{}".format(a, b)] = prices[a] / prices[b]
+
+    weights = [rng.randint(1, 10) for cur in currencies]
+    targets = {cur: 100.0 * w / sum(weights)
+               for cur, w in zip(currencies, weights)}
+    current = {cur: rng.uniform(0, 1000.0) / prices[cur]
+               for cur in currencies}
+    return targets, current, rates
+
+
+def run(balancer, targets, current, rates, max_orders):
+    exchange = DummyExchange(targets.keys(), current, rates)
+    portfolio = Portfolio.make_portfolio(targets, exchange)
+    start = time.time()
+    res = balancer.balance(portfolio, exchange, max_orders=max_orders)
+    elapsed = time.time() - start
+    if res['proposed_portfolio']:
+        error = res['proposed_portfolio'].balance_rms_error
+    else:
+        error = portfolio.balance_rms_error
+    return error, res['total_fee'], res['nodes_expanded'], elapsed
+
+
+def quality(cases, max_orders, name, settings, make_balancer):
+    # How close the balancer made with each setting gets to the
+    # exhaustive search, and what it costs
+    num_cases = len(cases)
+    exhaustive = [run(SimpleBalancer(), *case, max_orders)
+                  for case in cases]
+
+    print("{:>6s} {:>6s} {:>10s} {:>10s} {:>8s} {:>8s}"
+          .format(name, "same", "rms loss", "fee loss", "nodes", "secs"))
+    for setting in settings:
+        balancer = make_balancer(setting)
+        results = [run(balancer, *case, max_orders) for case in cases]
+
+        same = 0
+        rms_loss = 0.0
+        fee_loss = 0.0
+        for (error, fee, _, _), (best_error, best_fee, _, _) in \
+                zip(results, exhaustive):
+            if round(error, 9) == round(best_error, 9):
+                same += 1
+            rms_loss += error - best_error
+            fee_loss += fee - best_fee
+
+        print("{:>6d} {:>6d} {:>10.4f} {:>10.4f} {:>8d} {:>8.3f}"
+              .format(setting,
+                      same,
+                      rms_loss / num_cases,
+                      fee_loss / num_cases,
+                      sum(x[2] for x in results),
+                      sum(x[3] for x in results)))
+
+    print("{:>6s} {:>6d} {:>10.4f} {:>10.4f} {:>8d} {:>8.3f}"
+          .format("all",
+                  num_cases,
+                  0.0,
+                  0.0,
+                  sum(x[2] for x in exhaustive),
+                  sum(x[3] for x in exhaustive)))
+
+
+def beam_quality(cases, max_orders):
+    quality(cases, max_orders, "width", [1, 2, 5, 10, 25, 100],
+            lambda x: SimpleBalancer(search='beam', beam_width=x))
+
+
+def top_k_quality(cases, max_orders):
+    quality(cases, max_orders, "top k", [1, 2, 3, 4, 6, 8],
+            lambda x: SimpleBalancer(top_k=x))
+
+
+class DictOrder():
+    # Order and Attempt as they were laid out before they had slots, to
+    # compare against
+    def __init__(self, order):
+        self.pair = order.pair
+        self.direction = order.direction
+        self.amount = order.amount
+        self.price = order.price
+        self.type_ = None
+
+
+class DictAttempt():
+    def __init__(self, attempt, orders):
+        self.space = attempt.space
+        self.balances = attempt.balances
+        self.orders = orders
+        self.total_fee = attempt.total_fee
+        self.depth = attempt.depth
+        self.pairs_processed = attempt.pairs_processed
+        self._rms_error = None
+
+
+def traced_bytes(make, items):
+    tracemalloc.start()
+    made = [make(x) for x in items]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del made
+    return size / len(items)
+
+
+def node_memory(case, depth):
+    # Memory each node of the search takes for its attempt, its new order
+    # and its list of orders. The balances and the rest are the same
+    # either way, so they're left out.
+    targets, current, rates = case
+    exchange = DummyExchange(targets.keys(), current, rates)
+    portfolio = Portfolio.make_portfolio(targets, exchange)
+    rates = exchange.rates
+    rates['USDT/USDT'] = {'mid': 1.0, 'high': 1.0, 'low': 1.0}
+    balancer = SimpleBalancer()
+
+    nodes = []
+    layer = [Attempt(SearchSpace(portfolio, exchange, rates))]
+    for i in range(depth):
+        layer = [x for attempt in layer
+                 for x in balancer.expand(attempt, exchange)]
+        nodes.extend(layer)
+    parents = [(x, x.orders[:-1], x.orders[-1]) for x in nodes]
+
+    def compact(node):
+        attempt, orders, order = node
+        order = Order(order.pair, order.direction, order.amount, order.price)
+        return Attempt(attempt.space, attempt.balances, orders + (order,),
+                       attempt.total_fee, attempt.depth,
+                       attempt.pairs_processed)
+
+    def plain(node):
+        attempt, orders, order = node
+        return DictAttempt(attempt, list(orders) + [DictOrder(order)])
+
+    compact_bytes = traced_bytes(compact, parents)
+    plain_bytes = traced_bytes(plain, parents)
+    print("{} nodes, bytes per node: {:.0f} with __dict__, {:.0f} with "
+          "slots, {:.0f} saved"
+          .format(len(nodes), plain_bytes, compact_bytes,
+                  plain_bytes - compact_bytes))
+
+
+if __name__ == '__main__':
+    currencies = ['XRP', 'XLM', 'BTC', 'ETH', 'BNB', 'USDT']
+    max_orders = 4
+    num_cases = 20
+    rng = random.Random(1)
+
+    cases = [random_case(rng, currencies) for i in range(num_cases)]
+    beam_quality(cases, max_orders)
+    print()
+    top_k_quality(cases, max_orders)
+    print()
+    node_memory(cases[0], max_orders)
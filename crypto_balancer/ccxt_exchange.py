@@ -1,15 +1,62 @@
 import ccxt
+import numpy as np
 
 from functools import lru_cache
 
 exchanges = ccxt.exchanges
 
 
+def to_precision(values, precision, mode, truncate):
+    # amount_to_precision/price_to_precision for arrays of values, each
+    # with the precision of its own market. NaN precision leaves the
+    # value as it is.
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        if mode == ccxt.TICK_SIZE:
+            scales = 1.0 / precision
+            # Keep whole numbers of ticks per unit exact
+            whole = np.abs(scales - np.round(scales)) < 1e-9 * scales
+            scales = np.where(whole, np.round(scales), scales)
+            ticks = precision
+        else:
+            digits = precision
+            if mode == ccxt.SIGNIFICANT_DIGITS:
+                digits = precision - 1 - np.floor(np.log10(np.abs(values)))
+            scales = 10.0 ** digits
+            ticks = 10.0 ** -digits
+
+        # Worked out on the size, so truncating goes towards zero and
+        # rounding goes half away from it, as ccxt does
+        sizes = np.abs(values)
+        steps = sizes * scales
+        if not truncate:
+            steps = steps + 0.5
+        rounded = np.floor(steps)
+        # Dividing by a whole scale gets the same float as parsing the
+        # decimal would, which multiplying by the step doesn't always
+        rounded = np.copysign(np.where(scales >= 1, rounded / scales,
+                                       rounded * ticks), values)
+
+        # Where float noise could have put the value either side of a step
+        # only the decimal can say which, so leave those few to ccxt
+        unsure = np.abs(steps - np.round(steps)) <= \
+            1e-9 * np.maximum(steps, 1.0)
+
+    res = np.where(np.isnan(precision) | (values == 0), values, rounded)
+    rounding_mode = ccxt.TRUNCATE if truncate else ccxt.ROUND
+    for i in np.flatnonzero(unsure & ~np.isnan(precision) & (values != 0)):
+        digits = float(precision[i])
+        if mode != ccxt.TICK_SIZE:
+            digits = int(digits)
+        res[i] = float(ccxt.decimal_to_precision(
+            float(values[i]), rounding_mode, digits, mode, ccxt.NO_PADDING))
+    return res
+
+
 class CCXTExchange():
 
     def __init__(self, name, currencies, api_key, api_secret):
         self.name = name
-        self.currencies = currencies
+        self.currencies = list(currencies)
         self.exch = getattr(ccxt, name)({'nonce': ccxt.Exchange.milliseconds})
         self.exch.apiKey = api_key
         self.exch.secret = api_secret
@@ -24,13 +71,16 @@ class CCXTExchange():
     @property
     @lru_cache(maxsize=None)
     def pairs(self):
+        # Go over the markets once for those between our currencies rather
+        # than trying every combination of them, which matters with a few
+        # hundred currencies. Ordered as if every combination was tried.
+        index = {cur: i for i, cur in enumerate(self.currencies)}
         _pairs = []
-        for i in self.currencies:
-            for j in self.currencies:
-                pair = "{}/{}".format(i, j)
-                if pair in self.exch.markets and self.exch.markets[pair]['active']:
-                    _pairs.append(pair)
-        return _pairs
+        for pair, market in self.exch.markets.items():
+            base, _, quote = pair.partition('/')
+            if base in index and quote in index and market['active']:
+                _pairs.append((index[base], index[quote], pair))
+        return [pair for _, _, pair in sorted(_pairs)]
 
     @property
     @lru_cache(maxsize=None)
@@ -67,27 +117,62 @@ class CCXTExchange():
     def fee(self):
         return self.exch.fees['trading']['maker']
 
+    @property
+    @lru_cache(maxsize=None)
+    def market_table(self):
+        # The precision and limits of each pair taken from the markets once,
+        # as arrays so whole batches of orders can be rounded and checked
+        # here rather than one at a time through ccxt. The extra entry on
+        # the end is for pairs with no limits, which nothing can pass.
+        pairs = self.pairs
+        index = {pair: i for i, pair in enumerate(pairs)}
+
+        def column(values, missing, extra):
+            return np.array([missing if x is None else x for x in values] +
+                            [extra], dtype=float)
+
+        precision = [self.exch.markets[pair]['precision'] for pair in pairs]
+        limits = [self.limits[pair] for pair in pairs]
+        return (index,
+                column((x.get('amount') for x in precision), np.nan, np.nan),
+                column((x.get('price') for x in precision), np.nan, np.nan),
+                column((x['amount']['min'] for x in limits), 0.0, np.inf),
+                column((x['cost']['min'] for x in limits), 0.0, np.inf))
+
     def preprocess_order(self, order):
-        try:
-            limits = self.limits[order.pair]
-        except KeyError:
-            return None
-
-        order.amount = float(
-            self.exch.amount_to_precision(
-                order.pair, order.amount))
-        order.price = float(
-            self.exch.price_to_precision(
-                order.pair, order.price))
-
-        if order.price == 0 or order.amount == 0:
-            return None
-
-        if order.amount < limits['amount']['min'] \
-           or order.amount * order.price < limits['cost']['min']:
-            return None
-        order.type_ = 'LIMIT'
-        return order
+        return self.preprocess_orders([order])[0]
+
+    def preprocess_orders(self, orders):
+        # Each order back rounded to what the exchange will take, or None if
+        # it can't be placed
+        if not orders:
+            return []
+        index, amount_precision, price_precision, min_amounts, min_costs = \
+            self.market_table
+        mode = self.exch.precisionMode
+
+        pair_idx = [index.get(order.pair, -1) for order in orders]
+        amounts = to_precision(np.array([order.amount for order in orders]),
+                               amount_precision[pair_idx], mode, True)
+        prices = to_precision(np.array([order.price for order in orders]),
+                              price_precision[pair_idx], mode, False)
+
+        valid = (amounts != 0) & (prices != 0) \
+            & (amounts >= min_amounts[pair_idx]) \
+            & (amounts * prices >= min_costs[pair_idx])
+
+        res = []
+        for order, ok, amount, price in zip(orders, valid.tolist(),
+                                            amounts.tolist(),
+                                            prices.tolist()):
+            if ok:
+                order.amount = amount
+                order.price = price
+                order.type_ = 'LIMIT'
+                res.append(order)
+            else:
+                res.append(None)
+        return res
 
     def execute_order(self, order):
         if not order.type_:
@@ -1,3 +1,10 @@
+from functools import lru_cache
+
+import numpy as np
+
+# Batches of orders smaller than this are checked one at a time
+BATCH_MIN_ORDERS = 32
+
 LIMITS = {'BNB/BTC': {'amount': {'max': 90000000.0, 'min': 0.01},
                       'cost': {'max': None, 'min': 0.001},
                       'price': {'max': None, 'min': None}},
@@ -40,7 +47,7 @@ class DummyExchange():
 
     def __init__(self, currencies, balances, rates=None, fee=0.001):
         self.name = 'DummyExchange'
-        self._currencies = currencies
+        self._currencies = list(currencies)
         self._balances = balances
         self._fee = fee
         self._rates = {}
@@ -83,26 +90,90 @@ class DummyExchange():
     def fee(self):
         return self._fee
 
-    def preprocess_order(self, order):
+    @property
+    @lru_cache(maxsize=None)
+    def limit_table(self):
+        # The limits of each pair looked up once up front, as rows of
+        # (min amount, min cost, base, quote) and as arrays so that whole
+        # batches of orders can be checked at once
+        limits = self.limits
+        index = {}
+        rows = []
+        for pair in limits:
+            index[pair] = len(rows)
+            base, quote = pair.split('/')
+            rows.append((limits[pair]['amount']['min'] or 0.0,
+                         limits[pair]['cost']['min'] or 0.0,
+                         base,
+                         quote))
+        # The extra entry on the end is for pairs with no limits, which
+        # nothing can pass
+        min_amounts = np.array([x[0] for x in rows] + [np.inf])
+        min_costs = np.array([x[1] for x in rows] + [np.inf])
+        return index, rows, min_amounts, min_costs
+
+    def order_valid(self, order):
+        index, rows, _, _ = self.limit_table
+        pair, direction, amount, price = order.key
         try:
-            limits = self.limits[order.pair]
+            min_amount, min_cost, base, quote = rows[index[pair]]
         except KeyError:
-            return None
-        if order.amount < limits['amount']['min'] \
-           or order.amount * order.price < limits['cost']['min']:
-            return None
+            return False
+        if amount < min_amount or amount * price < min_cost:
+            return False
 
-        base, quote = order.pair.split('/')
-        if order.direction.upper() == 'BUY':
-            if order.amount * order.price > self._balances[quote]:
-                return None
+        if direction.upper() == 'BUY':
+            if amount * price > self._balances[quote]:
+                return False
 
-        if order.direction.upper() == 'SELL':
-            if order.amount > self._balances[base]:
-                return None
+        if direction.upper() == 'SELL':
+            if amount > self._balances[base]:
+                return False
+
+        return True
+
+    def orders_valid(self, orders):
+        # order_valid over a whole batch at once
+        index, rows, min_amounts, min_costs = self.limit_table
+        pairs, directions, amounts, prices = zip(*[order.key
+                                                   for order in orders])
+        pair_idx = [index.get(pair, -1) for pair in pairs]
+        buys = [direction.upper() == 'BUY' for direction in directions]
+        amounts = np.array(amounts)
+        prices = np.array(prices)
+
+        # Can't spend more than we hold, which is the quote currency when
+        # buying and the base currency when selling
+        funds = [self._balances[rows[idx][3 if buy else 2]]
+                 if idx >= 0 else 0.0
+                 for idx, buy in zip(pair_idx, buys)]
+        costs = amounts * prices
+        spend = np.where(buys, costs, amounts)
+
+        valid = (amounts >= min_amounts[pair_idx]) \
+            & (costs >= min_costs[pair_idx]) \
+            & (spend <= np.array(funds, dtype=float))
+        return valid.tolist()
+
+    def preprocess_order(self, order):
+        return self.preprocess_orders([order])[0]
+
+    def preprocess_orders(self, orders):
+        # Each order back if it can be placed, or None if not. Numpy only
+        # pays for itself on bigger batches.
+        if len(orders) >= BATCH_MIN_ORDERS:
+            valid = self.orders_valid(orders)
+        else:
+            valid = [self.order_valid(order) for order in orders]
 
-        order.type_ = 'LIMIT'
-        return order
+        res = []
+        for order, ok in zip(orders, valid):
+            if ok:
+                order.type_ = 'LIMIT'
+                res.append(order)
+            else:
+                res.append(None)
+        return res
 
     def execute_order(self, order):
         base, quote = order.pair.split('/')
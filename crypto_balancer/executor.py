@@ -12,7 +12,8 @@ class Executor():
         self.exchange = exchange
         self.balancer = balancer
 
-    def run(self, force=False, trade=False, max_orders=5, mode='mid'):
+    def run(self, force=False, trade=False, max_orders=5, mode='mid',
+            deadline_ms=None, max_nodes=None, prior_orders=None):
 
         balances = self.portfolio.balances
 
@@ -22,13 +23,18 @@ class Executor():
                'balances': balances,
                'total_fee': 0.0,
                'initial_portfolio': self.portfolio,
-               'proposed_portfolio': None, }
+               'proposed_portfolio': None,
+               'partial': False, }
 
         if self.portfolio.needs_balancing or force:
             orders = self.balancer.balance(self.portfolio,
                                            self.exchange,
                                            max_orders,
-                                           mode)
+                                           mode,
+                                           deadline_ms=deadline_ms,
+                                           max_nodes=max_nodes,
+                                           prior_orders=prior_orders)
+            res['partial'] = orders.get('partial', False)
 
             if orders['proposed_portfolio']:
                 res['proposed_portfolio'] = orders['proposed_portfolio']
@@ -0,0 +1,270 @@
+import numpy as np
+
+from crypto_balancer.order import Order
+from crypto_balancer.simple_balancer import trade_route
+
+# Amounts of quote currency below this are treated as nothing left to move
+EPSILON = 1e-9
+
+
+class LinearBalancer():
+    """ Balancer that solves the rebalance as a min-cost flow rather than
+    searching over combinations of trades.
+
+    Currencies above their target supply value, currencies below their
+    target demand it, and value can move along any pair the exchange has
+    a rate for at the cost of one fee per hop. The flow that meets all of
+    the demand at the least total fee is then turned into orders, keeping
+    the largest max_orders of them that the exchange will accept. """
+
+    def shortest_paths(self, adjacency):
+        # Floyd-Warshall over the pair graph, keeping the next hop of each
+        # shortest path so the flows can be routed afterwards
+        num = len(adjacency)
+        dist = adjacency.copy()
+        next_hop = np.where(np.isfinite(adjacency),
+                            np.arange(num)[None, :], -1)
+        for k in range(num):
+            through = dist[:, k, None] + dist[None, k, :]
+            shorter = through < dist
+            dist = np.where(shorter, through, dist)
+            next_hop = np.where(shorter, next_hop[:, k, None], next_hop)
+        return dist, next_hop
+
+    def min_cost_flow(self, supply, demand, costs):
+        # Successive shortest paths on the bipartite supply -> demand
+        # network. Residual edges back from demand to supply let later
+        # paths re-route flow, which keeps the solution optimal.
+        supply = supply.copy()
+        demand = demand.copy()
+        flows = np.zeros_like(costs)
+        reachable = np.isfinite(costs)
+        num_s, num_d = costs.shape
+
+        while supply.sum() > EPSILON and demand.sum() > EPSILON:
+            # Bellman-Ford, vectorized over all edges at each pass. Only
+            # strict improvements move a predecessor, so ties can't turn
+            # the predecessors into a cycle.
+            dist_s = np.where(supply > EPSILON, 0.0, np.inf)
+            pred_s = np.full(num_s, -1)
+            dist_d = np.full(num_d, np.inf)
+            pred_d = np.full(num_d, -1)
+            for _ in range(num_s + num_d):
+                via = np.where(reachable, dist_s[:, None] + costs, np.inf)
+                via_pred = via.argmin(axis=0)
+                via_dist = via[via_pred, np.arange(num_d)]
+                better_d = via_dist < dist_d
+                dist_d = np.where(better_d, via_dist, dist_d)
+                pred_d = np.where(better_d, via_pred, pred_d)
+
+                back = np.where(flows > EPSILON,
+                                dist_d[None, :] - costs, np.inf)
+                back_pred = back.argmin(axis=1)
+                back_dist = back[np.arange(num_s), back_pred]
+                better_s = back_dist < dist_s
+                dist_s = np.where(better_s, back_dist, dist_s)
+                pred_s = np.where(better_s, back_pred, pred_s)
+
+                if not better_d.any() and not better_s.any():
+                    break
+
+            open_d = np.where(demand > EPSILON, dist_d, np.inf)
+            j = int(open_d.argmin())
+            if not np.isfinite(open_d[j]):
+                break
+
+            # Walk the path back to a supply node with spare value
+            path = []
+            d = j
+            for _ in range(num_s + num_d):
+                s = int(pred_d[d])
+                path.append((s, d))
+                if pred_s[s] < 0:
+                    break
+                d = int(pred_s[s])
+                path.append((s, d))
+
+            amount = min(supply[path[-1][0]], demand[j])
+            for i, (s, d) in enumerate(path):
+                if i % 2:
+                    amount = min(amount, flows[s, d])
+            if amount <= EPSILON:
+                break
+
+            for i, (s, d) in enumerate(path):
+                flows[s, d] += -amount if i % 2 else amount
+            supply[path[-1][0]] -= amount
+            demand[j] -= amount
+
+        return flows
+
+    def balance(self, initial_portfolio, exchange, max_orders=5, mode='mid',
+                deadline_ms=None, max_nodes=None, prior_orders=None,
+                rates=None):
+        # The flow is solved outright rather than searched for, so a budget
+        # never cuts it short, the result is never partial and there is
+        # nothing for a previous plan to prune
+        if rates is None:
+            rates = exchange.rates
+        quote_currency = initial_portfolio.quote_currency
+
+        # Add in the identify rate just so we don't have to special
+        # case it later
+        rates["{}/{}".format(quote_currency, quote_currency)] = {'mid': 1.0,
+                                                                 'high': 1.0,
+                                                                 'low': 1.0, }
+
+        res = {'orders': [],
+               'total_fee': 0.0,
+               'initial_portfolio': initial_portfolio,
+               'proposed_portfolio': None,
+               'partial': False}
+
+        # Currencies with no target that aren't held have nothing to move,
+        # so leave them out, other than counting them in the RMS error. The
+        # rest are sorted so the same inputs give the same plan whichever
+        # order they came in.
+        targets = initial_portfolio.targets
+        balances = initial_portfolio.balances
+        currencies = sorted(cur for cur in initial_portfolio.currencies
+                            if targets[cur] or balances[cur])
+        num_currencies = len(targets)
+        quote_rates = np.array([initial_portfolio.quote_rate(cur)
+                                for cur in currencies])
+        # Summed over the sorted currencies as SearchSpace does, rather
+        # than in whatever order the targets came in
+        balances_quote = [balances[cur] * rate
+                          for cur, rate in zip(currencies, quote_rates)]
+        total = sum(balances_quote)
+        diffs = np.array([total * (targets[cur] / 100.0) - amount
+                          for cur, amount in zip(currencies,
+                                                 balances_quote)])
+
+        num = len(currencies)
+        index = {cur: i for i, cur in enumerate(currencies)}
+        adjacency = np.full((num, num), np.inf)
+        np.fill_diagonal(adjacency, 0.0)
+        # Only pairs the exchange has limits for can be traded, so route
+        # value over those alone
+        limits = exchange.limits
+        for pair in rates:
+            base, quote = pair.split('/')
+            if base != quote and base in index and quote in index and \
+               pair in limits:
+                # Every hop costs the same fee, so count hops which keeps
+                # the path costs exact
+                adjacency[index[base], index[quote]] = 1.0
+                adjacency[index[quote], index[base]] = 1.0
+        dist, next_hop = self.shortest_paths(adjacency)
+
+        sellers = np.flatnonzero(diffs < -0.01)
+        buyers = np.flatnonzero(diffs > 0.01)
+        if not len(sellers) or not len(buyers):
+            return res
+
+        flows = self.min_cost_flow(-diffs[sellers], diffs[buyers],
+                                   dist[np.ix_(sellers, buyers)])
+
+        # Route each flow along its path, so it becomes a flow of value
+        # across actual pairs, and net off flows in opposite directions
+        edge_flows = np.zeros((num, num))
+        for s, d in zip(*np.nonzero(flows > EPSILON)):
+            a, b = sellers[s], buyers[d]
+            while a != b:
+                hop = next_hop[a, b]
+                edge_flows[a, hop] += flows[s, d]
+                a = hop
+        edge_flows = np.maximum(edge_flows - edge_flows.T, 0.0)
+
+        edges = list(zip(*np.nonzero(edge_flows > EPSILON)))
+        edges.sort(key=lambda x: -edge_flows[x])
+
+        candidates = []
+        for n_idx, p_idx in edges:
+            n_cur, p_cur = currencies[n_idx], currencies[p_idx]
+
+            # The same choice of pair as the search balancer makes
+            pairs = {}
+            for direction, pair in [("BUY", "{}/{}".format(p_cur, n_cur)),
+                                    ("SELL", "{}/{}".format(n_cur, p_cur))]:
+                if pair in rates:
+                    pairs[direction] = pair
+            trade_direction, trade_pair = trade_route(pairs, limits)
+            if trade_direction == "BUY":
+                amount_rate = quote_rates[p_idx]
+            else:
+                amount_rate = quote_rates[n_idx]
+
+            if mode == 'passive':
+                if trade_direction == 'BUY':
+                    trade_rate = rates[trade_pair]['low']
+                if trade_direction == 'SELL':
+                    trade_rate = rates[trade_pair]['high']
+            else:
+                trade_rate = rates[trade_pair]['mid']
+
+            order = Order(trade_pair, trade_direction,
+                          edge_flows[n_idx, p_idx] / amount_rate,
+                          trade_rate)
+            candidates.append((n_idx, p_idx, amount_rate, order))
+
+        orders = []
+        deltas = []
+        checked = exchange.preprocess_orders([x[-1] for x in candidates])
+        for (n_idx, p_idx, amount_rate, _), order in zip(candidates, checked):
+            if len(orders) >= max_orders:
+                break
+            if not order:
+                continue
+
+            # The exchange may have rounded the amount, so work the value
+            # moved back out from the order itself
+            delta = np.zeros(num)
+            delta[p_idx] = order.amount * amount_rate
+            delta[n_idx] = -delta[p_idx]
+            orders.append(order)
+            deltas.append(delta)
+
+        if not orders:
+            return res
+
+        # If the exchange turned down one hop of a route, the other hops
+        # can leave things worse than before. Drop whichever order hurts
+        # the most until every remaining order pulls its weight.
+        deltas = np.array(deltas)
+        balances_quote = np.array(balances_quote)
+        targets = np.array([initial_portfolio.targets[cur]
+                            for cur in currencies])
+
+        def rms_errors(proposed):
+            pcts = (total * (targets / 100.0) - proposed) / total * 100.0
+            return np.sqrt((pcts ** 2).sum(axis=-1) / num_currencies)
+
+        kept = np.ones(len(orders), dtype=bool)
+        proposed = balances_quote + deltas.sum(axis=0)
+        error = rms_errors(proposed)
+        while kept.any():
+            without = np.where(kept, rms_errors(proposed - deltas), np.inf)
+            worst = int(without.argmin())
+            if without[worst] >= error:
+                break
+            kept[worst] = False
+            proposed -= deltas[worst]
+            error = without[worst]
+
+        if not kept.any() or error >= rms_errors(balances_quote):
+            return res
+
+        portfolio = initial_portfolio.copy()
+        total_fee = 0.0
+        for delta in deltas[kept]:
+            for idx in np.flatnonzero(delta):
+                portfolio.balances[currencies[idx]] += \
+                    float(delta[idx] / quote_rates[idx])
+            total_fee += float(delta.max()) * exchange.fee
+
+        orders = [order for order, keep in zip(orders, kept) if keep]
+        res.update({'orders': sorted(orders),
+                    'total_fee': total_fee,
+                    'proposed_portfolio': portfolio})
+        return res
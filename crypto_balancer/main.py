@@ -1,16 +1,41 @@
 import argparse
 import configparser
+import json
 import logging
 import sys
 
 from crypto_balancer.simple_balancer import SimpleBalancer
+from crypto_balancer.linear_balancer import LinearBalancer
 from crypto_balancer.ccxt_exchange import CCXTExchange, exchanges
 from crypto_balancer.executor import Executor
-from crypto_balancer.portfolio import Portfolio
+from crypto_balancer.order import Order
+from crypto_balancer.plan_cache import CachingBalancer, PlanCache
+from crypto_balancer.portfolio import ArrayPortfolio
 
 logger = logging.getLogger(__name__)
 
 
+def load_plan(filename):
+    # The orders from the last run, to give the balancer a head start
+    try:
+        with open(filename) as f:
+            return [Order(x['pair'], x['direction'], x['amount'], x['price'])
+                    for x in json.load(f)]
+    except FileNotFoundError:
+        return None
+    except (ValueError, KeyError, TypeError):
+        logger.warning("Ignoring invalid plan file {}".format(filename))
+        return None
+
+
+def save_plan(filename, orders):
+    with open(filename, 'w') as f:
+        json.dump([{'pair': order.pair,
+                    'direction': order.direction,
+                    'amount': order.amount,
+                    'price': order.price} for order in orders], f)
+
+
 def main(args=None):
     config = configparser.ConfigParser()
     config.read('config.ini')
@@ -29,11 +54,41 @@ def main(args=None):
                              'rebalance')
     parser.add_argument('--valuebase', default='USDT',
                         help='Currency to value portfolio in')
+    parser.add_argument('--report-in', nargs='+', default=[],
+                        metavar='CURRENCY',
+                        help='Other currencies to also report the value of '
+                             'the portfolio in')
     parser.add_argument('--cancel', action="store_true",
                         help='Cancel open orders first')
     parser.add_argument('--mode', choices=['mid', 'passive', 'cheap'],
                         default='mid',
                         help='Mode to place orders')
+    parser.add_argument('--search', choices=SimpleBalancer.searches,
+                        default='dfs',
+                        help='Strategy to search for orders with')
+    parser.add_argument('--beam-width', type=int, default=100,
+                        help='Number of attempts to keep at each depth '
+                             'with the beam search')
+    parser.add_argument('--top-k', type=int, default=None,
+                        help='Only try this many pairings of currencies '
+                             'from each step of the search, the ones that '
+                             'can move the most value')
+    parser.add_argument('--plan-cache', default=None,
+                        help='Directory to keep plans in, so the same '
+                             'inputs reuse a plan rather than searching '
+                             'again')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of processes to search for orders '
+                             'with, only with the dfs search')
+    parser.add_argument('--time-budget', type=int, default=None,
+                        help='Milliseconds to search for orders for, '
+                             'using the best found so far when it runs out')
+    parser.add_argument('--plan-file', default=None,
+                        help='File to keep the last plan in, which is used '
+                             'to speed up the next search')
+    parser.add_argument('--balancer', choices=['simple', 'linear'],
+                        default='simple',
+                        help='Balancer to calculate orders with')
     parser.add_argument('exchange', choices=exchange_choices())
     args = parser.parse_args()
 
@@ -71,7 +126,7 @@ def main(args=None):
     threshold = float(config['threshold'])
     max_orders = int(args.max_orders)
 
-    portfolio = Portfolio.make_portfolio(targets, exchange, threshold, valuebase)
+    portfolio = ArrayPortfolio.make_portfolio(targets, exchange, threshold, valuebase)
 
     print("Current Portfolio:")
     for cur in portfolio.balances:
@@ -84,12 +139,32 @@ def main(args=None):
     print()
     print("  Total value: {:.2f} {}".format(portfolio.valuation_quote,
                                             portfolio.quote_currency))
-    balancer = SimpleBalancer()
+    valuations = portfolio.valuations(args.report_in)
+    for quote_currency, valuation in valuations.items():
+        print("               {:.8g} {}".format(valuation['valuation_quote'],
+                                                quote_currency))
+    if args.balancer == 'linear':
+        balancer = LinearBalancer()
+    else:
+        balancer = SimpleBalancer(search=args.search,
+                                  workers=args.workers,
+                                  beam_width=args.beam_width,
+                                  top_k=args.top_k)
+    if args.plan_cache:
+        balancer = CachingBalancer(balancer,
+                                   PlanCache(directory=args.plan_cache))
+    prior_orders = None
+    if args.plan_file:
+        prior_orders = load_plan(args.plan_file)
     executor = Executor(portfolio, exchange, balancer)
     res = executor.run(force=args.force,
                        trade=args.trade,
                        max_orders=max_orders,
-                       mode=args.mode)
+                       mode=args.mode,
+                       deadline_ms=args.time_budget,
+                       prior_orders=prior_orders)
+    if args.plan_file and res['orders']:
+        save_plan(args.plan_file, res['orders'])
 
     print("  Balance RMS error: {:.2g} / {:.2g}".format(
         res['initial_portfolio'].balance_rms_error,
@@ -106,7 +181,8 @@ def main(args=None):
 
     print("Balancing needed{}:".format(" [FORCED]" if args.force else ""))
     print()
-    print("Proposed Portfolio:")
+    print("Proposed Portfolio{}:".format(
+        " [PARTIAL SEARCH]" if res['partial'] else ""))
     portfolio = res['proposed_portfolio']
 
     if not portfolio:
@@ -1,13 +1,45 @@
+import sys
+
+
 class Order():
+    # The search makes a lot of these, so there's no per-instance __dict__
+    # and the fields are only kept in the tuple they sort and compare on,
+    # rather than building that tuple on every comparison
+    __slots__ = ('key', 'type_')
+
     def __init__(self, pair, direction, amount, price):
         if direction.upper() not in ['BUY', 'SELL']:
             raise ValueError("{} is not a valid direction".format(direction))
-        self.pair = pair
-        self.direction = direction
-        self.amount = float(amount)
-        self.price = float(price)
+        # There are only a few pairs and directions, so share one string
+        # for each between all the orders
+        self.key = (sys.intern(pair), sys.intern(direction),
+                    float(amount), float(price))
         self.type_ = None
 
+    @property
+    def pair(self):
+        return self.key[0]
+
+    @property
+    def direction(self):
+        return self.key[1]
+
+    @property
+    def amount(self):
+        return self.key[2]
+
+    @amount.setter
+    def amount(self, amount):
+        self.key = self.key[:2] + (float(amount), self.key[3])
+
+    @property
+    def price(self):
+        return self.key[3]
+
+    @price.setter
+    def price(self, price):
+        self.key = self.key[:3] + (float(price),)
+
     def __str__(self):
         return f"{self.direction} {self.amount} {self.pair} @ {self.price}"
 
@@ -15,15 +47,10 @@ class Order():
         return f"Order('{self.pair}', '{self.direction}', {self.amount}, {self.price})"
 
     def __eq__(self, other):
-        return self.pair == other.pair and \
-            self.direction == other.direction and \
-            self.amount == other.amount and \
-            self.price == other.price
+        return self.key == other.key
 
     def __lt__(self, other):
-        return (self.pair, self.direction, self.amount, self.price) < \
-            (other.pair, other.direction, other.amount, other.price)
+        return self.key < other.key
 
     def __hash__(self):
-        return hash((self.pair, self.direction, self.amount, self.price))
-
+        return hash(self.key)
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+
+from collections import OrderedDict
+
+from crypto_balancer.order import Order
+from crypto_balancer.portfolio import quote_conversions
+from crypto_balancer.simple_balancer import quantize
+
+
+def plan_key(portfolio, exchange, rates, max_orders, mode, balancer=None,
+             prior_orders=None):
+    """ Hash of everything a plan is worked out from: the targets and
+    balances, the rates and limits of the pairs between the currencies,
+    the rate each currency is valued at in the quote currency, which can
+    go through other currencies, the fee, the mode, max_orders, the
+    balancer's settings and any previous plan. Numbers are quantized and
+    everything is put in order first, so the same inputs always give the
+    same key, between runs as well. """
+
+    def number(x):
+        return None if x is None else quantize(float(x))
+
+    currencies = sorted(portfolio.currencies)
+    pairs = []
+    for pair in sorted(rates):
+        base, quote = pair.split('/')
+        # The identity rate the balancers add in doesn't change anything
+        if base != quote and base in portfolio.targets and \
+           quote in portfolio.targets:
+            pairs.append(pair)
+
+    limits = exchange.limits
+    conversions = quote_conversions(rates, portfolio.quote_currency)
+    content = {
+        'quote_currency': portfolio.quote_currency,
+        'targets': [[cur, number(portfolio.targets[cur])]
+                    for cur in currencies],
+        'balances': [[cur, number(portfolio.balances[cur])]
+                     for cur in currencies],
+        'rates': [[pair] + [number(rates[pair].get(x))
+                            for x in ['mid', 'high', 'low']]
+                  for pair in pairs],
+        'quote_rates': [[cur, number(conversions.get(cur))]
+                        for cur in currencies],
+        'limits': [[pair,
+                    number(limits[pair]['amount']['min']),
+                    number(limits[pair]['cost']['min'])]
+                   for pair in pairs if pair in limits],
+        'fee': number(exchange.fee),
+        'mode': mode,
+        'max_orders': max_orders,
+        'balancer': None,
+        'prior_orders': sorted([order.pair, order.direction,
+                                number(order.amount), number(order.price)]
+                               for order in prior_orders or []),
+    }
+    if balancer is not None:
+        settings = sorted((k, v) for k, v in vars(balancer).items()
+                          if isinstance(v, (str, int, float, type(None))))
+        content['balancer'] = [type(balancer).__name__, settings]
+
+    content = json.dumps(content, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class PlanCache():
+    """ Plans by the key of what they were worked out from. The most
+    recently used are kept in memory, and given a directory every plan is
+    also written there so they last between runs. """
+
+    def __init__(self, maxsize=128, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.plans = OrderedDict()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def filename(self, key):
+        return os.path.join(self.directory, "{}.json".format(key))
+
+    def get(self, key):
+        plan = self.plans.get(key)
+        if plan is not None:
+            self.plans.move_to_end(key)
+            return plan
+
+        if self.directory is None:
+            return None
+        try:
+            with open(self.filename(key)) as f:
+                plan = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # Half written or otherwise broken, so just work it out again
+            return None
+        self.remember(key, plan)
+        return plan
+
+    def put(self, key, plan):
+        self.remember(key, plan)
+        if self.directory is not None:
+            # Written to one side first so a reader never sees half a plan
+            filename = self.filename(key)
+            with open(filename + '.tmp', 'w') as f:
+                json.dump(plan, f)
+            os.replace(filename + '.tmp', filename)
+
+    def remember(self, key, plan):
+        self.plans[key] = plan
+        self.plans.move_to_end(key)
+        while len(self.plans) > self.maxsize:
+            self.plans.popitem(last=False)
+
+
+class CachingBalancer():
+    """ Wraps a balancer so a plan already worked out for the same inputs is
+    used again rather than searched for, such as on dry runs one after
+    another or over a flat stretch of a backtest. Plans cut short by a
+    budget aren't kept, as another go could do better. """
+
+    def __init__(self, balancer, cache=None):
+        self.balancer = balancer
+        self.cache = cache if cache is not None else PlanCache()
+
+    def balance(self, initial_portfolio, exchange, max_orders=5, mode='mid',
+                deadline_ms=None, max_nodes=None, prior_orders=None,
+                rates=None):
+        if rates is None:
+            rates = exchange.rates
+        key = plan_key(initial_portfolio, exchange, rates, max_orders, mode,
+                       self.balancer, prior_orders)
+
+        plan = self.cache.get(key)
+        if plan is not None:
+            return self.result(initial_portfolio, plan)
+
+        res = self.balancer.balance(initial_portfolio, exchange, max_orders,
+                                    mode, deadline_ms=deadline_ms,
+                                    max_nodes=max_nodes,
+                                    prior_orders=prior_orders, rates=rates)
+        if not res.get('partial'):
+            self.cache.put(key, self.plan(res))
+        res['cached'] = False
+        return res
+
+    @staticmethod
+    def plan(res):
+        balances = None
+        if res['proposed_portfolio']:
+            balances = dict(res['proposed_portfolio'].balances)
+        return {'orders': [[order.pair, order.direction, order.amount,
+                            order.price, order.type_]
+                           for order in res['orders']],
+                'total_fee': res['total_fee'],
+                'balances': balances}
+
+    @staticmethod
+    def result(initial_portfolio, plan):
+        orders = []
+        for pair, direction, amount, price, type_ in plan['orders']:
+            order = Order(pair, direction, amount, price)
+            order.type_ = type_
+            orders.append(order)
+
+        proposed_portfolio = None
+        if plan['balances'] is not None:
+            proposed_portfolio = initial_portfolio.copy()
+            proposed_portfolio.balances = dict(plan['balances'])
+
+        return {'orders': orders,
+                'total_fee': plan['total_fee'],
+                'initial_portfolio': initial_portfolio,
+                'proposed_portfolio': proposed_portfolio,
+                'nodes_expanded': 0,
+                'partial': False,
+                'cached': True}
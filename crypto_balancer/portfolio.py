@@ -1,5 +1,72 @@
 import math
 
+from collections.abc import MutableMapping
+
+import numpy as np
+
+
+def conversion_routes(pairs, quote_currency):
+    """ How quote_conversions reaches each currency from the quote currency
+    over the pairs, as a dict from currency to (pair, inverse, previous
+    currency), in the order they're reached. inverse is True where the
+    pair is used the other way round. """
+    # edges[cur] is every (other, pair, inverse) where a rate of the pair
+    # takes cur to other, with the pairs the right way round first so they
+    # win a tie with an inverse. Going over the pairs in order means other
+    # ties are always broken the same way, however they happen to be
+    # ordered.
+    direct = {}
+    inverse = {}
+    for pair in sorted(pairs):
+        base, quote = pair.split('/')
+        if base == quote:
+            continue
+        direct.setdefault(quote, []).append((base, pair, False))
+        inverse.setdefault(base, []).append((quote, pair, True))
+
+    routes = {quote_currency: None}
+    todo = [quote_currency]
+    while todo:
+        next_todo = []
+        for cur in todo:
+            for other, pair, inv in direct.get(cur, []) + \
+                    inverse.get(cur, []):
+                if other not in routes:
+                    routes[other] = (pair, inv, cur)
+                    next_todo.append(other)
+        todo = next_todo
+    del routes[quote_currency]
+    return routes
+
+
+def quote_conversions(rates, quote_currency):
+    """ Rate to convert each currency the rates reach into the quote
+    currency, going through other currencies where there's no pair with
+    the quote currency itself. Pairs can be used either way round, and
+    the path with the fewest hops is used. """
+    pairs = [pair for pair, rate in rates.items()
+             if rate['mid'] and rate['mid'] > 0]
+
+    conversions = {quote_currency: 1.0}
+    for cur, (pair, inv, prev) in conversion_routes(pairs,
+                                                    quote_currency).items():
+        mid = rates[pair]['mid']
+        conversions[cur] = (1.0 / mid if inv else mid) * conversions[prev]
+    return conversions
+
+
+def conversion_matrix(rates, currencies, quote_currencies):
+    """ Rates to convert each of the currencies (rows) into each of the
+    quote currencies (columns), as quote_conversions would get them. NaN
+    where the rates don't join a currency to a quote currency, which only
+    matters if the currency is held or wanted. """
+    matrix = np.empty((len(currencies), len(quote_currencies)))
+    for j, quote_currency in enumerate(quote_currencies):
+        conversions = quote_conversions(rates, quote_currency)
+        for i, cur in enumerate(currencies):
+            matrix[i, j] = conversions.get(cur, np.nan)
+    return matrix
+
 
 class Portfolio():
 
@@ -21,17 +88,24 @@ class Portfolio():
         self.rates = {}
 
     def copy(self):
-        p = Portfolio(self.targets,
-                      self.exchange,
-                      self.threshold,
-                      self.quote_currency)
+        p = self.__class__(self.targets,
+                           self.exchange,
+                           self.threshold,
+                           self.quote_currency)
         p.balances = self.balances.copy()
         p.rates = self.rates.copy()
+        # Same rates, so no need to work the conversions out again
+        p._quote_rates = self._quote_rates
+        p._conversion_matrices = self._conversion_matrices
         return p
 
     def sync_balances(self):
         self.balances = self.exchange.balances.copy()
 
+    def apply_trade(self, buy_cur, buy_amt, sell_cur, sell_amt):
+        self.balances[buy_cur] += buy_amt
+        self.balances[sell_cur] -= sell_amt
+
     def sync_rates(self):
         self.rates = self.exchange.rates.copy()
 
@@ -39,20 +113,103 @@ class Portfolio():
     def currencies(self):
         return self.targets.keys()
 
+    @property
+    def rates(self):
+        return self._rates
+
+    @rates.setter
+    def rates(self, rates):
+        self._rates = rates
+        self._quote_rates = None
+        self._conversion_matrices = {}
+
+    @property
+    def quote_rates(self):
+        # Worked out once for each set of rates, which only changes with
+        # sync_rates or by assigning to rates
+        if self._quote_rates is None:
+            self._quote_rates = quote_conversions(self.rates,
+                                                  self.quote_currency)
+        return self._quote_rates
+
+    def quote_rate(self, cur):
+        try:
+            return self.quote_rates[cur]
+        except KeyError:
+            raise ValueError("Invalid pair: {}/{}"
+                             .format(cur, self.quote_currency))
+
+    def conversion_matrix(self, quote_currencies):
+        # Worked out once for each set of rates, like quote_rates
+        quote_currencies = tuple(quote_currencies)
+        matrix = self._conversion_matrices.get(quote_currencies)
+        if matrix is None:
+            matrix = conversion_matrix(self.rates, list(self.currencies),
+                                       quote_currencies)
+            self._conversion_matrices[quote_currencies] = matrix
+        return matrix
+
+    def valuations(self, quote_currencies):
+        """ The valuation and errors of the portfolio in each of the quote
+        currencies, all worked out at once from the conversion matrix
+        rather than valuing the portfolio again for each one. Returns a
+        dict from quote currency to a dict of balances_quote,
+        valuation_quote, balance_rms_error and balance_max_error. """
+        quote_currencies = list(quote_currencies)
+        currencies = list(self.currencies)
+        balances = np.array([self.balances[cur] for cur in currencies],
+                            dtype=float)
+        targets = np.array([self.targets[cur] for cur in currencies],
+                           dtype=float) / 100.0
+
+        # Currencies neither held nor wanted don't need a price, as with
+        # balances_quote
+        matrix = self.conversion_matrix(quote_currencies)
+        unpriced = np.isnan(matrix)
+        if unpriced.any():
+            needed = (balances != 0) | (targets != 0)
+            missing = unpriced & needed[:, None]
+            if missing.any():
+                j, i = np.argwhere(missing.T)[0]
+                raise ValueError("Invalid pair: {}/{}"
+                                 .format(currencies[i], quote_currencies[j]))
+            matrix = np.where(unpriced, 0.0, matrix)
+
+        _balances_quote = balances[:, None] * matrix
+        _totals = _balances_quote.sum(axis=0)
+        divisors = np.where(_totals == 0, 1.0, _totals)
+        pcts = (divisors * targets[:, None] - _balances_quote) \
+            / divisors * 100.0
+        pcts[:, _totals == 0] = 0.0
+        if currencies:
+            rms_errors = np.sqrt((pcts ** 2).mean(axis=0))
+            max_errors = np.abs(pcts).max(axis=0)
+        else:
+            rms_errors = max_errors = np.zeros(len(quote_currencies))
+
+        res = {}
+        for j, quote_currency in enumerate(quote_currencies):
+            res[quote_currency] = {
+                'balances_quote': dict(zip(currencies,
+                                           _balances_quote[:, j].tolist())),
+                'valuation_quote': float(_totals[j]),
+                'balance_rms_error': float(rms_errors[j]),
+                'balance_max_error': float(max_errors[j]),
+            }
+        return res
+
     @property
     def balances_quote(self):
         _balances_quote = {}
-        qc = self.quote_currency
         for cur in self.currencies:
             amount = self.balances[cur]
             if cur == self.quote_currency:
                 _balances_quote[cur] = amount
+            elif not amount and not self.targets[cur]:
+                # Neither held nor wanted, so it doesn't need a price
+                _balances_quote[cur] = 0.0
             else:
-                pair = f"{cur}/{qc}"
-                try:
-                    _balances_quote[cur] = amount * self.rates[pair]['mid']
-                except KeyError:
-                    raise ValueError("Invalid pair: {}".format(pair))
+                _balances_quote[cur] = amount * self.quote_rate(cur)
 
         return _balances_quote
 
@@ -117,3 +274,483 @@ class Portfolio():
                 - _balances_quote[cur]
 
         return {cur: calc_diff(cur) for cur in self.currencies}
+
+
+class ErrorSums():
+    """ Running sums that the RMS error of a portfolio can be worked out
+    from: the total value, the sum of each target times its value, and
+    the sum of the values squared. A trade only changes two of the values,
+    so the sums can be updated without going over every currency.
+
+    Working the error out from the sums cancels terms that are much bigger
+    than the error itself when a portfolio is nearly balanced, and the
+    rounding adds up over many trades. rms_error gives None when it can't
+    be trusted, and it then has to be worked out the long way. """
+
+    # How small the squared error can get, relative to the sum of the
+    # targets squared, before the cancellation is too much
+    CANCELLATION = 1e-6
+    # How many trades to apply before working the sums out again
+    MAX_TRADES = 100
+
+    def __init__(self, num, target_squares, total, cross, squares,
+                 trades=0):
+        self.num = num
+        self.target_squares = target_squares
+        self.total = total
+        self.cross = cross
+        self.squares = squares
+        self.trades = trades
+
+    @classmethod
+    def from_values(cls, targets, values, num=None):
+        # targets as fractions of 1 and values in the quote currency. num
+        # counts any currencies left out with no target and no value.
+        return cls(len(targets) if num is None else num,
+                   sum(t * t for t in targets),
+                   sum(values),
+                   sum(t * v for t, v in zip(targets, values)),
+                   sum(v * v for v in values))
+
+    def trade(self, buy_target, buy_old, buy_new,
+              sell_target, sell_old, sell_new):
+        return ErrorSums(self.num,
+                         self.target_squares,
+                         self.total + (buy_new - buy_old) +
+                         (sell_new - sell_old),
+                         self.cross + buy_target * (buy_new - buy_old) +
+                         sell_target * (sell_new - sell_old),
+                         self.squares + (buy_new * buy_new -
+                                         buy_old * buy_old) +
+                         (sell_new * sell_new - sell_old * sell_old),
+                         self.trades + 1)
+
+    @property
+    def rms_error(self):
+        if self.trades > self.MAX_TRADES:
+            return None
+        if not self.total:
+            return 0.0
+        total = self.total
+        squared = self.target_squares - 2 * self.cross / total + \
+            self.squares / (total * total)
+        if squared < self.CANCELLATION * self.target_squares:
+            return None
+        return math.sqrt(squared / self.num) * 100.0
+
+
+class Balances(MutableMapping):
+    """ The balances of an ArrayPortfolio. Reads and writes like a dict,
+    but the currencies the portfolio targets are stored in a vector, and
+    changing any of them tells the portfolio to drop what it has cached.
+    Anything else the exchange holds is kept to one side. """
+
+    def __init__(self, portfolio, balances=None):
+        self.portfolio = portfolio
+        self.vector = np.zeros(len(portfolio.index))
+        self.present = np.zeros(len(portfolio.index), dtype=bool)
+        self.extra = {}
+        for cur, amount in (balances or {}).items():
+            idx = portfolio.index.get(cur)
+            if idx is None:
+                self.extra[cur] = amount
+            else:
+                self.vector[idx] = amount
+                self.present[idx] = True
+
+    def __getitem__(self, cur):
+        idx = self.portfolio.index.get(cur)
+        if idx is None:
+            return self.extra[cur]
+        if not self.present[idx]:
+            raise KeyError(cur)
+        return float(self.vector[idx])
+
+    def __setitem__(self, cur, amount):
+        idx = self.portfolio.index.get(cur)
+        if idx is None:
+            self.extra[cur] = amount
+            return
+        self.vector[idx] = amount
+        self.present[idx] = True
+        self.portfolio.invalidate()
+
+    def __delitem__(self, cur):
+        idx = self.portfolio.index.get(cur)
+        if idx is None:
+            del self.extra[cur]
+            return
+        if not self.present[idx]:
+            raise KeyError(cur)
+        self.present[idx] = False
+        self.portfolio.invalidate()
+
+    def __iter__(self):
+        for cur, idx in self.portfolio.index.items():
+            if self.present[idx]:
+                yield cur
+        yield from self.extra
+
+    def __len__(self):
+        return int(self.present.sum()) + len(self.extra)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def copy(self):
+        return dict(self)
+
+
+class ArrayPortfolio(Portfolio):
+    """ Portfolio that keeps the balances, targets and quote rates as NumPy
+    vectors in the same currency order, and works out the derived metrics
+    once until the balances or rates change.
+
+    The balances can be changed in place as with a Portfolio, but the rates
+    are only picked up again by sync_rates or by assigning to rates. """
+
+    def __init__(self, targets, exchange, threshold=1.0,
+                 quote_currency="USDT"):
+        self.index = {cur: i for i, cur in enumerate(targets)}
+        self.target_vector = np.array([targets[cur] for cur in targets],
+                                      dtype=float) / 100.0
+        self._quote_vector = None
+        self._metrics = None
+        self._error_sums = None
+        super().__init__(targets, exchange, threshold, quote_currency)
+
+    def copy(self):
+        p = super().copy()
+        p._quote_vector = self._quote_vector
+        return p
+
+    def invalidate(self):
+        self._metrics = None
+        self._error_sums = None
+
+    def apply_trade(self, buy_cur, buy_amt, sell_cur, sell_amt):
+        # Only two balances change, so update the error sums from those
+        # rather than dropping them along with everything else
+        balances = self._balances
+        buy_idx = self.index[buy_cur]
+        sell_idx = self.index[sell_cur]
+        if not balances.present[buy_idx]:
+            raise KeyError(buy_cur)
+        if not balances.present[sell_idx]:
+            raise KeyError(sell_cur)
+
+        error_sums = self.error_sums
+        quote_rates = self.quote_vector
+        buy_old = float(balances.vector[buy_idx])
+        sell_old = float(balances.vector[sell_idx])
+        balances.vector[buy_idx] += buy_amt
+        balances.vector[sell_idx] -= sell_amt
+        self._metrics = None
+        buy_rate = float(quote_rates[buy_idx])
+        sell_rate = float(quote_rates[sell_idx])
+        if math.isnan(buy_rate) or math.isnan(sell_rate):
+            # Traded something with no price, leave metrics to complain
+            self._error_sums = None
+            return
+        self._error_sums = error_sums.trade(
+            float(self.target_vector[buy_idx]),
+            buy_old * buy_rate,
+            float(balances.vector[buy_idx]) * buy_rate,
+            float(self.target_vector[sell_idx]),
+            sell_old * sell_rate,
+            float(balances.vector[sell_idx]) * sell_rate)
+
+    @property
+    def balances(self):
+        return self._balances
+
+    @balances.setter
+    def balances(self, balances):
+        self._balances = Balances(self, balances)
+        self.invalidate()
+
+    @property
+    def rates(self):
+        return self._rates
+
+    @rates.setter
+    def rates(self, rates):
+        self._rates = rates
+        self._quote_rates = None
+        self._conversion_matrices = {}
+        self._quote_vector = None
+        self.invalidate()
+
+    @property
+    def quote_vector(self):
+        if self._quote_vector is None:
+            quote_rates = []
+            for cur in self.currencies:
+                if cur not in self.quote_rates and not self.targets[cur]:
+                    # Only needs a price if it's held, which metrics checks
+                    quote_rates.append(np.nan)
+                else:
+                    quote_rates.append(self.quote_rate(cur))
+            self._quote_vector = np.array(quote_rates, dtype=float)
+        return self._quote_vector
+
+    @property
+    def metrics(self):
+        # (balances in quote, total, errors as percentages), kept until
+        # something changes
+        if self._metrics is None:
+            balances = self._balances
+            if not balances.present.all():
+                missing = [cur for cur, idx in self.index.items()
+                           if not balances.present[idx]]
+                raise KeyError(missing[0])
+            _balances_quote = balances.vector * self.quote_vector
+            unpriced = np.isnan(_balances_quote)
+            if unpriced.any():
+                held = unpriced & (balances.vector != 0)
+                if held.any():
+                    cur = list(self.currencies)[int(held.argmax())]
+                    raise ValueError("Invalid pair: {}/{}"
+                                     .format(cur, self.quote_currency))
+                _balances_quote[unpriced] = 0.0
+            _total = float(_balances_quote.sum())
+            if _total:
+                pcts = (_total * self.target_vector - _balances_quote) \
+                    / _total * 100.0
+            else:
+                pcts = np.zeros(0)
+            self._metrics = (_balances_quote, _total, pcts)
+        return self._metrics
+
+    @property
+    def error_sums(self):
+        if self._error_sums is None:
+            _balances_quote, _, _ = self.metrics
+            self._error_sums = ErrorSums.from_values(
+                self.target_vector.tolist(), _balances_quote.tolist())
+        return self._error_sums
+
+    @property
+    def balances_quote(self):
+        _balances_quote, _, _ = self.metrics
+        return dict(zip(self.currencies, _balances_quote.tolist()))
+
+    @property
+    def valuation_quote(self):
+        _, _total, _ = self.metrics
+        return _total
+
+    @property
+    def balances_pct(self):
+        _balances_quote, _total, _ = self.metrics
+
+        if not _total:
+            return {cur: 0 for cur in self.currencies}
+
+        return dict(zip(self.currencies,
+                        (_balances_quote / _total * 100.0).tolist()))
+
+    @property
+    def balance_errors_pct(self):
+        _, _, pcts = self.metrics
+        return pcts.tolist()
+
+    @property
+    def balance_rms_error(self):
+        if self._metrics is None and self._error_sums is not None:
+            rms_error = self._error_sums.rms_error
+            if rms_error is not None:
+                return rms_error
+            self._error_sums = None
+        _, _, pcts = self.metrics
+        num = len(pcts)
+        if not num:
+            return 0.0
+        return math.sqrt(float((pcts ** 2).sum()) / num)
+
+    @property
+    def balance_max_error(self):
+        _, _, pcts = self.metrics
+        return float(np.abs(pcts).max())
+
+    @property
+    def differences_quote(self):
+        _balances_quote, _total, _ = self.metrics
+        return dict(zip(self.currencies,
+                        (_total * self.target_vector -
+                         _balances_quote).tolist()))
+
+
+class PortfolioSet():
+    """ Several portfolios with the same targets, such as sub-accounts run
+    on the same allocation, possibly on different exchanges.
+
+    The rates are fetched once for each exchange and shared by all of the
+    accounts on it, and the valuations and errors of every account are
+    worked out together as matrices with a row for each account and a
+    column for each currency. The accounts can be rebalanced one by one
+    or as a whole. """
+
+    @classmethod
+    def make_portfolio_set(cls, targets, exchanges, threshold=1.0,
+                           quote_currency="USDT", portfolio_class=Portfolio):
+        portfolios = []
+        for exchange in exchanges:
+            p = portfolio_class(targets, exchange, threshold, quote_currency)
+            p.sync_balances()
+            portfolios.append(p)
+        portfolio_set = cls(portfolios)
+        portfolio_set.sync_rates()
+        return portfolio_set
+
+    def __init__(self, portfolios):
+        self.portfolios = list(portfolios)
+        if not self.portfolios:
+            raise ValueError("A portfolio set needs at least one portfolio")
+        first = self.portfolios[0]
+        for p in self.portfolios[1:]:
+            if p.targets != first.targets or \
+               p.quote_currency != first.quote_currency:
+                raise ValueError("Portfolios in a set need the same targets "
+                                 "and quote currency")
+        self.targets = first.targets
+        self.quote_currency = first.quote_currency
+        self.currencies = list(first.currencies)
+        self.target_vector = np.array([self.targets[cur]
+                                       for cur in self.currencies],
+                                      dtype=float) / 100.0
+        self.snapshots = {}
+
+    def __len__(self):
+        return len(self.portfolios)
+
+    def __iter__(self):
+        return iter(self.portfolios)
+
+    def sync_balances(self):
+        for p in self.portfolios:
+            p.sync_balances()
+
+    def sync_rates(self):
+        # The rates are the same for every account on an exchange, so only
+        # ask the first one for them, and only work the conversions into
+        # the quote currency out once for each exchange too. Exchanges
+        # are told apart by identity, as two of them can share a name.
+        snapshots = {}
+        conversions = {}
+        for p in self.portfolios:
+            key = id(p.exchange)
+            if key not in snapshots:
+                snapshots[key] = p.exchange.rates.copy()
+                conversions[key] = quote_conversions(snapshots[key],
+                                                     self.quote_currency)
+            p.rates = snapshots[key]
+            p._quote_rates = conversions[key]
+        self.snapshots = snapshots
+
+    def rates(self, portfolio):
+        # The snapshot the portfolio's exchange shares with the rest
+        return self.snapshots.get(id(portfolio.exchange), portfolio.rates)
+
+    @property
+    def balance_matrix(self):
+        return np.array([[p.balances[cur] for cur in self.currencies]
+                         for p in self.portfolios], dtype=float)
+
+    @property
+    def quote_matrix(self):
+        rows = {}
+        for p in self.portfolios:
+            key = id(p.exchange)
+            if key not in rows:
+                rows[key] = [p.quote_rates.get(cur, np.nan)
+                             for cur in self.currencies]
+        matrix = np.array([rows[id(p.exchange)] for p in self.portfolios],
+                          dtype=float)
+
+        # Currencies neither held nor wanted don't need a price, as with
+        # Portfolio.balances_quote
+        unpriced = np.isnan(matrix)
+        if unpriced.any():
+            needed = (self.balance_matrix != 0) | (self.target_vector != 0)
+            missing = unpriced & needed
+            if missing.any():
+                cur = self.currencies[int(np.argwhere(missing)[0][1])]
+                raise ValueError("Invalid pair: {}/{}"
+                                 .format(cur, self.quote_currency))
+            matrix[unpriced] = 0.0
+        return matrix
+
+    @property
+    def metrics(self):
+        # (balances in quote, total of each account, errors as percentages)
+        # for every account in one go. Worked out again on each call, as
+        # the portfolios can change underneath the set.
+        _balances_quote = self.balance_matrix * self.quote_matrix
+        _totals = _balances_quote.sum(axis=1)
+        # Nothing held at all counts as no error
+        empty = _totals == 0
+        divisors = np.where(empty, 1.0, _totals)[:, None]
+        pcts = (divisors * self.target_vector - _balances_quote) \
+            / divisors * 100.0
+        pcts[empty] = 0.0
+        return _balances_quote, _totals, pcts
+
+    @property
+    def valuations_quote(self):
+        _, _totals, _ = self.metrics
+        return _totals.tolist()
+
+    @property
+    def valuation_quote(self):
+        _, _totals, _ = self.metrics
+        return float(_totals.sum())
+
+    @property
+    def balance_rms_errors(self):
+        _, _, pcts = self.metrics
+        return np.sqrt((pcts ** 2).mean(axis=1)).tolist()
+
+    @property
+    def balance_max_errors(self):
+        _, _, pcts = self.metrics
+        return np.abs(pcts).max(axis=1).tolist()
+
+    @property
+    def needs_balancing(self):
+        return [error > p.threshold for error, p in
+                zip(self.balance_max_errors, self.portfolios)]
+
+    def aggregate(self, account=0):
+        """ One portfolio holding everything the accounts hold between
+        them, valued at the rates of the given account's exchange. Orders
+        to balance it are placed on that account, so it needs to hold
+        enough of whatever they sell. """
+        p = self.portfolios[account]
+        portfolio = p.copy()
+        totals = self.balance_matrix.sum(axis=0).tolist()
+        balances = dict(p.balances)
+        balances.update(zip(self.currencies, totals))
+        portfolio.balances = balances
+        return portfolio
+
+    def balance_each(self, balancer, max_orders=5, mode='mid', force=False,
+                     **kwargs):
+        # A result for each account in turn, None for those that don't
+        # need balancing. Each one trades with the rates snapshot of its
+        # exchange.
+        results = []
+        for p, needed in zip(self.portfolios, self.needs_balancing):
+            if not needed and not force:
+                results.append(None)
+                continue
+            results.append(balancer.balance(p, p.exchange, max_orders, mode,
+                                            rates=self.rates(p), **kwargs))
+        return results
+
+    def balance_aggregate(self, balancer, max_orders=5, mode='mid',
+                          account=0, **kwargs):
+        p = self.portfolios[account]
+        return balancer.balance(self.aggregate(account), p.exchange,
+                                max_orders, mode, rates=self.rates(p),
+                                **kwargs)
@@ -1,156 +1,885 @@
+import bisect
+import heapq
+import math
+import time
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
 from crypto_balancer.order import Order
+from crypto_balancer.portfolio import ErrorSums, quote_conversions
 from itertools import product
 
-class Attempt():
-    def __init__(self, portfolio, orders=None, total_fee=0.0, depth=0,
-                 pairs_processed=None):
+# Slack allowed when pruning on the lower bound, so that attempts whose
+# error only differs by floating point noise are never cut off
+BOUND_TOLERANCE = 1e-9
+
+# Below this many currencies there are too few candidate trades per attempt
+# for scoring them as a batch to pay for the array overhead
+BATCH_MIN_CURRENCIES = 8
+
+
+def quantize(value, digits=9):
+    # Round to a number of significant digits so that values that only
+    # differ by floating point noise compare equal
+    return float('%.*g' % (digits, value))
+
+
+def quantize_rows(values, digits=9):
+    # quantize() for a whole array at once, returning a tuple per row. This
+    # can differ from quantize() in the last bit, so keys made by the two
+    # shouldn't be compared with each other.
+    magnitude = np.floor(np.log10(np.abs(values) + (values == 0)))
+    scale = 10.0 ** (digits - 1 - magnitude)
+    return [tuple(row) for row in (np.round(values * scale) / scale).tolist()]
+
+
+def trade_route(pairs, limits):
+    # The direction and pair to trade, given the pairs that join two
+    # currencies by direction. Only pairs with limits can be traded, and
+    # selling wins if both can be.
+    for direction in ['SELL', 'BUY']:
+        pair = pairs.get(direction)
+        if pair is not None and pair in limits:
+            return direction, pair
+    return None
+
+
+def search_subtree(balancer, root, exchange, max_orders, budget,
+                   incumbent_error=None):
+    # Runs in a worker process, so only send back the best attempt rather
+    # than every attempt found
+    def expand(attempt):
+        return balancer.expand(attempt, exchange)
+
+    attempts = balancer.searcher(root, expand, max_orders, budget,
+                                 incumbent_error)
+    return balancer.best_attempt(attempts), budget
+
+
+class Budget():
+    """ How long a search may run for, as a wall-clock deadline and/or a
+    number of nodes to expand. The search asks before expanding each node,
+    and once the budget has run out it stops with what it has so far. """
+
+    def __init__(self, deadline_ms=None, max_nodes=None):
+        self.deadline = None
+        if deadline_ms is not None:
+            self.deadline = time.monotonic() + deadline_ms / 1000.0
+        self.max_nodes = max_nodes
+        self.nodes = 0
+        self.exhausted = False
+
+    def split(self, ways):
+        # Share what is left of the node budget between subtrees, the
+        # deadline stays the same for all of them
+        budget = Budget(max_nodes=self.max_nodes)
+        budget.deadline = self.deadline
+        if self.max_nodes is not None:
+            budget.max_nodes = max(self.max_nodes - self.nodes, 0) // ways
+        return budget
+
+    def spend(self):
+        if self.max_nodes is not None and self.nodes >= self.max_nodes:
+            self.exhausted = True
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            self.exhausted = True
+        if self.exhausted:
+            return False
+        self.nodes += 1
+        return True
+
+
+class SearchSpace():
+    """ The parts of the initial portfolio that don't change during a
+    search. Attempts share one of these and only carry their own balances,
+    as a tuple in the same order as the currencies here.
+
+    Given the exchange and its rates, this also holds the routing table
+    the search trades with, so the search itself only has to index into
+    lists rather than format pairs and look them up. """
+
+    def __init__(self, portfolio, exchange=None, rates=None, mode='mid'):
         self.portfolio = portfolio
-        self.orders = orders or []
+        # Currencies with no target that aren't held can't be traded into
+        # or out of, so they're left out of the search altogether. They
+        # still count towards the RMS error, with no error of their own.
+        # The rest are sorted so that the search goes the same way however
+        # the targets happen to be ordered.
+        self.currencies = sorted(cur for cur in portfolio.currencies
+                                 if portfolio.targets[cur] or
+                                 portfolio.balances[cur])
+        self.num_currencies = len(portfolio.targets)
+        self.index = {cur: i for i, cur in enumerate(self.currencies)}
+        self.targets = [portfolio.targets[cur] for cur in self.currencies]
+
+        # Rate to convert each currency into the quote currency, which
+        # may go through other currencies to get there
+        self.quote_rates = [portfolio.quote_rate(cur)
+                            for cur in self.currencies]
+
+        self.balances = tuple(portfolio.balances[cur]
+                              for cur in self.currencies)
+        self.initial_error = self.rms_error(self.balances)
+        self.target_fractions = [target / 100.0 for target in self.targets]
+        self.error_sums = ErrorSums.from_values(
+            self.target_fractions, self.balances_quote(self.balances),
+            self.num_currencies)
+
+        # The same as arrays, for scoring a whole batch of candidate
+        # trades at once
+        self.quote_vector = np.array(self.quote_rates, dtype=float)
+        self.target_vector = np.array(self.targets, dtype=float) / 100.0
+
+        self.mode = mode
+        self.pairs = []
+        self.routes = []
+        self.trade_rates = []
+        if exchange is not None:
+            self.build_routes(exchange, rates, mode)
+
+    def build_routes(self, exchange, rates, mode):
+        quote_currency = self.portfolio.quote_currency
+        self.fee = exchange.fee
+
+        # Rate to work out how much of each currency to buy/sell
+        conversions = quote_conversions(rates, quote_currency)
+        for cur in self.currencies:
+            try:
+                self.trade_rates.append(conversions[cur])
+            except KeyError:
+                raise ValueError("Invalid pair: {}/{}"
+                                 .format(cur, quote_currency))
+
+        # routes[p_idx][n_idx] is how to buy currency p_idx with currency
+        # n_idx: (pair index, direction, min order cost, trade rate). The
+        # pairs are indexed by the currencies they join in one go over the
+        # rates, rather than trying every combination of currencies.
+        directions = {}
+        for pair in rates:
+            base, quote = pair.split('/')
+            if base == quote or base not in self.index or \
+               quote not in self.index:
+                continue
+            base_idx, quote_idx = self.index[base], self.index[quote]
+            # Buy the base with the quote on the pair itself, or buy the
+            # quote by selling the base. Selling wins if both pairs can be
+            # traded.
+            directions.setdefault((base_idx, quote_idx), {})['BUY'] = pair
+            directions.setdefault((quote_idx, base_idx), {})['SELL'] = pair
+
+        limits = exchange.limits
+        num = len(self.currencies)
+        self.routes = [[None] * num for _ in range(num)]
+        pair_indices = {}
+        for p_idx, n_idx in sorted(directions):
+            route = trade_route(directions[p_idx, n_idx], limits)
+            # can't place orders on a pair with no limits
+            if route is None:
+                continue
+            trade_direction, trade_pair = route
+
+            # We got a direction, so we know we can either
+            # buy or sell this pair
+            if mode == 'passive':
+                if trade_direction == 'BUY':
+                    trade_rate = rates[trade_pair]['low']
+                if trade_direction == 'SELL':
+                    trade_rate = rates[trade_pair]['high']
+            else:
+                trade_rate = rates[trade_pair]['mid']
+
+            if trade_pair not in pair_indices:
+                pair_indices[trade_pair] = len(self.pairs)
+                self.pairs.append(trade_pair)
+            self.routes[p_idx][n_idx] = (pair_indices[trade_pair],
+                                         trade_direction,
+                                         limits[trade_pair]['cost']['min'],
+                                         trade_rate)
+
+        # Every route flattened into arrays, in the order the search tries
+        # them: by currency to buy, then by currency to sell
+        routes = [(p_idx, n_idx, route)
+                  for p_idx, row in enumerate(self.routes)
+                  for n_idx, route in enumerate(row) if route]
+        self.route_list = [route for _, _, route in routes]
+        self.route_buys = np.array([x[0] for x in routes], dtype=int)
+        self.route_sells = np.array([x[1] for x in routes], dtype=int)
+        self.route_pairs = np.array([x[2][0] for x in routes], dtype=int)
+        self.route_min_costs = np.array([x[2][2] for x in routes],
+                                        dtype=float)
+        self.trade_vector = np.array(self.trade_rates, dtype=float)
+
+    def balances_quote(self, balances):
+        return [amount * rate
+                for amount, rate in zip(balances, self.quote_rates)]
+
+    def differences_quote(self, balances):
+        _balances_quote = self.balances_quote(balances)
+        _total = sum(_balances_quote)
+
+        return [_total * (target / 100.0) - amount
+                for target, amount in zip(self.targets, _balances_quote)]
+
+    def errors_pct(self, balances):
+        _balances_quote = self.balances_quote(balances)
+        _total = sum(_balances_quote)
+
+        if not _total:
+            return []
+
+        return [((_total * (target / 100.0) - amount) / _total) * 100.0
+                for target, amount in zip(self.targets, _balances_quote)]
+
+    def rms_error(self, balances):
+        pcts = self.errors_pct(balances)
+        if not pcts:
+            return 0.0
+        return math.sqrt(sum([x**2 for x in pcts]) / self.num_currencies)
+
+    def make_portfolio(self, balances):
+        portfolio = self.portfolio.copy()
+        # Back in the portfolio's own order, with any currencies left out
+        # of the search put back as they were
+        balances = dict(zip(self.currencies, balances))
+        portfolio.balances = {cur: balances[cur] if cur in balances
+                              else self.portfolio.balances[cur]
+                              for cur in self.portfolio.currencies}
+        return portfolio
+
+
+class Attempt():
+    # The search makes a lot of these, so no per-instance __dict__
+    __slots__ = ('space', 'balances', 'orders', 'total_fee', 'depth',
+                 'pairs_processed', 'error_sums', '_rms_error',
+                 '_orders_key', '_balances_key')
+
+    def __init__(self, space, balances=None, orders=None, total_fee=0.0,
+                 depth=0, pairs_processed=None, error_sums=None):
+        self.space = space
+        self.balances = balances or space.balances
+        self.orders = tuple(orders or ())
         self.total_fee = total_fee
         self.depth = depth
-        self.pairs_processed = pairs_processed or set()
+        self.pairs_processed = pairs_processed or frozenset()
+        self.error_sums = error_sums
+        if balances is None:
+            self.error_sums = space.error_sums
+        self._rms_error = None
+        self._orders_key = None if orders else ()
+        self._balances_key = None
+
+    @property
+    def portfolio(self):
+        return self.space.make_portfolio(self.balances)
+
+    def child(self, balances, order, fee, pair_idx, error_sums=None):
+        # The orders are kept sorted, so put the new one in its place
+        # rather than sorting them all again, and the same for its part
+        # of the state key. A tuple rather than a list, as the orders never
+        # change once the attempt is made.
+        idx = bisect.bisect_right(self.orders, order)
+        attempt = Attempt(self.space,
+                          balances,
+                          self.orders[:idx] + (order,) + self.orders[idx:],
+                          self.total_fee + fee,
+                          self.depth + 1,
+                          self.pairs_processed | {pair_idx},
+                          error_sums)
+        if self._orders_key is not None:
+            attempt._orders_key = self._orders_key[:idx] + \
+                (self.order_key(order),) + self._orders_key[idx:]
+        return attempt
+
+    @staticmethod
+    def order_key(order):
+        return (order.pair, order.direction, quantize(order.amount),
+                order.price)
+
+    @property
+    def rms_error(self):
+        if self._rms_error is None and self.error_sums is not None:
+            self._rms_error = self.error_sums.rms_error
+        if self._rms_error is None:
+            self._rms_error = self.space.rms_error(self.balances)
+        return self._rms_error
+
+    @property
+    def priority(self):
+        return (round(self.rms_error, 9), round(self.total_fee, 9))
+
+    @property
+    def state_key(self):
+        # The same set of orders can be reached through every permutation
+        # of trades, so key the search state on the (sorted) orders and
+        # the balances they lead to
+        if self._orders_key is None:
+            self._orders_key = tuple(self.order_key(o) for o in self.orders)
+        if self._balances_key is None:
+            self._balances_key = tuple(quantize(x) for x in self.balances)
+        return (self._orders_key, self._balances_key)
 
 
 class SimpleBalancer():
 
+    searches = ['dfs', 'best-first', 'beam']
+
+    def __init__(self, search='dfs', workers=None, beam_width=100,
+                 batch=None, top_k=None):
+        if search not in self.searches:
+            raise ValueError("{} is not a valid search".format(search))
+        if beam_width < 1:
+            raise ValueError("beam_width must be at least 1")
+        if top_k is not None and top_k < 1:
+            raise ValueError("top_k must be at least 1")
+        self.search = search
+        self.workers = workers
+        self.beam_width = beam_width
+        # None picks by the number of currencies, True/False forces it
+        self.batch = batch
+        # Only try this many pairings of currencies from each attempt, the
+        # ones that can move the most value. None tries them all.
+        self.top_k = top_k
+
+    @property
+    def searcher(self):
+        if self.search == 'best-first':
+            return self.best_first
+        if self.search == 'beam':
+            return self.beam
+        return self.depth_first
+
     def permute_differences(self, differences_quote):
         differences = differences_quote.items()
         positives = [x for x in differences if x[1] > 0.01]
         negatives = [x for x in differences if x[1] < -0.01]
         res = product(positives, negatives)
+        if self.top_k is not None:
+            res = list(res)
+            ranked = sorted(range(len(res)),
+                            key=lambda i: -self.pairing_score(
+                                res[i][0][1], res[i][1][1]))
+            res = [res[i] for i in sorted(ranked[:self.top_k])]
         return res
 
-    def balance(self, initial_portfolio, exchange, max_orders=5, mode='mid'):
-        rates = exchange.rates
-        quote_currency = initial_portfolio.quote_currency
+    @staticmethod
+    def pairing_score(positive, negative):
+        # How much value a trade between a currency that's short by
+        # positive and one that's over by -negative can move to where it
+        # should be. The fee is the same for every pair, so it doesn't
+        # change the ranking.
+        return min(positive, -negative)
+
+    def rms_lower_bound(self, attempt, trades_left):
+        # Each trade only moves value between two currencies and leaves
+        # the total valuation unchanged, so at best the remaining trades
+        # zero the errors of the 2 * trades_left worst currencies
+        pcts = attempt.space.errors_pct(attempt.balances)
+        pcts = sorted(x**2 for x in pcts)
+        num = len(pcts)
+        if not num:
+            return 0.0
+        remaining = pcts[:max(num - 2 * trades_left, 0)]
+        return math.sqrt(sum(remaining) / attempt.space.num_currencies)
+
+    def expand_each(self, attempt, exchange):
+        # One candidate trade at a time, which has less overhead than
+        # the batch for a handful of currencies
+        space = attempt.space
+        routes = space.routes
+        trade_rates = space.trade_rates
+        quote_rates = space.quote_rates
+        targets = space.target_fractions
+        mid = space.mode == 'mid'
+
+        diffs = space.differences_quote(attempt.balances)
+        positives = [i for i, x in enumerate(diffs) if x > 0.01]
+        negatives = [i for i, x in enumerate(diffs) if x < -0.01]
+
+        pairings = []
+        for p_idx, n_idx in product(positives, negatives):
+            route = routes[p_idx][n_idx]
+            if route and route[0] not in attempt.pairs_processed:
+                pairings.append((p_idx, n_idx, route))
+
+        top_k = self.top_k
+        if top_k is not None and len(pairings) > top_k:
+            ranked = sorted(range(len(pairings)),
+                            key=lambda i: -self.pairing_score(
+                                diffs[pairings[i][0]],
+                                diffs[pairings[i][1]]))
+            pairings = [pairings[i] for i in sorted(ranked[:top_k])]
+
+        # Work out every candidate order first, so the exchange can check
+        # them all in one batch
+        candidates = []
+        for p_idx, n_idx, route in pairings:
+            pair_idx, trade_direction, min_trade_amount_quote, trade_rate = \
+                route
+            trade_pair = space.pairs[pair_idx]
+
+            amounts = [diffs[p_idx], -diffs[n_idx]]
+            if mid:
+                amounts.extend([min_trade_amount_quote,
+                                min_trade_amount_quote * 1.5])
+
+            for trade_amount_quote in amounts:
+
+                # Work out how much of the currency to buy/sell
+                to_sell_amount_cur = trade_amount_quote / trade_rates[n_idx]
+                to_buy_amount_cur = trade_amount_quote / trade_rates[p_idx]
+
+                if trade_direction == "BUY":
+                    trade_amount = to_buy_amount_cur
+
+                if trade_direction == "SELL":
+                    trade_amount = to_sell_amount_cur
+
+                order = Order(trade_pair, trade_direction,
+                              trade_amount, trade_rate)
+                candidates.append((p_idx, n_idx, pair_idx, trade_amount_quote,
+                                   to_buy_amount_cur, to_sell_amount_cur,
+                                   order))
+
+        orders = exchange.preprocess_orders([x[-1] for x in candidates])
+
+        dead_route = None
+        for candidate, order in zip(candidates, orders):
+            p_idx, n_idx, pair_idx, trade_amount_quote, \
+                to_buy_amount_cur, to_sell_amount_cur, _ = candidate
+            if not order or (p_idx, n_idx) == dead_route:
+                continue
 
-        # Add in the identify rate just so we don't have to special
-        # case it later
-        rates["{}/{}".format(quote_currency, quote_currency)] = {'mid': 1.0,
-                                                                 'high': 1.0,
-                                                                 'low': 1.0, }
+            # Adjust the amounts of each currency we hold
+            balances = list(attempt.balances)
+            balances[p_idx] += to_buy_amount_cur
+            balances[n_idx] -= to_sell_amount_cur
+
+            if balances[n_idx] < 0:
+                # gone negative so not valid result, and neither are the
+                # rest of the amounts for this route
+                dead_route = (p_idx, n_idx)
+                continue
 
-        todo = [Attempt(initial_portfolio)]
+            # Only two balances changed, so update the error from those
+            # rather than going over every currency again
+            error_sums = None
+            if attempt.error_sums is not None:
+                error_sums = attempt.error_sums.trade(
+                    targets[p_idx],
+                    attempt.balances[p_idx] * quote_rates[p_idx],
+                    balances[p_idx] * quote_rates[p_idx],
+                    targets[n_idx],
+                    attempt.balances[n_idx] * quote_rates[n_idx],
+                    balances[n_idx] * quote_rates[n_idx])
+
+            fee = trade_amount_quote * space.fee
+            yield attempt.child(tuple(balances), order, fee, pair_idx,
+                                error_sums)
+
+    def expand_batch(self, attempt, exchange):
+        # Score every candidate trade from this attempt in one go: one row
+        # per (route, amount) holding the balances after that trade. Only
+        # the candidates the exchange accepts get turned into attempts.
+        space = attempt.space
+        balances = np.array(attempt.balances, dtype=float)
+
+        balances_quote = balances * space.quote_vector
+        diffs = balances_quote.sum() * space.target_vector - balances_quote
+
+        buys = space.route_buys
+        sells = space.route_sells
+        open_routes = (diffs[buys] > 0.01) & (diffs[sells] < -0.01)
+        if attempt.pairs_processed:
+            processed = np.zeros(len(space.pairs), dtype=bool)
+            processed[list(attempt.pairs_processed)] = True
+            open_routes &= ~processed[space.route_pairs]
+        open_routes = np.flatnonzero(open_routes)
+        if not len(open_routes):
+            return
+
+        top_k = self.top_k
+        if top_k is not None and len(open_routes) > top_k:
+            scores = np.minimum(diffs[buys[open_routes]],
+                                -diffs[sells[open_routes]])
+            ranked = np.argsort(-scores, kind='stable')[:top_k]
+            open_routes = open_routes[np.sort(ranked)]
+
+        buys = buys[open_routes]
+        sells = sells[open_routes]
+        num_amounts = 4 if space.mode == 'mid' else 2
+        amounts = np.empty((len(open_routes), num_amounts))
+        amounts[:, 0] = diffs[buys]
+        amounts[:, 1] = -diffs[sells]
+        if space.mode == 'mid':
+            amounts[:, 2] = space.route_min_costs[open_routes]
+            amounts[:, 3] = amounts[:, 2] * 1.5
+        amounts = amounts.ravel()
+        buys = np.repeat(buys, num_amounts)
+        sells = np.repeat(sells, num_amounts)
+
+        # Work out how much of each currency to buy/sell, and adjust the
+        # amounts of each currency we hold
+        to_buy = amounts / space.trade_vector[buys]
+        to_sell = amounts / space.trade_vector[sells]
+        rows = np.arange(len(amounts))
+        candidates = np.repeat(balances[None, :], len(amounts), axis=0)
+        candidates[rows, buys] += to_buy
+        candidates[rows, sells] -= to_sell
+        # gone negative so not valid result
+        negative = candidates[rows, sells] < 0
+
+        candidates_quote = candidates * space.quote_vector
+        totals = candidates_quote.sum(axis=1, keepdims=True)
+        # Nothing held at all counts as no error
+        empty = totals[:, 0] == 0
+        totals[empty] = 1.0
+        pcts = (totals * space.target_vector - candidates_quote) \
+            / totals * 100.0
+        errors = np.sqrt((pcts ** 2).sum(axis=1) / space.num_currencies)
+        errors[empty] = 0.0
+        balances_keys = quantize_rows(candidates)
+
+        # Back to plain floats for building the orders and attempts,
+        # indexing into arrays one element at a time is slow
+        to_buy = to_buy.tolist()
+        to_sell = to_sell.tolist()
+        negative = negative.tolist()
+        errors = errors.tolist()
+        fees = (amounts * space.fee).tolist()
+
+        orders = []
+        for i, route_idx in enumerate(open_routes.tolist()):
+            pair_idx, trade_direction, _, trade_rate = \
+                space.route_list[route_idx]
+            trade_pair = space.pairs[pair_idx]
+
+            for j in range(i * num_amounts, (i + 1) * num_amounts):
+                if trade_direction == "BUY":
+                    trade_amount = to_buy[j]
+                else:
+                    trade_amount = to_sell[j]
+
+                orders.append(Order(trade_pair, trade_direction,
+                                    trade_amount, trade_rate))
+        orders = exchange.preprocess_orders(orders)
+
+        for i, route_idx in enumerate(open_routes.tolist()):
+            pair_idx = space.route_list[route_idx][0]
+
+            for j in range(i * num_amounts, (i + 1) * num_amounts):
+                order = orders[j]
+                if not order:
+                    continue
+
+                if negative[j]:
+                    break
+
+                new_attempt = attempt.child(tuple(candidates[j].tolist()),
+                                            order, fees[j], pair_idx)
+                new_attempt._rms_error = errors[j]
+                new_attempt._balances_key = balances_keys[j]
+                yield new_attempt
+
+    def expand(self, attempt, exchange):
+        batch = self.batch
+        if batch is None:
+            batch = len(attempt.space.currencies) >= BATCH_MIN_CURRENCIES
+        if batch:
+            return self.expand_batch(attempt, exchange)
+        return self.expand_each(attempt, exchange)
+
+    def bounded(self, attempt, max_orders, best_error):
+        # Whether nothing under this attempt can get below best_error
+        if best_error is None:
+            return False
+        bound = self.rms_lower_bound(attempt, max_orders - attempt.depth)
+        return bound > best_error + BOUND_TOLERANCE
+
+    def depth_first(self, root, expand, max_orders, budget,
+                    incumbent_error=None):
+        initial_error = root.space.initial_error
+        todo = [root]
         attempts = []
+        # Transposition table of states already queued, so that duplicate
+        # subtrees are only expanded once
+        seen = set()
 
         while todo:
             attempt = todo.pop()
-            diffs = self.permute_differences(
-                attempt.portfolio.differences_quote)
 
-            if not diffs or attempt.depth >= max_orders:
+            if attempt.depth >= max_orders:
+                continue
+
+            # Given a plan to beat already, skip subtrees that can't
+            if self.bounded(attempt, max_orders, incumbent_error):
                 continue
 
-            for pos, neg in diffs:
-                p_cur, p_amount = pos
-                n_cur, n_amount = neg
+            if not budget.spend():
+                break
+            for new_attempt in expand(attempt):
+                state_key = new_attempt.state_key
+                if state_key in seen:
+                    continue
+                seen.add(state_key)
 
-                trade_direction = None
+                todo.append(new_attempt)
 
-                # try and see if we have the pair we need
-                # and if so, buy it
-                pair = "{}/{}".format(p_cur, n_cur)
-                if pair in rates:
-                    trade_direction = "BUY"
-                    trade_pair = pair
+                if new_attempt.rms_error < initial_error:
+                    attempts.append(new_attempt)
 
-                # if previous failed then reverse paid and try
-                # sell instead
-                pair = "{}/{}".format(n_cur, p_cur)
-                if pair in rates:
-                    trade_direction = "SELL"
-                    trade_pair = pair
+        return attempts
 
-                if not trade_direction:
-                    continue
+    def best_first(self, root, expand, max_orders, budget,
+                   incumbent_error=None):
+        # Expand the most promising attempts first, and cut off any
+        # subtree whose lower bound can't reach the best error found so
+        # far. Ties are kept so the result matches the exhaustive search.
+        initial_error = root.space.initial_error
+        todo = [(root.priority, 0, root)]
+        counter = 1
+        attempts = []
+        seen = set()
+        best_error = initial_error
+        if incumbent_error is not None:
+            best_error = min(best_error, incumbent_error)
+
+        def bounded(attempt):
+            return self.bounded(attempt, max_orders, best_error)
+
+        while todo:
+            _, _, attempt = heapq.heappop(todo)
+
+            if attempt.depth >= max_orders or bounded(attempt):
+                continue
 
-                if trade_pair in attempt.pairs_processed:
+            if not budget.spend():
+                break
+            for new_attempt in expand(attempt):
+                state_key = new_attempt.state_key
+                if state_key in seen:
                     continue
+                seen.add(state_key)
+
+                if new_attempt.rms_error < initial_error:
+                    attempts.append(new_attempt)
+                    best_error = min(best_error, new_attempt.rms_error)
+
+                if new_attempt.depth < max_orders \
+                   and not bounded(new_attempt):
+                    heapq.heappush(todo, (new_attempt.priority, counter,
+                                          new_attempt))
+                    counter += 1
+
+        return attempts
+
+    def beam(self, root, expand, max_orders, budget, incumbent_error=None):
+        # Only carry the best beam_width attempts from one depth on to the
+        # next, so the work and memory per run are bounded at the cost of
+        # maybe missing a plan that starts out badly
+        initial_error = root.space.initial_error
+        layer = [root]
+        attempts = []
+        seen = set()
+
+        for _ in range(max_orders):
+            next_layer = []
+            for attempt in layer:
+                if not budget.spend():
+                    return attempts
+                for new_attempt in expand(attempt):
+                    state_key = new_attempt.state_key
+                    if state_key in seen:
+                        continue
+                    seen.add(state_key)
 
-                # Calculate the min order for this pair
-                min_trade_amount_quote = \
-                    exchange.limits[trade_pair]['cost']['min']
+                    if new_attempt.rms_error < initial_error:
+                        attempts.append(new_attempt)
 
-                # Work out the pair to get to the quote currency
-                to_sell_pair_quote = "{}/{}".format(n_cur, quote_currency)
-                to_buy_pair_quote = "{}/{}".format(p_cur, quote_currency)
+                    if not self.bounded(new_attempt, max_orders,
+                                        incumbent_error):
+                        next_layer.append(new_attempt)
 
-                amounts = [p_amount, -n_amount,]
-                if mode == 'mid':
-                    amounts.extend([min_trade_amount_quote, min_trade_amount_quote * 1.5])
+            layer = heapq.nsmallest(self.beam_width, next_layer,
+                                    key=lambda x: (x.priority, x.orders))
+            if not layer:
+                break
 
-                for trade_amount_quote in amounts:
+        return attempts
 
-                    # Work out how much of the currency to buy/sell
-                    to_sell_amount_cur = \
-                        trade_amount_quote / rates[to_sell_pair_quote]['mid']
-                    to_buy_amount_cur = \
-                        trade_amount_quote / rates[to_buy_pair_quote]['mid']
+    def parallel(self, root, exchange, max_orders, budget,
+                 incumbent_error=None):
+        # Every attempt at the first level starts an independent subtree,
+        # so expand those here and search each subtree in its own process
+        attempts = []
+        subtrees = []
+        seen = set()
+        if not budget.spend():
+            return attempts
+        for attempt in self.expand(root, exchange):
+            state_key = attempt.state_key
+            if state_key in seen:
+                continue
+            seen.add(state_key)
+
+            if attempt.rms_error < root.space.initial_error:
+                attempts.append(attempt)
+            if attempt.depth < max_orders and \
+               not self.bounded(attempt, max_orders, incumbent_error):
+                subtrees.append(attempt)
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(search_subtree, self, attempt,
+                                       exchange, max_orders,
+                                       budget.split(len(subtrees)),
+                                       incumbent_error)
+                       for attempt in subtrees]
+            results = [future.result() for future in futures]
+
+        # Subtrees can reach the same state by different paths, giving
+        # attempts that only differ by floating point noise. The serial
+        # search explores the last subtree first and keeps the first attempt
+        # it reaches, so do the same here to get exactly the same plan.
+        for best_attempt, subtree_budget in reversed(results):
+            budget.nodes += subtree_budget.nodes
+            budget.exhausted |= subtree_budget.exhausted
+            if best_attempt:
+                state_key = best_attempt.state_key
+                if state_key in seen:
+                    continue
+                seen.add(state_key)
+                attempts.append(best_attempt)
+
+        return attempts
+
+    def warm_start(self, root, exchange, prior_orders):
+        # Replay the orders of a previous plan from the root at today's
+        # rates, dropping any the exchange won't take any more. Usually the
+        # portfolio has only drifted a little, so this makes a good plan to
+        # beat straight away.
+        space = root.space
+        candidates = []
+        for prior in prior_orders:
+            base, quote = prior.pair.split('/')
+            if base not in space.index or quote not in space.index:
+                continue
+            if prior.direction == "BUY":
+                p_idx, n_idx = space.index[base], space.index[quote]
+            else:
+                p_idx, n_idx = space.index[quote], space.index[base]
 
-                    if trade_direction == "BUY":
-                        trade_amount = to_buy_amount_cur
+            route = space.routes[p_idx][n_idx]
+            if not route:
+                continue
+            pair_idx, trade_direction, _, trade_rate = route
+            if space.pairs[pair_idx] != prior.pair or \
+               trade_direction != prior.direction:
+                continue
 
-                    if trade_direction == "SELL":
-                        trade_amount = to_sell_amount_cur
+            order = Order(prior.pair, prior.direction, prior.amount,
+                          trade_rate)
+            candidates.append((p_idx, n_idx, pair_idx, space.index[base],
+                               order))
 
-                    # We got a direction, so we know we can either
-                    # buy or sell this pair
-                    if mode == 'passive':
-                        if trade_direction == 'BUY':
-                            trade_rate = rates[trade_pair]['low']
-                        if trade_direction == 'SELL':
-                            trade_rate = rates[trade_pair]['high']                         
-                    else:
-                        trade_rate = rates[trade_pair]['mid']
+        orders = exchange.preprocess_orders([x[-1] for x in candidates])
 
-                    order = Order(trade_pair, trade_direction,
-                                  trade_amount, trade_rate)
+        attempt = root
+        for (p_idx, n_idx, pair_idx, base_idx, _), order in zip(candidates,
+                                                                 orders):
+            if not order or pair_idx in attempt.pairs_processed:
+                continue
 
-                    order = exchange.preprocess_order(order)
-                    if not order:
-                        continue
+            # The amount is of the base currency, work out how much that
+            # is worth to adjust the amounts of each currency we hold
+            trade_amount_quote = order.amount * space.trade_rates[base_idx]
+            balances = list(attempt.balances)
+            balances[p_idx] += trade_amount_quote / space.trade_rates[p_idx]
+            balances[n_idx] -= trade_amount_quote / space.trade_rates[n_idx]
+            if balances[n_idx] < 0:
+                continue
 
-                    # Adjust the amounts of each currency we hold
-                    new_portfolio = attempt.portfolio.copy()
-
-                    new_portfolio.balances[p_cur] \
-                        += to_buy_amount_cur
-                    new_portfolio.balances[n_cur] \
-                        -= to_sell_amount_cur
-
-                    if new_portfolio.balances[n_cur] < 0:
-                        # gone negative so not valid result
-                        break
-
-                    fee = trade_amount_quote * exchange.fee
-                    new_attempt = Attempt(new_portfolio,
-                                          sorted(attempt.orders + [order]),
-                                          attempt.total_fee + fee,
-                                          attempt.depth + 1,
-                                          attempt.pairs_processed | set(
-                                              [trade_pair]
-                                          ))
-                    todo.append(new_attempt)
-
-                    if new_attempt.portfolio.balance_rms_error < \
-                       initial_portfolio.balance_rms_error:
-                        attempts.append(new_attempt)
+            attempt = attempt.child(tuple(balances), order,
+                                    trade_amount_quote * space.fee,
+                                    pair_idx)
+
+        if attempt is root or attempt.rms_error >= space.initial_error:
+            return None
+        return attempt
 
+    def best_attempt(self, attempts):
         if not attempts:
-            return {'orders': [],
-                    'total_fee': 0.0,
-                    'initial_portfolio': initial_portfolio,
-                    'proposed_portfolio': None}
+            return None
 
-        sort_key = lambda x: (x.portfolio.balance_rms_error,
-                              x.total_fee,
+        # Round the error and fee so attempts that only differ by floating
+        # point noise are decided by the next key rather than by the noise
+        sort_key = lambda x: (round(x.rms_error, 9),
+                              round(x.total_fee, 9),
                               len(x.orders),
                               x.orders)
         decorated_attempts = [(sort_key(x), x) for x in attempts]
         decorated_attempts.sort(key=lambda x: x[0])
-        best_attempt = decorated_attempts[0][1]
+        return decorated_attempts[0][1]
+
+    def balance(self, initial_portfolio, exchange, max_orders=5, mode='mid',
+                deadline_ms=None, max_nodes=None, prior_orders=None,
+                rates=None):
+        # A snapshot of the rates can be passed in to share it between
+        # several balances, rather than each one asking the exchange
+        if rates is None:
+            rates = exchange.rates
+        quote_currency = initial_portfolio.quote_currency
+
+        # Add in the identify rate just so we don't have to special
+        # case it later
+        rates["{}/{}".format(quote_currency, quote_currency)] = {'mid': 1.0,
+                                                                 'high': 1.0,
+                                                                 'low': 1.0, }
+
+        def expand(attempt):
+            return self.expand(attempt, exchange)
+
+        # If the budget runs out the search stops early and the best
+        # attempt found so far is used, flagged as a partial result
+        budget = Budget(deadline_ms, max_nodes)
+
+        space = SearchSpace(initial_portfolio, exchange, rates, mode)
+        root = Attempt(space)
+
+        # Anything that can't beat the previous plan can be pruned
+        incumbent = None
+        incumbent_error = None
+        if prior_orders and max_orders > 0:
+            incumbent = self.warm_start(root, exchange,
+                                        prior_orders[:max_orders])
+        if incumbent:
+            incumbent_error = incumbent.rms_error
+
+        # Only the depth-first search is split between workers. A beam
+        # searched per subtree would keep beam_width attempts in each of
+        # them rather than in all, and best-first would go through the
+        # subtrees in another order, so neither gives the same plan.
+        if self.workers and self.workers > 1 and max_orders > 1 and \
+           self.search == 'dfs':
+            attempts = self.parallel(root, exchange, max_orders, budget,
+                                     incumbent_error)
+        else:
+            attempts = self.searcher(root, expand, max_orders, budget,
+                                     incumbent_error)
+        if incumbent:
+            attempts.append(incumbent)
+
+        best_attempt = self.best_attempt(attempts)
+        if not best_attempt:
+            return {'orders': [],
+                    'total_fee': 0.0,
+                    'initial_portfolio': initial_portfolio,
+                    'proposed_portfolio': None,
+                    'nodes_expanded': budget.nodes,
+                    'partial': budget.exhausted}
 
         return {'orders': sorted(best_attempt.orders),
                 'total_fee': best_attempt.total_fee,
                 'initial_portfolio': initial_portfolio,
-                'proposed_portfolio': best_attempt.portfolio}
+                'proposed_portfolio': best_attempt.portfolio,
+                'nodes_expanded': budget.nodes,
+                'partial': budget.exhausted}
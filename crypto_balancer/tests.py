@@ -1,12 +1,33 @@
+import json
+import math
+import os
+import random
+import tempfile
 import unittest
+import numpy as np
 from pstats import Stats
 import cProfile
 
-from crypto_balancer.simple_balancer import SimpleBalancer
-from crypto_balancer.portfolio import Portfolio
-from crypto_balancer.dummy_exchange import DummyExchange
+from crypto_balancer.simple_balancer import SimpleBalancer, Attempt, \
+    SearchSpace, quantize, quantize_rows
+from crypto_balancer.linear_balancer import LinearBalancer
+from crypto_balancer.portfolio import Portfolio, ArrayPortfolio, \
+    ErrorSums, PortfolioSet, quote_conversions
+from crypto_balancer.dummy_exchange import DummyExchange, BATCH_MIN_ORDERS
 from crypto_balancer.executor import Executor
+from crypto_balancer.benchmark import random_case, run
 from crypto_balancer.order import Order
+from crypto_balancer.backtest_engine import Backtest, HistoryExchange, \
+    PriceHistory, grid, read_candles, sweep
+from crypto_balancer.backtest_exchange import BacktestExchange, \
+    StreamingBacktestExchange
+from crypto_balancer.plan_cache import CachingBalancer, PlanCache, plan_key
+
+try:
+    import ccxt
+    from crypto_balancer.ccxt_exchange import CCXTExchange, to_precision
+except ImportError:  # pragma: no cover
+    ccxt = None
 
 import sys
 sys.path.append('..')      # XXX Probably needed to import your code
@@ -63,6 +84,8 @@ class test_Order(unittest.TestCase):
 
 
 class test_Portfolio(unittest.TestCase):
+    portfolio_class = Portfolio
+
     targets = {'XRP': 45,
                'XLM': 45,
                'USDT': 10, }
@@ -81,7 +104,7 @@ class test_Portfolio(unittest.TestCase):
 
     def test_create_portfolio_defaults(self):
         exchange = DummyExchange(self.targets.keys(), self.targets)
-        portfolio = Portfolio.make_portfolio(self.targets, exchange)
+        portfolio = self.portfolio_class.make_portfolio(self.targets, exchange)
 
         self.assertEqual(portfolio.threshold, 1.0)
         self.assertEqual(portfolio.quote_currency, 'USDT')
@@ -90,8 +113,8 @@ class test_Portfolio(unittest.TestCase):
 
     def test_create_portfolio_custom(self):
         exchange = DummyExchange(self.targets.keys(), self.targets)
-        portfolio = Portfolio.make_portfolio(self.targets,
-                                             exchange, 2.0, 'BTC')
+        portfolio = self.portfolio_class.make_portfolio(self.targets,
+                                                        exchange, 2.0, 'BTC')
 
         self.assertEqual(portfolio.threshold, 2.0)
         self.assertEqual(portfolio.quote_currency, 'BTC')
@@ -100,51 +123,51 @@ class test_Portfolio(unittest.TestCase):
 
     def test_create_portfolio_balances_quote(self):
         exchange = DummyExchange(self.targets.keys(), self.balances)
-        portfolio = Portfolio.make_portfolio(self.targets, exchange)
+        portfolio = self.portfolio_class.make_portfolio(self.targets, exchange)
 
         self.assertEqual(portfolio.balances_quote, self.balances)
 
     def test_create_portfolio_valuation_quote(self):
         exchange = DummyExchange(self.targets.keys(), self.balances)
-        portfolio = Portfolio.make_portfolio(self.targets, exchange)
+        portfolio = self.portfolio_class.make_portfolio(self.targets, exchange)
 
         self.assertEqual(portfolio.valuation_quote, 1000)
 
     def test_create_portfolio_balances_pct(self):
         exchange = DummyExchange(self.targets.keys(), self.balances)
-        portfolio = Portfolio.make_portfolio(self.targets, exchange)
+        portfolio = self.portfolio_class.make_portfolio(self.targets, exchange)
 
         self.assertEqual(portfolio.balances_pct, self.targets)
         self.assertNotEqual(portfolio.balances_pct, self.targets2)
 
     def test_create_portfolio_balances_pct_zero(self):
         exchange = DummyExchange(self.targets.keys(), self.zero_balances)
-        portfolio = Portfolio.make_portfolio(self.targets, exchange)
+        portfolio = self.portfolio_class.make_portfolio(self.targets, exchange)
 
         self.assertEqual(portfolio.balances_pct, self.zero_balances)
         self.assertNotEqual(portfolio.balances_pct, self.targets)
 
     def test_create_portfolio_metric1(self):
         exchange = DummyExchange(self.targets.keys(), self.balances)
-        portfolio = Portfolio.make_portfolio(self.targets, exchange)
+        portfolio = self.portfolio_class.make_portfolio(self.targets, exchange)
 
         self.assertEqual(portfolio.balance_rms_error, 0)
 
     def test_create_portfolio_metric2(self):
         exchange = DummyExchange(self.targets.keys(), self.balances)
-        portfolio = Portfolio.make_portfolio(self.targets2, exchange)
+        portfolio = self.portfolio_class.make_portfolio(self.targets2, exchange)
 
         self.assertAlmostEqual(portfolio.balance_rms_error, 7.071067, 5)
 
     def test_create_portfolio_metric_zero(self):
         exchange = DummyExchange(self.targets.keys(), self.zero_balances)
-        portfolio = Portfolio.make_portfolio(self.targets, exchange)
+        portfolio = self.portfolio_class.make_portfolio(self.targets, exchange)
 
         self.assertEqual(portfolio.balance_rms_error, 0)
 
     def test_create_portfolio_differences_quote1(self):
         exchange = DummyExchange(self.targets.keys(), self.balances)
-        portfolio = Portfolio.make_portfolio(self.targets, exchange)
+        portfolio = self.portfolio_class.make_portfolio(self.targets, exchange)
 
         expected = {'XRP': 0,
                     'XLM': 0,
@@ -154,7 +177,7 @@ class test_Portfolio(unittest.TestCase):
 
     def test_create_portfolio_differences_quote2(self):
         exchange = DummyExchange(self.targets.keys(), self.balances)
-        portfolio = Portfolio.make_portfolio(self.targets2, exchange)
+        portfolio = self.portfolio_class.make_portfolio(self.targets2, exchange)
 
         expected = {'XRP': -50,
                     'XLM': -50,
@@ -164,20 +187,21 @@ class test_Portfolio(unittest.TestCase):
 
     def test_create_portfolio_needs_balancing1(self):
         exchange = DummyExchange(self.targets.keys(), self.balances)
-        portfolio = Portfolio.make_portfolio(self.targets, exchange)
+        portfolio = self.portfolio_class.make_portfolio(self.targets, exchange)
 
         self.assertFalse(portfolio.needs_balancing)
 
     def test_create_portfolio_needs_balancing2(self):
         exchange = DummyExchange(self.targets.keys(), self.balances)
-        portfolio = Portfolio.make_portfolio(self.targets2, exchange)
+        portfolio = self.portfolio_class.make_portfolio(self.targets2, exchange)
 
         self.assertTrue(portfolio.needs_balancing)
 
     def test_create_portfolio_needs_balancing3(self):
         exchange = DummyExchange(self.targets.keys(), self.balances)
-        portfolio = Portfolio.make_portfolio(self.targets2,
-                                             exchange, threshold=20)
+        portfolio = self.portfolio_class.make_portfolio(self.targets2,
+                                                        exchange,
+                                                        threshold=20)
 
         self.assertFalse(portfolio.needs_balancing)
 
@@ -193,7 +217,7 @@ class test_Portfolio(unittest.TestCase):
                  'XLM/USDT': 0.4, }
 
         exchange = DummyExchange(targets.keys(), current, rates)
-        portfolio = Portfolio.make_portfolio(targets, exchange)
+        portfolio = self.portfolio_class.make_portfolio(targets, exchange)
 
         expected = {'XRP': 40,
                     'XLM': 0,
@@ -214,7 +238,7 @@ class test_Portfolio(unittest.TestCase):
                  'USDT/USDT': 1.0, }
 
         exchange = DummyExchange(targets.keys(), current, rates)
-        portfolio = Portfolio.make_portfolio(targets, exchange)
+        portfolio = self.portfolio_class.make_portfolio(targets, exchange)
 
         expected = {'XRP': 40,
                     'XLM': 0,
@@ -249,7 +273,7 @@ class test_Portfolio(unittest.TestCase):
                  'USDT/USDT': 1.0, }
 
         exchange = DummyExchange(targets.keys(), current, rates)
-        portfolio = Portfolio.make_portfolio(targets, exchange)
+        portfolio = self.portfolio_class.make_portfolio(targets, exchange)
 
         expected = {'XRP': 7,
                     'XLM': 7,
@@ -273,13 +297,480 @@ class test_Portfolio(unittest.TestCase):
         self.assertEqual(targets, final_targets)
 
 
+    def test_apply_trade(self):
+        exchange = DummyExchange(self.targets.keys(), self.balances)
+        portfolio = self.portfolio_class.make_portfolio(self.targets2,
+                                                        exchange)
+        self.assertAlmostEqual(portfolio.balance_rms_error, 7.071067, 5)
+
+        portfolio.apply_trade('USDT', 50, 'XRP', 50)
+        portfolio.apply_trade('USDT', 50, 'XLM', 50)
+        self.assertEqual(portfolio.balances,
+                         {'XRP': 400, 'XLM': 400, 'USDT': 200})
+        self.assertAlmostEqual(portfolio.balance_rms_error, 0)
+        self.assertAlmostEqual(portfolio.balance_max_error, 0)
+        self.assertEqual(exchange.balances['USDT'], 100)
+
+    def test_apply_trades(self):
+        # Lots of small trades, checked against working it all out again
+        targets = {'XRP': 30,
+                   'XLM': 20,
+                   'BTC': 20,
+                   'ETH': 10,
+                   'BNB': 10,
+                   'USDT': 10, }
+        current = {'XRP': 3352,
+                   'XLM': 0,
+                   'BTC': 0.01,
+                   'ETH': 0,
+                   'BNB': 5,
+                   'USDT': 243, }
+        rates = {'XRP/USDT': 0.32076,
+                 'XLM/USDT': 0.09084,
+                 'BTC/USDT': 3968.13,
+                 'ETH/USDT': 147.81,
+                 'BNB/USDT': 10.0, }
+        exchange = DummyExchange(targets.keys(), current, rates)
+        portfolio = self.portfolio_class.make_portfolio(targets, exchange)
+        expected = Portfolio.make_portfolio(targets, exchange)
+
+        currencies = sorted(targets)
+        for i in range(300):
+            buy_cur = currencies[i % len(currencies)]
+            sell_cur = currencies[(i * 7 + 1) % len(currencies)]
+            if buy_cur == sell_cur:
+                continue
+            value = 10.0 + i % 13
+            buy_rate = rates.get(buy_cur + '/USDT', 1.0)
+            sell_rate = rates.get(sell_cur + '/USDT', 1.0)
+            portfolio.apply_trade(buy_cur, value / buy_rate * 0.999,
+                                  sell_cur, value / sell_rate)
+            expected.apply_trade(buy_cur, value / buy_rate * 0.999,
+                                 sell_cur, value / sell_rate)
+            self.assertAlmostEqual(portfolio.balance_rms_error,
+                                   expected.balance_rms_error, 9)
+            self.assertAlmostEqual(portfolio.valuation_quote,
+                                   expected.valuation_quote, 9)
+
+
+    def test_quote_rates_inverse(self):
+        exchange = DummyExchange(self.targets.keys(), self.balances,
+                                 {'USDT/XRP': 2.0,
+                                  'XLM/USDT': 0.5})
+        portfolio = self.portfolio_class.make_portfolio(self.targets,
+                                                        exchange)
+
+        self.assertEqual(portfolio.quote_rate('XRP'), 0.5)
+        self.assertEqual(portfolio.balances_quote,
+                         {'XRP': 225, 'XLM': 225, 'USDT': 100})
+
+    def test_quote_rates_triangulated(self):
+        targets = {'XRP': 40,
+                   'XLM': 20,
+                   'BTC': 40, }
+        current = {'XRP': 100,
+                   'XLM': 100,
+                   'BTC': 1, }
+        rates = {'XRP/BTC': 0.0001,
+                 'XLM/XRP': 0.5,
+                 'BTC/USDT': 4000.0,
+                 'XLM/BTC': 0.00004, }
+        exchange = DummyExchange(targets.keys(), current, rates)
+        portfolio = self.portfolio_class.make_portfolio(targets, exchange)
+
+        self.assertAlmostEqual(portfolio.quote_rate('XRP'), 0.4)
+        # Through BTC rather than the longer way through XRP
+        self.assertAlmostEqual(portfolio.quote_rate('XLM'), 0.16)
+        self.assertAlmostEqual(portfolio.valuation_quote, 4056)
+
+    def test_quote_rates_direct_first(self):
+        exchange = DummyExchange(self.targets.keys(), self.balances,
+                                 {'XRP/USDT': 1.0,
+                                  'USDT/XRP': 2.0,
+                                  'XLM/USDT': 1.0})
+        portfolio = self.portfolio_class.make_portfolio(self.targets,
+                                                        exchange)
+
+        self.assertEqual(portfolio.quote_rate('XRP'), 1.0)
+
+    def test_quote_rates_unreachable(self):
+        exchange = DummyExchange(self.targets.keys(), self.balances,
+                                 {'XRP/USDT': 1.0})
+        portfolio = self.portfolio_class.make_portfolio(self.targets,
+                                                        exchange)
+
+        with self.assertRaises(ValueError):
+            portfolio.quote_rate('XLM')
+        with self.assertRaises(ValueError):
+            portfolio.balances_quote
+
+    def test_quote_rates_sync(self):
+        exchange = DummyExchange(self.targets.keys(), self.balances,
+                                 {'XRP/USDT': 1.0,
+                                  'XLM/USDT': 1.0})
+        portfolio = self.portfolio_class.make_portfolio(self.targets,
+                                                        exchange)
+        self.assertEqual(portfolio.valuation_quote, 1000)
+
+        exchange._rates = {'XRP/USDT': {'mid': 1.0},
+                           'XLM/XRP': {'mid': 2.0}}
+        portfolio.sync_rates()
+        self.assertEqual(portfolio.quote_rate('XLM'), 2.0)
+        self.assertEqual(portfolio.valuation_quote, 1450)
+
+    def test_unpriced_currencies(self):
+        # Currencies that are neither held nor wanted don't need a price
+        targets = dict(self.targets, BNB=0, ETH=0)
+        balances = dict(self.balances, BNB=0, ETH=0)
+        exchange = DummyExchange(targets.keys(), balances,
+                                 {'XRP/USDT': 1.0,
+                                  'XLM/USDT': 1.0})
+        portfolio = self.portfolio_class.make_portfolio(targets, exchange)
+        self.assertEqual(portfolio.valuation_quote, 1000)
+        self.assertEqual(portfolio.balances_quote['BNB'], 0)
+        self.assertAlmostEqual(portfolio.balance_rms_error, 0)
+
+        # But they do once they're held
+        portfolio.balances['BNB'] = 1
+        with self.assertRaises(ValueError):
+            portfolio.valuation_quote
+
+    def test_valuations(self):
+        targets = {'XRP': 40,
+                   'XLM': 20,
+                   'BTC': 40, }
+        current = {'XRP': 100,
+                   'XLM': 100,
+                   'BTC': 1, }
+        rates = {'XRP/BTC': 0.0001,
+                 'XLM/XRP': 0.5,
+                 'BTC/USDT': 4000.0,
+                 'ETH/BTC': 0.05,
+                 'XLM/BTC': 0.00004, }
+        exchange = DummyExchange(targets.keys(), current, rates)
+        portfolio = self.portfolio_class.make_portfolio(targets, exchange)
+
+        valuations = portfolio.valuations(['USDT', 'BTC', 'ETH'])
+        self.assertEqual(list(valuations), ['USDT', 'BTC', 'ETH'])
+        for quote_currency, res in valuations.items():
+            expected = self.portfolio_class.make_portfolio(
+                targets, exchange, quote_currency=quote_currency)
+            self.assertAlmostEqual(res['valuation_quote'],
+                                   expected.valuation_quote)
+            for cur, value in expected.balances_quote.items():
+                self.assertAlmostEqual(res['balances_quote'][cur], value)
+            self.assertAlmostEqual(res['balance_rms_error'],
+                                   expected.balance_rms_error)
+            self.assertAlmostEqual(res['balance_max_error'],
+                                   expected.balance_max_error)
+        self.assertAlmostEqual(valuations['ETH']['valuation_quote'],
+                               4056 / 200.0)
+
+        # Worked out once until the rates change
+        matrix = portfolio.conversion_matrix(['USDT', 'BTC'])
+        self.assertIs(portfolio.conversion_matrix(['USDT', 'BTC']), matrix)
+        self.assertIs(portfolio.copy().conversion_matrix(['USDT', 'BTC']),
+                      matrix)
+        portfolio.sync_rates()
+        self.assertIsNot(portfolio.conversion_matrix(['USDT', 'BTC']),
+                         matrix)
+
+    def test_valuations_unpriced(self):
+        # Currencies that are neither held nor wanted don't need a price
+        # in any of the quote currencies either
+        targets = dict(self.targets, DOGE=0)
+        balances = dict(self.balances, DOGE=0)
+        exchange = DummyExchange(targets.keys(), balances,
+                                 {'XRP/USDT': 1.0,
+                                  'XLM/USDT': 1.0})
+        portfolio = self.portfolio_class.make_portfolio(targets, exchange)
+        res = portfolio.valuations(['USDT'])['USDT']
+        self.assertEqual(res['valuation_quote'], portfolio.valuation_quote)
+        self.assertEqual(res['balances_quote']['DOGE'], 0.0)
+        self.assertAlmostEqual(res['balance_rms_error'],
+                               portfolio.balance_rms_error)
+
+        portfolio.balances['DOGE'] = 1
+        with self.assertRaises(ValueError):
+            portfolio.valuations(['USDT'])
+
+    def test_valuations_unreachable(self):
+        exchange = DummyExchange(self.targets.keys(), self.balances,
+                                 {'XRP/USDT': 1.0,
+                                  'XLM/USDT': 1.0})
+        portfolio = self.portfolio_class.make_portfolio(self.targets,
+                                                        exchange)
+        with self.assertRaises(ValueError):
+            portfolio.valuations(['USDT', 'BTC'])
+        valuations = portfolio.valuations([])
+        self.assertEqual(valuations, {})
+
+
+class test_ArrayPortfolio(test_Portfolio):
+    """ Run the whole Portfolio suite again with the balances and rates
+    held as vectors """
+    portfolio_class = ArrayPortfolio
+
+    def test_balances_mapping(self):
+        balances = dict(self.balances, BTC=0.5)
+        exchange = DummyExchange(self.targets.keys(), balances)
+        portfolio = ArrayPortfolio.make_portfolio(self.targets, exchange)
+
+        self.assertEqual(portfolio.balances, balances)
+        self.assertEqual(len(portfolio.balances), 4)
+        self.assertEqual(portfolio.balances['BTC'], 0.5)
+        self.assertEqual(portfolio.balances.copy(), balances)
+
+        portfolio.balances['XRP'] += 50
+        self.assertEqual(portfolio.balances['XRP'], 500)
+        self.assertEqual(exchange.balances['XRP'], 450)
+
+    def test_missing_balance(self):
+        exchange = DummyExchange(self.targets.keys(), {'XRP': 450,
+                                                       'XLM': 450})
+        portfolio = ArrayPortfolio.make_portfolio(self.targets, exchange)
+
+        with self.assertRaises(KeyError):
+            portfolio.balances['USDT']
+        with self.assertRaises(KeyError):
+            portfolio.balance_rms_error
+
+    def test_invalidated_by_mutation(self):
+        exchange = DummyExchange(self.targets.keys(), self.balances)
+        portfolio = ArrayPortfolio.make_portfolio(self.targets, exchange)
+        self.assertEqual(portfolio.balance_rms_error, 0)
+        self.assertFalse(portfolio.needs_balancing)
+
+        portfolio.balances['XRP'] += 100
+        portfolio.balances['USDT'] -= 100
+        self.assertEqual(portfolio.valuation_quote, 1000)
+        self.assertEqual(portfolio.differences_quote,
+                         {'XRP': -100, 'XLM': 0, 'USDT': 100})
+        self.assertTrue(portfolio.needs_balancing)
+
+    def test_invalidated_by_sync(self):
+        exchange = DummyExchange(self.targets.keys(), dict(self.balances))
+        portfolio = ArrayPortfolio.make_portfolio(self.targets, exchange)
+        self.assertEqual(portfolio.valuation_quote, 1000)
+
+        exchange.balances['USDT'] = 200
+        self.assertEqual(portfolio.valuation_quote, 1000)
+        portfolio.sync_balances()
+        self.assertEqual(portfolio.valuation_quote, 1100)
+
+        exchange._rates = {'XRP/USDT': {'mid': 2.0},
+                           'XLM/USDT': {'mid': 1.0}}
+        self.assertEqual(portfolio.valuation_quote, 1100)
+        portfolio.sync_rates()
+        self.assertEqual(portfolio.valuation_quote, 1550)
+
+    def test_copy(self):
+        exchange = DummyExchange(self.targets.keys(), self.balances)
+        portfolio = ArrayPortfolio.make_portfolio(self.targets, exchange)
+        self.assertEqual(portfolio.balance_rms_error, 0)
+
+        other = portfolio.copy()
+        self.assertIsInstance(other, ArrayPortfolio)
+        other.balances['XRP'] = 0
+        self.assertEqual(portfolio.balances['XRP'], 450)
+        self.assertEqual(portfolio.balance_rms_error, 0)
+        self.assertNotEqual(other.balance_rms_error, 0)
+
+
+class test_ErrorSums(unittest.TestCase):
+
+    def test_rms_error(self):
+        targets = [0.5, 0.4, 0.1]
+        sums = ErrorSums.from_values(targets, [100.0, 100.0, 50.0])
+        exact = math.sqrt(((0.5 * 250 - 100) ** 2 +
+                           (0.4 * 250 - 100) ** 2 +
+                           (0.1 * 250 - 50) ** 2) / 3) / 250 * 100
+        self.assertAlmostEqual(sums.rms_error, exact)
+
+        sums = sums.trade(0.5, 100.0, 110.0, 0.1, 50.0, 40.0)
+        exact = math.sqrt(((0.5 * 250 - 110) ** 2 +
+                           (0.4 * 250 - 100) ** 2 +
+                           (0.1 * 250 - 40) ** 2) / 3) / 250 * 100
+        self.assertEqual(sums.total, 250.0)
+        self.assertAlmostEqual(sums.rms_error, exact)
+
+    def test_cancellation(self):
+        # Balanced, so everything cancels and the sums can't be trusted
+        sums = ErrorSums.from_values([0.5, 0.5], [1e6, 1e6])
+        self.assertIsNone(sums.rms_error)
+
+        sums = ErrorSums.from_values([0.5, 0.5], [1e6, 0.5e6])
+        self.assertIsNotNone(sums.rms_error)
+        sums = sums.trade(0.5, 0.5e6, 0.75e6, 0.5, 1e6, 0.75e6)
+        self.assertIsNone(sums.rms_error)
+
+    def test_empty(self):
+        sums = ErrorSums.from_values([0.5, 0.5], [0.0, 0.0])
+        self.assertEqual(sums.rms_error, 0.0)
+
+    def test_max_trades(self):
+        sums = ErrorSums.from_values([0.5, 0.5], [100.0, 0.0])
+        for i in range(ErrorSums.MAX_TRADES):
+            sums = sums.trade(0.5, 100.0, 100.0, 0.5, 0.0, 0.0)
+        self.assertIsNotNone(sums.rms_error)
+        sums = sums.trade(0.5, 100.0, 100.0, 0.5, 0.0, 0.0)
+        self.assertIsNone(sums.rms_error)
+
+
+class test_PortfolioSet(unittest.TestCase):
+    targets = {'XRP': 45,
+               'XLM': 45,
+               'USDT': 10, }
+
+    accounts = [{'XRP': 450, 'XLM': 450, 'USDT': 100, },
+                {'XRP': 450, 'XLM': 0, 'USDT': 550, },
+                {'XRP': 0, 'XLM': 0, 'USDT': 0, },
+                {'XRP': 100, 'XLM': 300, 'USDT': 600, }]
+
+    rates = [{'XRP/USDT': 1.0, 'XLM/USDT': 1.0, },
+             {'XRP/USDT': 0.5, 'XLM/XRP': 2.0, }]
+
+    def make_set(self, portfolio_class=Portfolio):
+        exchanges = []
+        for i, balances in enumerate(self.accounts):
+            # The first two accounts are on one exchange and the rest on
+            # another
+            exchange = DummyExchange(self.targets.keys(), dict(balances),
+                                     self.rates[i // 2])
+            exchange.name = 'Exchange{}'.format(i // 2)
+            exchanges.append(exchange)
+        return PortfolioSet.make_portfolio_set(self.targets, exchanges,
+                                               portfolio_class=portfolio_class)
+
+    def test_shared_rates(self):
+        # Accounts whose portfolios use the same exchange share its rates
+        exchanges = [DummyExchange(self.targets.keys(), {}, rates)
+                     for rates in self.rates]
+        portfolios = []
+        for i, balances in enumerate(self.accounts):
+            p = Portfolio(self.targets, exchanges[i // 2])
+            p.balances = dict(balances)
+            portfolios.append(p)
+        portfolio_set = PortfolioSet(portfolios)
+        portfolio_set.sync_rates()
+        self.assertEqual(len(portfolio_set), 4)
+        self.assertIs(portfolios[0].rates, portfolios[1].rates)
+        self.assertIs(portfolios[2].rates, portfolios[3].rates)
+        self.assertIsNot(portfolios[0].rates, portfolios[2].rates)
+        self.assertIs(portfolio_set.rates(portfolios[3]),
+                      portfolios[3].rates)
+        self.assertEqual(portfolios[3].quote_rate('XLM'), 1.0)
+
+    def test_same_name(self):
+        # Exchanges that only share a name each keep their own rates
+        targets = {'XRP': 50, 'USDT': 50, }
+        exchanges = [DummyExchange(targets.keys(), {'XRP': 100, 'USDT': 0},
+                                   {'XRP/USDT': rate})
+                     for rate in [2.0, 3.0]]
+        for portfolio_class in [Portfolio, ArrayPortfolio]:
+            portfolio_set = PortfolioSet.make_portfolio_set(
+                targets, exchanges, portfolio_class=portfolio_class)
+            self.assertEqual(portfolio_set.valuations_quote, [200.0, 300.0])
+            p = portfolio_set.portfolios[1]
+            self.assertEqual(portfolio_set.rates(p)['XRP/USDT']['mid'], 3.0)
+            self.assertEqual(p.valuation_quote, 300.0)
+
+    def test_unpriced_currencies(self):
+        # A currency none of the accounts hold or want doesn't need a price
+        targets = dict(self.targets, DOGE=0)
+        exchanges = [DummyExchange(targets.keys(), dict(balances, DOGE=0),
+                                   self.rates[0])
+                     for balances in self.accounts]
+        for portfolio_class in [Portfolio, ArrayPortfolio]:
+            portfolio_set = PortfolioSet.make_portfolio_set(
+                targets, exchanges, portfolio_class=portfolio_class)
+            self.assertEqual(portfolio_set.valuations_quote,
+                             [p.valuation_quote for p in portfolio_set])
+
+            portfolio_set.portfolios[3].balances['DOGE'] = 1
+            with self.assertRaises(ValueError):
+                portfolio_set.valuations_quote
+
+    def test_metrics(self):
+        for portfolio_class in [Portfolio, ArrayPortfolio]:
+            portfolio_set = self.make_set(portfolio_class)
+            valuations = portfolio_set.valuations_quote
+            rms_errors = portfolio_set.balance_rms_errors
+            max_errors = portfolio_set.balance_max_errors
+            for i, p in enumerate(portfolio_set):
+                self.assertAlmostEqual(valuations[i], p.valuation_quote)
+                self.assertAlmostEqual(rms_errors[i], p.balance_rms_error)
+                if p.valuation_quote:
+                    self.assertAlmostEqual(max_errors[i],
+                                           p.balance_max_error)
+            # Nothing held counts as balanced
+            self.assertEqual(rms_errors[2], 0.0)
+            self.assertEqual(max_errors[2], 0.0)
+            self.assertEqual(portfolio_set.needs_balancing,
+                             [False, True, False, True])
+            self.assertAlmostEqual(portfolio_set.valuation_quote,
+                                   sum(valuations))
+
+    def test_metrics_follow_trades(self):
+        portfolio_set = self.make_set(ArrayPortfolio)
+        portfolio_set.portfolios[1].apply_trade('XLM', 450, 'USDT', 450)
+        self.assertEqual(portfolio_set.needs_balancing,
+                         [False, False, False, True])
+
+    def test_mismatched_targets(self):
+        exchange = DummyExchange(self.targets.keys(), self.accounts[0])
+        p1 = Portfolio.make_portfolio(self.targets, exchange)
+        p2 = Portfolio.make_portfolio(self.targets, exchange,
+                                      quote_currency='XRP')
+        with self.assertRaises(ValueError):
+            PortfolioSet([p1, p2])
+        with self.assertRaises(ValueError):
+            PortfolioSet([])
+
+    def test_aggregate(self):
+        portfolio_set = self.make_set()
+        portfolio = portfolio_set.aggregate()
+        self.assertEqual(portfolio.balances,
+                         {'XRP': 1000, 'XLM': 750, 'USDT': 1250})
+        self.assertEqual(portfolio.rates, portfolio_set.portfolios[0].rates)
+        self.assertEqual(portfolio.valuation_quote, 3000)
+        # The accounts themselves are left as they were
+        self.assertEqual(portfolio_set.portfolios[0].balances,
+                         self.accounts[0])
+
+    def test_balance_each(self):
+        portfolio_set = self.make_set()
+        balancer = SimpleBalancer()
+        results = portfolio_set.balance_each(balancer)
+        self.assertIsNone(results[0])
+        self.assertIsNone(results[2])
+        for i in [1, 3]:
+            p = portfolio_set.portfolios[i]
+            expected = balancer.balance(p, p.exchange)
+            self.assertEqual(results[i]['orders'], expected['orders'])
+            self.assertTrue(results[i]['orders'])
+
+        results = portfolio_set.balance_each(balancer, force=True)
+        self.assertEqual(results[0]['orders'], [])
+        self.assertIsNone(results[2]['proposed_portfolio'])
+
+    def test_balance_aggregate(self):
+        portfolio_set = self.make_set()
+        res = portfolio_set.balance_aggregate(SimpleBalancer(), account=3)
+        self.assertTrue(res['orders'])
+        self.assertLess(res['proposed_portfolio'].balance_rms_error,
+                        portfolio_set.aggregate(3).balance_rms_error)
+
+
 class test_SimpleBalancer(unittest.TestCase):
+    portfolio_class = Portfolio
 
-    def execute(self, targets, current, rates, fee=0.001, max_orders=5, mode='mid'):
+    def execute(self, targets, current, rates, fee=0.001, max_orders=5, mode='mid',
+                **kwargs):
         exchange = DummyExchange(targets.keys(), current, rates, fee)
-        portfolio = Portfolio.make_portfolio(targets, exchange)
+        portfolio = self.portfolio_class.make_portfolio(targets, exchange)
 
-        balancer = SimpleBalancer()
+        balancer = SimpleBalancer(**kwargs)
         return balancer.balance(portfolio, exchange, max_orders=max_orders, mode=mode)
 
     def test_noop(self):
@@ -296,6 +787,24 @@ class test_SimpleBalancer(unittest.TestCase):
         res = self.execute(targets, current, rates)
         self.assertEqual(res['orders'], [])
 
+    def test_untradable_sell_pair(self):
+        # Quoted both ways, but only XRP/BTC has limits, so buy on that
+        # rather than giving up on selling BTC/XRP
+        targets = {'XRP': 50,
+                   'BTC': 50, }
+        current = {'XRP': 0,
+                   'BTC': 1, }
+        rates = {'XRP/BTC': 0.0001,
+                 'BTC/XRP': 10000.0, }
+        exchange = DummyExchange(targets.keys(), current, rates, 0.001)
+        portfolio = self.portfolio_class.make_portfolio(
+            targets, exchange, quote_currency='BTC')
+
+        res = SimpleBalancer().balance(portfolio, exchange)
+
+        self.assertEqual(res['orders'], [Order('XRP/BTC', 'BUY', 5000,
+                                               0.0001)])
+
     def test_start_all_usdt(self):
 
         targets = {'XRP': 50,
@@ -500,10 +1009,10 @@ class test_SimpleBalancer(unittest.TestCase):
         res = self.execute(targets, current, rates)
         # Test the orders we get are correct
         expected = [Order('BTC/USDT', 'SELL', 0.0037801180908891593, 3968.13),
-                    Order('XLM/XRP', 'BUY', 6.551686481727605, 0.283366),
-                    Order('XRP/BTC', 'SELL', 18.648636987155573, 8.102e-05),
-                    Order('XRP/ETH', 'SELL', 13.236589350291911, 0.00217366),
-                    Order('XRP/USDT', 'BUY', 39.15710063598936, 0.32076), ]
+                    Order('XLM/XRP', 'BUY', 6.551686481726353, 0.283366),
+                    Order('XRP/BTC', 'SELL', 18.648636987155218, 8.102e-05),
+                    Order('XRP/ETH', 'SELL', 13.236589350292975, 0.00217366),
+                    Order('XRP/USDT', 'BUY', 39.15710063598953, 0.32076), ]
         self.assertEqual(res['orders'], expected)
 
         # Test that the final amounts are in proportion to the targets
@@ -542,8 +1051,8 @@ class test_SimpleBalancer(unittest.TestCase):
 
         res = self.execute(targets, current, rates, mode='cheap')
         # Test the orders we get are correct
-        expected = [Order('XLM/XRP', 'BUY', 6.551686481727605, 0.283366),
-                    Order('XRP/BTC', 'BUY', 28.11529866566897, 8.102e-05),
+        expected = [Order('XLM/XRP', 'BUY', 6.551686481726353, 0.283366),
+                    Order('XRP/BTC', 'BUY', 28.115298665669325, 8.102e-05),
                     Order('XRP/ETH', 'SELL', 13.236589350292975, 0.00217366)] 
         self.assertEqual(res['orders'], expected)
 
@@ -672,28 +1181,95 @@ class test_SimpleBalancer(unittest.TestCase):
                  'XRP/ETH': 0.00217366,
                  }
 
-        with self.assertRaises(ValueError):
-            self.execute(targets, current, rates)
+        # No BTC/USDT or ETH/USDT, so those are valued through XRP
+        res = self.execute(targets, current, rates)
+        portfolio = res['initial_portfolio']
+        self.assertAlmostEqual(portfolio.quote_rate('BTC'),
+                               0.32076 / 0.00008102)
+        self.assertAlmostEqual(portfolio.quote_rate('ETH'),
+                               0.32076 / 0.00217366)
+
+        pairs = set(order.pair for order in res['orders'])
+        self.assertIn('XRP/BTC', pairs)
+        self.assertIn('XRP/ETH', pairs)
+        self.assertLess(res['proposed_portfolio'].balance_rms_error,
+                        portfolio.balance_rms_error)
+
+    def test_sparse_universe(self):
+        # Lots of currencies with no target that aren't held, most of them
+        # without even a rate, are left out of the search
+        targets = {'XRP': 45,
+                   'XLM': 45,
+                   'USDT': 10, }
+        current = {'XRP': 450,
+                   'XLM': 0,
+                   'USDT': 550, }
+        rates = {'XRP/USDT': 1.0,
+                 'XLM/USDT': 1.0, }
+        expected = self.execute(targets, current, rates)
+        self.assertTrue(expected['orders'])
+
+        others = ['C{}'.format(i) for i in range(200)]
+        targets = dict(targets, **{cur: 0 for cur in others})
+        current = dict(current, **{cur: 0 for cur in others})
+        rates = dict(rates, **{'{}/USDT'.format(cur): 1.0
+                               for cur in others[:20]})
+        res = self.execute(targets, current, rates)
+
+        self.assertEqual(res['orders'], expected['orders'])
+        self.assertEqual(res['proposed_portfolio'].balances,
+                         dict(expected['proposed_portfolio'].balances,
+                              **{cur: 0 for cur in others}))
+        self.assertAlmostEqual(res['proposed_portfolio'].balance_rms_error,
+                               expected['proposed_portfolio']
+                               .balance_rms_error * math.sqrt(3 / 203))
+
+    def test_canonical_order(self):
+        targets = {'XRP': 40,
+                   'XLM': 20,
+                   'BTC': 20,
+                   'USDT': 20, }
+        current = {'XRP': 3352,
+                   'XLM': 0,
+                   'BTC': 0.01,
+                   'USDT': 243, }
+        rates = {'XRP/USDT': 0.32076,
+                 'XLM/USDT': 0.09084,
+                 'XLM/XRP': 0.283366,
+                 'XRP/BTC': 0.00008102,
+                 'BTC/USDT': 3968.13, }
+        res = self.execute(targets, current, rates)
+
+        # The same inputs in another order give exactly the same plan
+        def reverse(x):
+            return dict(reversed(list(x.items())))
+        other = self.execute(reverse(targets), reverse(current),
+                             reverse(rates))
+        self.assertTrue(res['orders'])
+        self.assertEqual(res['orders'], other['orders'])
+        self.assertEqual(res['total_fee'], other['total_fee'])
+        self.assertEqual(res['proposed_portfolio'].balances,
+                         other['proposed_portfolio'].balances)
 
     def test_badpair3(self):
 
         targets = {'XRP': 40,
                    'XLM': 20,
                    'BTC': 20,
-                   'ETH': 10,
+                   'BNB': 10,
                    'USDT': 10, }
         current = {'XRP': 3352,
                    'XLM': 0,
                    'BTC': 0,
-                   'ETH': 0,
+                   'BNB': 0,
                    'USDT': 243, }
         rates = {'XRP/USDT': 0.32076,
                  'XLM/USDT': 0.09084,
                  'XLM/XRP': 0.283366,
                  'XRP/BTC': 0.00008102,
-                 'XRP/ETH': 0.00217366,
                  }
 
+        # Nothing reaches BNB at all
         with self.assertRaises(ValueError):
             self.execute(targets, current, rates)
 
@@ -750,6 +1326,904 @@ class test_SimpleBalancer(unittest.TestCase):
         self.assertEqual(res['total_fee'], 4.5)
 
 
+    def test_state_key_permutations(self):
+        targets = {'XRP': 50,
+                   'XLM': 40,
+                   'USDT': 10, }
+        current = {'XRP': 0,
+                   'XLM': 0,
+                   'USDT': 1000, }
+        exchange = DummyExchange(targets.keys(), current)
+        portfolio = Portfolio.make_portfolio(targets, exchange)
+        space = SearchSpace(portfolio)
+
+        a = Order('XRP/USDT', 'BUY', 500, 1.0)
+        b = Order('XLM/USDT', 'BUY', 400, 1.0)
+        first = (500, 400, 100)
+        second = (500.0000000000001, 400, 100)
+
+        self.assertEqual(Attempt(space, first, sorted([a, b])).state_key,
+                         Attempt(space, second, sorted([b, a])).state_key)
+        self.assertNotEqual(Attempt(space, first, [a]).state_key,
+                            Attempt(space, second, sorted([b, a])).state_key)
+
+    def test_attempt_shares_space(self):
+        targets = {'XRP': 50,
+                   'XLM': 40,
+                   'USDT': 10, }
+        current = {'XRP': 0,
+                   'XLM': 0,
+                   'USDT': 1000, }
+        exchange = DummyExchange(targets.keys(), current)
+        portfolio = Portfolio.make_portfolio(targets, exchange)
+        space = SearchSpace(portfolio)
+
+        # The search sorts the currencies, whatever order they came in
+        self.assertEqual(space.currencies, ['USDT', 'XLM', 'XRP'])
+        root = Attempt(space)
+        self.assertEqual(root.balances, (1000, 0, 0))
+        self.assertEqual(root.rms_error, portfolio.balance_rms_error)
+
+        attempt = Attempt(space, (100, 400, 500))
+        self.assertIs(attempt.space, root.space)
+        self.assertEqual(attempt.rms_error, 0)
+        self.assertEqual(attempt.portfolio.balances,
+                         {'XRP': 500, 'XLM': 400, 'USDT': 100})
+        self.assertEqual(portfolio.balances, current)
+
+
+    def test_routes(self):
+        targets = {'XRP': 50,
+                   'XLM': 40,
+                   'USDT': 10, }
+        current = {'XRP': 1000,
+                   'XLM': 0,
+                   'USDT': 0, }
+        rates = {'XRP/USDT': 1.0,
+                 'XLM/USDT': 2.0,
+                 'XLM/XRP': 2.0, }
+        exchange = DummyExchange(targets.keys(), current, rates)
+        portfolio = Portfolio.make_portfolio(targets, exchange)
+        rates = exchange.rates
+        rates['USDT/USDT'] = {'mid': 1.0, 'high': 1.0, 'low': 1.0}
+        space = SearchSpace(portfolio, exchange, rates, 'passive')
+        usdt, xlm, xrp = range(3)
+
+        self.assertEqual(space.trade_rates, [1.0, 2.0, 1.0])
+
+        pair_idx, direction, min_cost, rate = space.routes[xlm][xrp]
+        self.assertEqual(space.pairs[pair_idx], 'XLM/XRP')
+        self.assertEqual((direction, min_cost), ('BUY', 1.0))
+        self.assertAlmostEqual(rate, 1.998)
+
+        pair_idx, direction, min_cost, rate = space.routes[usdt][xrp]
+        self.assertEqual(space.pairs[pair_idx], 'XRP/USDT')
+        self.assertEqual((direction, min_cost), ('SELL', 10.0))
+        self.assertAlmostEqual(rate, 1.001)
+
+        self.assertIsNone(space.routes[xrp][xrp])
+
+
+class test_BestFirstBalancer(test_SimpleBalancer):
+    """ Run the whole SimpleBalancer suite again with the best-first
+    search, it needs to come up with the same plans """
+
+    def execute(self, *args, **kwargs):
+        kwargs.setdefault('search', 'best-first')
+        return super().execute(*args, **kwargs)
+
+    def assertSameOrders(self, orders, expected):
+        self.assertEqual(len(orders), len(expected))
+        for order, other in zip(orders, expected):
+            self.assertEqual((order.pair, order.direction, order.price),
+                             (other.pair, other.direction, other.price))
+            self.assertAlmostEqual(order.amount, other.amount)
+
+    def test_invalid_search(self):
+        with self.assertRaises(ValueError):
+            SimpleBalancer(search='foo')
+
+    def test_same_as_dfs(self):
+        targets = {'XRP': 30,
+                   'XLM': 20,
+                   'BTC': 20,
+                   'ETH': 10,
+                   'BNB': 10,
+                   'USDT': 10, }
+        current = {'XRP': 3352,
+                   'XLM': 0,
+                   'BTC': 0.01,
+                   'ETH': 0,
+                   'BNB': 5,
+                   'USDT': 243, }
+        rates = {'XRP/USDT': 0.32076,
+                 'XLM/USDT': 0.09084,
+                 'XLM/XRP': 0.283366,
+                 'XRP/BTC': 0.00008102,
+                 'XRP/ETH': 0.00217366,
+                 'BTC/USDT': 3968.13,
+                 'ETH/USDT': 147.81,
+                 'BNB/USDT': 10.0,
+                 'BNB/BTC': 0.0025,
+                 'ETH/BTC': 0.037, }
+
+        for max_orders in range(1, 5):
+            dfs = self.execute(targets, current, rates,
+                               max_orders=max_orders, search='dfs')
+            best_first = self.execute(targets, current, rates,
+                                      max_orders=max_orders)
+            self.assertSameOrders(best_first['orders'], dfs['orders'])
+            self.assertAlmostEqual(best_first['total_fee'], dfs['total_fee'])
+            self.assertLessEqual(best_first['nodes_expanded'],
+                                 dfs['nodes_expanded'])
+        self.assertLess(best_first['nodes_expanded'], dfs['nodes_expanded'])
+
+
+class test_ParallelBalancer(test_SimpleBalancer):
+    """ Run the whole SimpleBalancer suite again with the first level
+    subtrees searched in worker processes """
+
+    def execute(self, *args, **kwargs):
+        kwargs.setdefault('workers', 2)
+        return super().execute(*args, **kwargs)
+
+    def test_same_as_serial(self):
+        # Exactly the same plan, down to the last bit, even where subtrees
+        # reach the same state by different paths
+        rng = random.Random(1)
+        currencies = ['XRP', 'XLM', 'BTC', 'ETH', 'BNB', 'USDT']
+        cases = [random_case(rng, currencies) for i in range(40)]
+        for search in SimpleBalancer.searches:
+            for targets, current, rates in cases:
+                exchange = DummyExchange(targets.keys(), current, rates,
+                                         0.001)
+                portfolio = Portfolio.make_portfolio(targets, exchange)
+                serial = SimpleBalancer(search=search).balance(
+                    portfolio, exchange, max_orders=4)
+                res = SimpleBalancer(search=search, workers=2).balance(
+                    portfolio, exchange, max_orders=4)
+                self.assertEqual([order.key for order in res['orders']],
+                                 [order.key for order in serial['orders']])
+                self.assertEqual(res['total_fee'], serial['total_fee'])
+                if serial['proposed_portfolio']:
+                    self.assertEqual(res['proposed_portfolio'].balances,
+                                     serial['proposed_portfolio'].balances)
+
+
+class test_ArrayPortfolioBalancer(test_SimpleBalancer):
+    """ Run the whole SimpleBalancer suite again on an ArrayPortfolio """
+    portfolio_class = ArrayPortfolio
+
+
+class test_BatchBalancer(test_SimpleBalancer):
+    """ Run the whole SimpleBalancer suite again scoring the candidate
+    trades as a batch, which it would only do for larger portfolios """
+
+    def execute(self, *args, **kwargs):
+        kwargs.setdefault('batch', True)
+        return super().execute(*args, **kwargs)
+
+    def test_same_as_each(self):
+        targets = {'XRP': 30,
+                   'XLM': 20,
+                   'BTC': 20,
+                   'ETH': 10,
+                   'BNB': 10,
+                   'USDT': 10, }
+        current = {'XRP': 3352,
+                   'XLM': 0,
+                   'BTC': 0.01,
+                   'ETH': 0,
+                   'BNB': 5,
+                   'USDT': 243, }
+        rates = {'XRP/USDT': 0.32076,
+                 'XLM/USDT': 0.09084,
+                 'XLM/XRP': 0.283366,
+                 'XRP/BTC': 0.00008102,
+                 'XRP/ETH': 0.00217366,
+                 'BTC/USDT': 3968.13,
+                 'ETH/USDT': 147.81,
+                 'BNB/USDT': 10.0,
+                 'BNB/BTC': 0.0025,
+                 'ETH/BTC': 0.037, }
+        exchange = DummyExchange(targets.keys(), current, rates)
+        portfolio = Portfolio.make_portfolio(targets, exchange)
+        rates = exchange.rates
+        rates['USDT/USDT'] = {'mid': 1.0, 'high': 1.0, 'low': 1.0}
+        balancer = SimpleBalancer()
+
+        todo = [Attempt(SearchSpace(portfolio, exchange, rates))]
+        for depth in range(2):
+            batch = [x for a in todo
+                     for x in balancer.expand_batch(a, exchange)]
+            each = [x for a in todo
+                    for x in balancer.expand_each(a, exchange)]
+            self.assertTrue(batch)
+            self.assertEqual(len(batch), len(each))
+            for a, b in zip(batch, each):
+                self.assertEqual(a.orders, b.orders)
+                self.assertEqual(a.balances, b.balances)
+                self.assertAlmostEqual(a.total_fee, b.total_fee)
+                self.assertAlmostEqual(a.rms_error, b.rms_error)
+                self.assertEqual(a.state_key[0], b.state_key[0])
+            todo = batch
+
+    def test_quantize_rows(self):
+        values = np.array([[0.0, 1.0, 123456.7891234, -0.000123456789123],
+                           [1e-20, 3e15, 0.30000000000000004, 0.3]])
+        noisy = values * (1 + 1e-15)
+        self.assertEqual(quantize_rows(values), quantize_rows(noisy))
+        for row, expected in zip(quantize_rows(values), values.tolist()):
+            for x, y in zip(row, expected):
+                self.assertAlmostEqual(x / (quantize(y) or 1.0),
+                                       1.0 if y else 0.0)
+
+
+class test_BeamBalancer(test_SimpleBalancer):
+    """ Run the whole SimpleBalancer suite again with a beam search, which
+    is wide enough for these small portfolios to find the same plans """
+
+    def execute(self, *args, **kwargs):
+        kwargs.setdefault('search', 'beam')
+        return super().execute(*args, **kwargs)
+
+    def test_invalid_beam_width(self):
+        with self.assertRaises(ValueError):
+            SimpleBalancer(search='beam', beam_width=0)
+
+    def test_narrow_beam(self):
+        targets = {'XRP': 30,
+                   'XLM': 20,
+                   'BTC': 20,
+                   'ETH': 10,
+                   'BNB': 10,
+                   'USDT': 10, }
+        current = {'XRP': 3352,
+                   'XLM': 0,
+                   'BTC': 0.01,
+                   'ETH': 0,
+                   'BNB': 5,
+                   'USDT': 243, }
+        rates = {'XRP/USDT': 0.32076,
+                 'XLM/USDT': 0.09084,
+                 'XLM/XRP': 0.283366,
+                 'XRP/BTC': 0.00008102,
+                 'XRP/ETH': 0.00217366,
+                 'BTC/USDT': 3968.13,
+                 'ETH/USDT': 147.81,
+                 'BNB/USDT': 10.0,
+                 'BNB/BTC': 0.0025,
+                 'ETH/BTC': 0.037, }
+
+        full = self.execute(targets, current, rates, max_orders=4,
+                            search='dfs')
+        for beam_width in [1, 2, 5]:
+            res = self.execute(targets, current, rates, max_orders=4,
+                               beam_width=beam_width)
+            # Only beam_width attempts are expanded at each depth
+            self.assertLessEqual(res['nodes_expanded'],
+                                 1 + beam_width * 3)
+            self.assertLess(res['proposed_portfolio'].balance_rms_error,
+                            res['initial_portfolio'].balance_rms_error)
+            self.assertGreaterEqual(
+                round(res['proposed_portfolio'].balance_rms_error, 9),
+                round(full['proposed_portfolio'].balance_rms_error, 9))
+
+
+    def test_workers(self):
+        # The beam is over the whole search, so workers don't change it
+        rng = random.Random(1)
+        currencies = ['XRP', 'XLM', 'BTC', 'ETH', 'BNB', 'USDT']
+        for i in range(10):
+            targets, current, rates = random_case(rng, currencies)
+            serial = self.execute(targets, current, rates, max_orders=4,
+                                  beam_width=3)
+            res = self.execute(targets, current, rates, max_orders=4,
+                               beam_width=3, workers=2)
+            self.assertEqual(res['orders'], serial['orders'])
+            self.assertEqual(res['total_fee'], serial['total_fee'])
+            self.assertLessEqual(res['nodes_expanded'], 1 + 3 * 3)
+
+
+class test_TopKBalancer(test_SimpleBalancer):
+    """ Run the whole SimpleBalancer suite again only trying the top few
+    pairings from each attempt, which is enough for these small
+    portfolios to find the same plans """
+
+    def execute(self, *args, **kwargs):
+        kwargs.setdefault('top_k', 3)
+        return super().execute(*args, **kwargs)
+
+    def test_invalid_top_k(self):
+        with self.assertRaises(ValueError):
+            SimpleBalancer(top_k=0)
+
+    def test_permute_differences(self):
+        differences = {'XRP': 100.0,
+                       'XLM': 10.0,
+                       'BTC': -50.0,
+                       'USDT': -5.0, }
+        pairings = list(SimpleBalancer().permute_differences(differences))
+        self.assertEqual(len(pairings), 4)
+
+        balancer = SimpleBalancer(top_k=2)
+        pairings = balancer.permute_differences(differences)
+        # XRP with BTC can move 50, then XLM with BTC 10, which beats 5
+        # for either with USDT. Kept in the order they came in.
+        self.assertEqual([(p[0], n[0]) for p, n in pairings],
+                         [('XRP', 'BTC'), ('XLM', 'BTC')])
+
+    def test_quality_loss(self):
+        # How much worse the plans get for cutting down the pairings on
+        # some random portfolios, against trying them all
+        rng = random.Random(1)
+        currencies = ['XRP', 'XLM', 'BTC', 'ETH', 'BNB', 'USDT']
+        cases = [random_case(rng, currencies) for i in range(10)]
+        exhaustive = [run(SimpleBalancer(), *case, 4) for case in cases]
+
+        losses = []
+        nodes = []
+        for top_k in [1, 2, 3, 4]:
+            results = [run(SimpleBalancer(top_k=top_k), *case, 4)
+                       for case in cases]
+            loss = [error - best_error for (error, _, _, _),
+                    (best_error, _, _, _) in zip(results, exhaustive)]
+            self.assertGreaterEqual(min(loss), -1e-9)
+            losses.append(sum(loss) / len(cases))
+            nodes.append(sum(x[2] for x in results))
+
+        # Fewer pairings, fewer nodes, worse plans
+        self.assertEqual(nodes, sorted(nodes))
+        self.assertLess(nodes[0], sum(x[2] for x in exhaustive) / 4)
+        self.assertGreater(losses[0], losses[-1])
+        # but only a little worse once a few pairings are kept
+        self.assertLess(losses[2], 0.05)
+        self.assertLess(losses[3], 1e-6)
+
+    def test_same_as_each(self):
+        targets = {'XRP': 30,
+                   'XLM': 20,
+                   'BTC': 20,
+                   'ETH': 10,
+                   'BNB': 10,
+                   'USDT': 10, }
+        current = {'XRP': 3352,
+                   'XLM': 0,
+                   'BTC': 0.01,
+                   'ETH': 0,
+                   'BNB': 5,
+                   'USDT': 243, }
+        rates = {'XRP/USDT': 0.32076,
+                 'XLM/USDT': 0.09084,
+                 'XLM/XRP': 0.283366,
+                 'XRP/BTC': 0.00008102,
+                 'XRP/ETH': 0.00217366,
+                 'BTC/USDT': 3968.13,
+                 'ETH/USDT': 147.81,
+                 'BNB/USDT': 10.0,
+                 'BNB/BTC': 0.0025,
+                 'ETH/BTC': 0.037, }
+        for top_k in [1, 2, 3]:
+            each = self.execute(targets, current, rates, max_orders=4,
+                                top_k=top_k, batch=False)
+            batch = self.execute(targets, current, rates, max_orders=4,
+                                 top_k=top_k, batch=True)
+            self.assertEqual(each['orders'], batch['orders'])
+            self.assertEqual(each['nodes_expanded'],
+                             batch['nodes_expanded'])
+
+
+class test_BalancerBudget(unittest.TestCase):
+
+    targets = {'XRP': 30,
+               'XLM': 20,
+               'BTC': 20,
+               'ETH': 10,
+               'BNB': 10,
+               'USDT': 10, }
+    current = {'XRP': 3352,
+               'XLM': 0,
+               'BTC': 0.01,
+               'ETH': 0,
+               'BNB': 5,
+               'USDT': 243, }
+    rates = {'XRP/USDT': 0.32076,
+             'XLM/USDT': 0.09084,
+             'XLM/XRP': 0.283366,
+             'XRP/BTC': 0.00008102,
+             'XRP/ETH': 0.00217366,
+             'BTC/USDT': 3968.13,
+             'ETH/USDT': 147.81,
+             'BNB/USDT': 10.0,
+             'BNB/BTC': 0.0025,
+             'ETH/BTC': 0.037, }
+
+    def execute(self, balancer=None, **kwargs):
+        exchange = DummyExchange(self.targets.keys(), self.current,
+                                 self.rates, 0.001)
+        portfolio = Portfolio.make_portfolio(self.targets, exchange)
+        balancer = balancer or SimpleBalancer()
+        return balancer.balance(portfolio, exchange, max_orders=4, **kwargs)
+
+    def test_unlimited(self):
+        res = self.execute()
+        budgeted = self.execute(deadline_ms=60000, max_nodes=10 ** 6)
+        self.assertFalse(res['partial'])
+        self.assertFalse(budgeted['partial'])
+        self.assertEqual(res['orders'], budgeted['orders'])
+        self.assertEqual(res['nodes_expanded'], budgeted['nodes_expanded'])
+
+    def test_max_nodes(self):
+        full = self.execute()
+        for search in SimpleBalancer.searches:
+            res = self.execute(SimpleBalancer(search=search), max_nodes=20)
+            self.assertTrue(res['partial'])
+            self.assertEqual(res['nodes_expanded'], 20)
+            # Still a usable plan, just maybe not as good as the full one
+            self.assertTrue(res['orders'])
+            self.assertLess(res['proposed_portfolio'].balance_rms_error,
+                            res['initial_portfolio'].balance_rms_error)
+            self.assertGreaterEqual(
+                round(res['proposed_portfolio'].balance_rms_error, 9),
+                round(full['proposed_portfolio'].balance_rms_error, 9))
+
+    def test_max_nodes_parallel(self):
+        res = self.execute(SimpleBalancer(workers=2), max_nodes=20)
+        self.assertTrue(res['partial'])
+        self.assertLessEqual(res['nodes_expanded'], 20)
+        self.assertTrue(res['orders'])
+
+    def test_deadline(self):
+        res = self.execute(deadline_ms=0)
+        self.assertTrue(res['partial'])
+        self.assertEqual(res['nodes_expanded'], 0)
+        self.assertEqual(res['orders'], [])
+        self.assertIsNone(res['proposed_portfolio'])
+
+    def test_linear(self):
+        res = self.execute(LinearBalancer(), deadline_ms=0, max_nodes=0)
+        self.assertFalse(res['partial'])
+        self.assertTrue(res['orders'])
+
+
+class test_WarmStart(unittest.TestCase):
+
+    targets = test_BalancerBudget.targets
+    current = test_BalancerBudget.current
+    rates = test_BalancerBudget.rates
+
+    def execute(self, rates, prior_orders=None, **kwargs):
+        exchange = DummyExchange(self.targets.keys(), self.current, rates,
+                                 0.001)
+        portfolio = Portfolio.make_portfolio(self.targets, exchange)
+        balancer = SimpleBalancer(**kwargs)
+        return balancer.balance(portfolio, exchange, max_orders=4,
+                                prior_orders=prior_orders)
+
+    def assertSamePlan(self, res, expected):
+        self.assertEqual(len(res['orders']), len(expected['orders']))
+        for order, other in zip(res['orders'], expected['orders']):
+            self.assertEqual((order.pair, order.direction, order.price),
+                             (other.pair, other.direction, other.price))
+            self.assertAlmostEqual(order.amount, other.amount)
+        self.assertAlmostEqual(res['total_fee'], expected['total_fee'])
+
+    def test_same_rates(self):
+        cold = self.execute(self.rates)
+        warm = self.execute(self.rates, cold['orders'])
+        self.assertSamePlan(warm, cold)
+        self.assertLess(warm['nodes_expanded'], cold['nodes_expanded'])
+
+    def test_drifted_rates(self):
+        prior = self.execute(self.rates)['orders']
+        rates = dict((pair, rate * 1.01 if 'XRP' in pair else rate)
+                     for pair, rate in self.rates.items())
+        for search in SimpleBalancer.searches + ['parallel']:
+            if search == 'parallel':
+                kwargs = {'workers': 2}
+            else:
+                kwargs = {'search': search}
+            cold = self.execute(rates, **kwargs)
+            warm = self.execute(rates, prior, **kwargs)
+            self.assertSamePlan(warm, cold)
+            self.assertLessEqual(warm['nodes_expanded'],
+                                 cold['nodes_expanded'])
+
+    def test_repriced(self):
+        exchange = DummyExchange(self.targets.keys(), self.current,
+                                 self.rates, 0.001)
+        portfolio = Portfolio.make_portfolio(self.targets, exchange)
+        rates = exchange.rates
+        rates['USDT/USDT'] = {'mid': 1.0, 'high': 1.0, 'low': 1.0}
+        root = Attempt(SearchSpace(portfolio, exchange, rates))
+
+        prior = [Order('XRP/USDT', 'SELL', 1000, 0.25),
+                 Order('XLM/XRP', 'BUY', 1000, 0.3)]
+        incumbent = SimpleBalancer().warm_start(root, exchange, prior)
+        self.assertEqual(list(incumbent.orders),
+                         [Order('XLM/XRP', 'BUY', 1000, 0.283366),
+                          Order('XRP/USDT', 'SELL', 1000, 0.32076)])
+        self.assertLess(incumbent.rms_error, root.rms_error)
+
+    def test_invalid_prior(self):
+        cold = self.execute(self.rates)
+        # Pairs that aren't traded, the wrong way round or too small for
+        # the exchange are skipped
+        prior = [Order('DOGE/USDT', 'BUY', 100, 0.1),
+                 Order('USDT/XRP', 'SELL', 100, 3.0),
+                 Order('XRP/USDT', 'SELL', 0.001, 0.32076)]
+        res = self.execute(self.rates, prior)
+        self.assertSamePlan(res, cold)
+        self.assertEqual(res['nodes_expanded'], cold['nodes_expanded'])
+
+
+class test_PlanCache(unittest.TestCase):
+
+    targets = test_BalancerBudget.targets
+    current = test_BalancerBudget.current
+    rates = test_BalancerBudget.rates
+
+    def execute(self, balancer, targets=None, current=None, rates=None,
+                **kwargs):
+        exchange = DummyExchange((targets or self.targets).keys(),
+                                 current or self.current,
+                                 rates or self.rates, 0.001)
+        portfolio = Portfolio.make_portfolio(targets or self.targets,
+                                             exchange)
+        return balancer.balance(portfolio, exchange, max_orders=4, **kwargs)
+
+    def key(self, targets=None, current=None, rates=None, max_orders=4,
+            mode='mid', balancer=None):
+        exchange = DummyExchange((targets or self.targets).keys(),
+                                 current or self.current,
+                                 rates or self.rates, 0.001)
+        portfolio = Portfolio.make_portfolio(targets or self.targets,
+                                             exchange)
+        return plan_key(portfolio, exchange, exchange.rates, max_orders,
+                        mode, balancer or SimpleBalancer())
+
+    def test_key(self):
+        key = self.key()
+        self.assertEqual(len(key), 64)
+        self.assertEqual(key, self.key())
+
+        def reverse(x):
+            return dict(reversed(list(x.items())))
+        self.assertEqual(key, self.key(reverse(self.targets),
+                                       reverse(self.current),
+                                       reverse(self.rates)))
+
+        # Noise well below what the search can tell apart doesn't matter
+        current = dict(self.current, XRP=self.current['XRP'] * (1 + 1e-13))
+        self.assertEqual(key, self.key(current=current))
+
+    def test_key_changes(self):
+        key = self.key()
+        others = [
+            self.key(current=dict(self.current, XRP=3353)),
+            self.key(targets=dict(self.targets, XRP=20, XLM=30)),
+            self.key(rates=dict(self.rates, **{'XRP/USDT': 0.33})),
+            self.key(max_orders=5),
+            self.key(mode='passive'),
+            self.key(balancer=SimpleBalancer(top_k=2)),
+            self.key(balancer=LinearBalancer()),
+        ]
+        self.assertEqual(len(set(others + [key])), len(others) + 1)
+
+    def test_key_valuation_route(self):
+        # BTC is only valued through ETH, which isn't one of the targets,
+        # so a change to ETH/USDT alone still changes the plan
+        targets = {'XRP': 40, 'BTC': 30, 'USDT': 30, }
+        current = {'XRP': 1000, 'BTC': 0.1, 'USDT': 100, }
+        rates = {'XRP/USDT': 0.5,
+                 'XRP/BTC': 0.00025,
+                 'BTC/ETH': 20.0,
+                 'ETH/USDT': 100.0, }
+        moved = dict(rates, **{'ETH/USDT': 300.0})
+        self.assertNotEqual(self.key(targets, current, rates),
+                            self.key(targets, current, moved))
+
+        balancer = CachingBalancer(SimpleBalancer())
+        self.execute(balancer, targets, current, rates)
+        res = self.execute(balancer, targets, current, moved)
+        self.assertFalse(res['cached'])
+        expected = self.execute(SimpleBalancer(), targets, current, moved)
+        self.assertEqual(res['orders'], expected['orders'])
+
+    def test_hit(self):
+        balancer = CachingBalancer(SimpleBalancer())
+        res = self.execute(balancer)
+        self.assertFalse(res['cached'])
+        self.assertTrue(res['orders'])
+
+        again = self.execute(balancer)
+        self.assertTrue(again['cached'])
+        self.assertEqual(again['nodes_expanded'], 0)
+        self.assertFalse(again['partial'])
+        self.assertEqual(again['orders'], res['orders'])
+        self.assertEqual([x.type_ for x in again['orders']],
+                         [x.type_ for x in res['orders']])
+        self.assertEqual(again['total_fee'], res['total_fee'])
+        self.assertEqual(again['proposed_portfolio'].balances,
+                         res['proposed_portfolio'].balances)
+        self.assertIsNot(again['orders'][0], res['orders'][0])
+
+    def test_lru(self):
+        cache = PlanCache(maxsize=2)
+        for key in ['a', 'b', 'c']:
+            cache.put(key, {key: 1})
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), {'b': 1})
+        cache.put('d', {'d': 1})
+        # b was used more recently than c, so c went
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual(cache.get('b'), {'b': 1})
+        self.assertEqual(cache.get('d'), {'d': 1})
+
+    def test_directory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            res = self.execute(CachingBalancer(SimpleBalancer(),
+                                               PlanCache(directory=directory)))
+            self.assertFalse(res['cached'])
+            self.assertEqual(len(os.listdir(directory)), 1)
+
+            # A fresh cache, as on the next run, reads it back
+            again = self.execute(CachingBalancer(
+                SimpleBalancer(), PlanCache(directory=directory)))
+            self.assertTrue(again['cached'])
+            self.assertEqual(again['orders'], res['orders'])
+            self.assertEqual(again['proposed_portfolio'].balances,
+                             res['proposed_portfolio'].balances)
+
+    def test_partial(self):
+        balancer = CachingBalancer(SimpleBalancer())
+        res = self.execute(balancer, max_nodes=1)
+        self.assertTrue(res['partial'])
+        self.assertFalse(balancer.cache.plans)
+
+        res = self.execute(balancer)
+        self.assertFalse(res['partial'])
+        self.assertFalse(res['cached'])
+
+
+class test_LinearBalancer(unittest.TestCase):
+
+    def execute(self, targets, current, rates, fee=0.001, max_orders=5,
+                mode='mid', exchange_class=DummyExchange):
+        exchange = exchange_class(targets.keys(), current, rates, fee)
+        portfolio = Portfolio.make_portfolio(targets, exchange)
+
+        balancer = LinearBalancer()
+        return balancer.balance(portfolio, exchange,
+                                max_orders=max_orders, mode=mode)
+
+    def test_noop(self):
+        targets = {'XRP': 45,
+                   'XLM': 45,
+                   'USDT': 10, }
+        current = {'XRP': 450,
+                   'XLM': 450,
+                   'USDT': 100, }
+        rates = {'XRP/USDT': 1.0,
+                 'XLM/USDT': 1.0, }
+
+        res = self.execute(targets, current, rates)
+        self.assertEqual(res['orders'], [])
+        self.assertIsNone(res['proposed_portfolio'])
+
+    def test_canonical_order(self):
+        targets = {'XRP': 40,
+                   'XLM': 20,
+                   'BTC': 20,
+                   'USDT': 20, }
+        current = {'XRP': 3352,
+                   'XLM': 0,
+                   'BTC': 0.01,
+                   'USDT': 243, }
+        rates = {'XRP/USDT': 0.32076,
+                 'XLM/USDT': 0.09084,
+                 'XLM/XRP': 0.283366,
+                 'XRP/BTC': 0.00008102,
+                 'BTC/USDT': 3968.13, }
+        res = self.execute(targets, current, rates)
+
+        def reverse(x):
+            return dict(reversed(list(x.items())))
+        other = self.execute(reverse(targets), reverse(current),
+                             reverse(rates))
+        self.assertTrue(res['orders'])
+        self.assertEqual(res['orders'], other['orders'])
+        self.assertEqual(res['total_fee'], other['total_fee'])
+        self.assertEqual(res['proposed_portfolio'].balances,
+                         other['proposed_portfolio'].balances)
+
+    def test_shuffled_order(self):
+        # Exactly the same plan, down to the last bit, however the inputs
+        # are ordered
+        rng = random.Random(3)
+        currencies = ['XRP', 'XLM', 'BTC', 'ETH', 'BNB', 'USDT']
+
+        def shuffled(x):
+            items = list(x.items())
+            rng.shuffle(items)
+            return dict(items)
+
+        for i in range(40):
+            targets, current, rates = random_case(rng, currencies)
+            res = self.execute(targets, current, rates, max_orders=4)
+            other = self.execute(shuffled(targets), shuffled(current),
+                                 shuffled(rates), max_orders=4)
+            self.assertEqual([order.key for order in res['orders']],
+                             [order.key for order in other['orders']])
+            self.assertEqual(res['total_fee'], other['total_fee'])
+
+    def test_sparse_universe(self):
+        targets = {'XRP': 45,
+                   'XLM': 45,
+                   'USDT': 10, }
+        current = {'XRP': 450,
+                   'XLM': 0,
+                   'USDT': 550, }
+        rates = {'XRP/USDT': 1.0,
+                 'XLM/USDT': 1.0, }
+        expected = self.execute(targets, current, rates)
+        self.assertTrue(expected['orders'])
+
+        others = ['C{}'.format(i) for i in range(200)]
+        targets = dict(targets, **{cur: 0 for cur in others})
+        current = dict(current, **{cur: 0 for cur in others})
+        res = self.execute(targets, current, rates)
+        self.assertEqual(res['orders'], expected['orders'])
+        self.assertAlmostEqual(res['total_fee'], expected['total_fee'])
+
+    def test_start_all_usdt(self):
+        targets = {'XRP': 50,
+                   'XLM': 40,
+                   'USDT': 10, }
+        current = {'XRP': 0,
+                   'XLM': 0,
+                   'USDT': 1000, }
+        rates = {'XRP/USDT': 0.5,
+                 'XLM/USDT': 0.5, }
+
+        res = self.execute(targets, current, rates)
+
+        expected = [Order('XLM/USDT', 'BUY', 800, 0.5),
+                    Order('XRP/USDT', 'BUY', 1000, 0.5), ]
+        self.assertEqual(res['orders'], expected)
+        self.assertAlmostEqual(res['total_fee'], 0.9)
+        self.assertAlmostEqual(res['proposed_portfolio'].balance_rms_error, 0)
+
+    def test_start_all_xrp(self):
+        targets = {'XRP': 50,
+                   'XLM': 40,
+                   'USDT': 10, }
+        current = {'XRP': 1000,
+                   'XLM': 0,
+                   'USDT': 0, }
+        rates = {'XRP/USDT': 1.0,
+                 'XLM/USDT': 1.0,
+                 'XLM/XRP': 1.0, }
+
+        res = self.execute(targets, current, rates)
+
+        expected = [Order('XLM/XRP', 'BUY', 400, 1.0),
+                    Order('XRP/USDT', 'SELL', 100, 1.0), ]
+        self.assertEqual(res['orders'], expected)
+
+    def test_max_orders(self):
+        targets = {'XRP': 50,
+                   'XLM': 40,
+                   'USDT': 10, }
+        current = {'XRP': 1000,
+                   'XLM': 0,
+                   'USDT': 0, }
+        rates = {'XRP/USDT': 1.0,
+                 'XLM/USDT': 1.0,
+                 'XLM/XRP': 1.0, }
+
+        res = self.execute(targets, current, rates, max_orders=1)
+
+        expected = [Order('XLM/XRP', 'BUY', 400, 1.0), ]
+        self.assertEqual(res['orders'], expected)
+
+    def test_passive(self):
+        targets = {'XRP': 50,
+                   'XLM': 40,
+                   'USDT': 10, }
+        current = {'XRP': 1000,
+                   'XLM': 0,
+                   'USDT': 0, }
+        rates = {'XRP/USDT': 1.0,
+                 'XLM/USDT': 1.0,
+                 'XLM/XRP': 1.0, }
+
+        res = self.execute(targets, current, rates, mode='passive')
+
+        self.assertEqual([(x.pair, x.price) for x in res['orders']],
+                         [('XLM/XRP', 0.999), ('XRP/USDT', 1.001)])
+
+    def test_indirect(self):
+        # Nothing trades XLM against XRP, so it has to go via USDT
+        targets = {'XRP': 50,
+                   'XLM': 40,
+                   'USDT': 10, }
+        current = {'XRP': 500,
+                   'XLM': 0,
+                   'USDT': 500, }
+        rates = {'XRP/USDT': 1.0,
+                 'XLM/USDT': 1.0, }
+
+        res = self.execute(targets, current, rates)
+
+        expected = [Order('XLM/USDT', 'BUY', 400, 1.0), ]
+        self.assertEqual(res['orders'], expected)
+
+    def test_untradable_direction(self):
+        # Quoted both ways, but only ETH/BTC has limits, so sell on that as
+        # the search balancer does
+        targets = {'ETH': 50,
+                   'BTC': 50, }
+        current = {'ETH': 10,
+                   'BTC': 0, }
+        rates = {'ETH/BTC': 0.05,
+                 'BTC/ETH': 20.0, }
+        exchange = DummyExchange(targets.keys(), current, rates, 0.001)
+        portfolio = Portfolio.make_portfolio(targets, exchange,
+                                             quote_currency='BTC')
+
+        res = LinearBalancer().balance(portfolio, exchange)
+        expected = SimpleBalancer().balance(portfolio, exchange)
+
+        self.assertEqual(res['orders'], [Order('ETH/BTC', 'SELL', 5, 0.05)])
+        self.assertEqual(res['orders'], expected['orders'])
+
+    def test_untradable_pair(self):
+        # XRP/XLM has a rate but no limits, so value has to go through
+        # USDT rather than straight across
+        targets = {'XRP': 50,
+                   'XLM': 20,
+                   'USDT': 30, }
+        current = {'XRP': 1000,
+                   'XLM': 0,
+                   'USDT': 400, }
+        rates = {'XRP/USDT': 1.0,
+                 'XLM/USDT': 1.0,
+                 'XRP/XLM': 1.0, }
+
+        res = self.execute(targets, current, rates)
+
+        expected = [Order('XLM/USDT', 'BUY', 280, 1.0),
+                    Order('XRP/USDT', 'SELL', 300, 1.0), ]
+        self.assertEqual(res['orders'], expected)
+        self.assertAlmostEqual(res['proposed_portfolio'].balance_rms_error,
+                               0)
+
+    def test_large_universe(self):
+
+        class Exchange(DummyExchange):
+            @property
+            def limits(self):
+                return {pair: {'amount': {'min': 0.0},
+                               'cost': {'min': 0.0}}
+                        for pair in self._rates}
+
+        currencies = ['C{}'.format(i) for i in range(49)]
+        targets = {cur: 2.0 for cur in currencies + ['USDT']}
+        current = {cur: float(i % 7) * 10 for i, cur in
+                   enumerate(currencies)}
+        current['USDT'] = 1000.0
+        rates = {'{}/USDT'.format(cur): 1.0 + i / 10.0
+                 for i, cur in enumerate(currencies)}
+
+        res = self.execute(targets, current, rates, max_orders=50,
+                           exchange_class=Exchange)
+
+        self.assertEqual(len(res['orders']), 49)
+        self.assertAlmostEqual(res['proposed_portfolio'].balance_rms_error,
+                               0)
+
+
 class test_Executor(unittest.TestCase):
 
     def create_executor(self, targets, current, rates, fee=0.001):
@@ -897,6 +2371,378 @@ class test_Executor(unittest.TestCase):
         self.assertEqual(exchange.balances['USDT'], 100)
 
 
+    def test_run_budget(self):
+        targets = {'XRP': 45,
+                   'XLM': 45,
+                   'USDT': 10, }
+        current = {'XRP': 400,
+                   'XLM': 400,
+                   'USDT': 200}
+        rates = {'XRP/USDT': 1.0,
+                 'XLM/USDT': 1.0,
+                 'XLM/XRP': 1.0,
+                 }
+
+        executor = self.create_executor(targets, current, rates)
+        res = executor.run(force=True)
+        self.assertFalse(res['partial'])
+
+        res = executor.run(force=True, max_nodes=1)
+        self.assertTrue(res['partial'])
+        expected = [Order('XLM/USDT', 'BUY', 50.0, 1.0)]
+        self.assertEqual(res['orders'], expected)
+
+
+    def test_run_prior_orders(self):
+        targets = {'XRP': 45,
+                   'XLM': 45,
+                   'USDT': 10, }
+        current = {'XRP': 400,
+                   'XLM': 400,
+                   'USDT': 200}
+        rates = {'XRP/USDT': 1.0,
+                 'XLM/USDT': 1.0,
+                 'XLM/XRP': 1.0,
+                 }
+
+        executor = self.create_executor(targets, current, rates)
+        res = executor.run(force=True)
+        warm = executor.run(force=True, prior_orders=res['orders'])
+        self.assertEqual(warm['orders'], res['orders'])
+
+
+def random_candles(ticks, seed=1):
+    # Hourly candles on a random walk, with the odd candle missing and
+    # ETH/BTC and XRP/BTC only starting part way through
+    rng = random.Random(seed)
+    starts = {'XRP/USD': (0, 0.5),
+              'BTC/USD': (0, 5000.0),
+              'ETH/BTC': (ticks // 8, 0.05),
+              'XRP/BTC': (ticks // 4, 0.0001), }
+    candles = {}
+    for pair, (start, price) in starts.items():
+        candles[pair] = []
+        for i in range(start, ticks):
+            price *= math.exp(rng.gauss(0, 0.02))
+            if rng.random() > 0.1 or i == 0:
+                candles[pair].append({'time': 1500000000 + i * 3600,
+                                      'close': price})
+    return candles
+
+
+def random_history(ticks, seed=1):
+    return PriceHistory.from_candles(random_candles(ticks, seed))
+
+
+class test_PriceHistory(unittest.TestCase):
+
+    def test_from_candles(self):
+        candles = {'XRP/USD': [{'time': 10, 'close': 1.0},
+                               {'time': 30, 'close': 3.0},
+                               {'time': 30, 'close': 4.0}, ],
+                   'BTC/USD': [{'time': 20, 'close': 200.0},
+                               {'time': 40, 'close': 400.0}, ], }
+        history = PriceHistory.from_candles(candles)
+        self.assertEqual(history.pairs, ['BTC/USD', 'XRP/USD'])
+        self.assertEqual(history.times.tolist(), [10, 20, 30, 40])
+        self.assertTrue(math.isnan(history.prices[0, 0]))
+        self.assertEqual(history.prices[1:, 0].tolist(),
+                         [200.0, 200.0, 400.0])
+        self.assertEqual(history.prices[:, 1].tolist(),
+                         [1.0, 1.0, 3.0, 3.0])
+        self.assertEqual(len(history), 4)
+
+        self.assertEqual(history.rates(0),
+                         {'XRP/USD': {'mid': 1.0,
+                                      'high': 1.001,
+                                      'low': 0.999, }, })
+        self.assertEqual(set(history.rates(1)), {'BTC/USD', 'XRP/USD'})
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            def write(pair, candles):
+                path = os.path.join(directory, pair + '.json')
+                with open(path, 'w') as f:
+                    json.dump(candles, f)
+                return path
+
+            write('XRP-USD', [{'time': 10, 'close': 1.0},
+                              {'time': 20, 'close': 2.0}, ])
+            path = write('BTC-USD', [{'time': 20, 'close': 200.0}, ])
+            filenames = os.path.join(directory, '*.json')
+            cache_dir = os.path.join(directory, 'cache')
+
+            history = PriceHistory.from_files(filenames)
+            self.assertIsNone(history.prices_file)
+            cached = PriceHistory.from_files(filenames, cache_dir)
+            self.assertEqual(cached.prices_file,
+                             os.path.join(cache_dir, 'prices.npy'))
+            self.assertIsInstance(cached.prices.base, np.memmap)
+            self.assertEqual(cached.pairs, history.pairs)
+            self.assertEqual(cached.times.tolist(), history.times.tolist())
+            np.testing.assert_array_equal(cached.prices, history.prices)
+
+            # Comes from the cache the next time
+            self.assertIsNotNone(PriceHistory.load(cache_dir))
+            again = PriceHistory.from_files(filenames, cache_dir)
+            np.testing.assert_array_equal(again.prices, history.prices)
+
+            # Until one of the files changes
+            write('BTC-USD', [{'time': 20, 'close': 300.0}, ])
+            stat = os.stat(path)
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            changed = PriceHistory.from_files(filenames, cache_dir)
+            self.assertEqual(changed.prices[1, 0], 300.0)
+            # Leaving the histories already mapped from the cache as they
+            # were
+            self.assertEqual(cached.prices[1, 0], 200.0)
+            self.assertEqual(again.prices[1, 0], 200.0)
+
+            exchange = BacktestExchange(filenames, {'XRP': 1.0, 'USD': 0.0},
+                                        cache_dir=cache_dir)
+            self.assertEqual(exchange.rates['XRP/USD']['mid'], 1.0)
+            exchange.tick()
+            self.assertEqual(exchange.rates['BTC/USD']['mid'], 300.0)
+
+    def test_quote_prices(self):
+        history = random_history(200)
+        currencies = ['XRP', 'BTC', 'ETH', 'USD', 'BNB']
+        quote_prices = history.quote_prices(currencies, 'USD')
+        self.assertEqual(quote_prices.shape, (200, 5))
+
+        # The same as a portfolio works out from the rates at each tick,
+        # before and after the pairs that start later
+        exchange = HistoryExchange(history, {})
+        for tick in [0, 24, 25, 49, 50, 199]:
+            exchange.seek(tick)
+            quote_rates = quote_conversions(exchange.rates, 'USD')
+            for i, cur in enumerate(currencies):
+                if cur in quote_rates:
+                    self.assertEqual(quote_prices[tick, i],
+                                     quote_rates[cur])
+                else:
+                    self.assertTrue(math.isnan(quote_prices[tick, i]))
+        self.assertTrue(math.isnan(quote_prices[0, 2]))
+        self.assertFalse(math.isnan(quote_prices[199, 2]))
+
+        # Worked out once for each set of currencies
+        self.assertIs(history.quote_prices(currencies, 'USD'), quote_prices)
+        self.assertFalse(quote_prices.flags.writeable)
+
+    def test_tick(self):
+        history = random_history(3)
+        exchange = HistoryExchange(history, {})
+        self.assertEqual(exchange.tick_index, 0)
+        exchange.tick()
+        exchange.tick()
+        self.assertEqual(exchange.rates['XRP/USD']['mid'],
+                         history.prices[2, history.index['XRP/USD']])
+        with self.assertRaises(StopIteration):
+            exchange.tick()
+
+
+class test_StreamingBacktestExchange(unittest.TestCase):
+
+    def write_candles(self, directory, candles):
+        for pair, pair_candles in candles.items():
+            path = os.path.join(directory,
+                                pair.replace('/', '-') + '.json')
+            with open(path, 'w') as f:
+                json.dump(pair_candles, f, indent=1)
+
+    def test_read_candles(self):
+        candles = random_candles(50)['XRP/USD']
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'XRP-USD.json')
+            with open(path, 'w') as f:
+                json.dump(candles, f, indent=2)
+            # Small chunks split candles between them
+            for chunk_size in [1, 7, 64, 1 << 16]:
+                self.assertEqual(list(read_candles(path, chunk_size)),
+                                 candles)
+
+            with open(path, 'a') as f:
+                f.write('{"time": ')
+            with self.assertRaises(ValueError):
+                list(read_candles(path))
+
+    def test_same_as_history(self):
+        candles = random_candles(200)
+        # A repeated time, where the first candle is the one used
+        candles['XRP/USD'].insert(5, dict(candles['XRP/USD'][4],
+                                          close=1000.0))
+        with tempfile.TemporaryDirectory() as directory:
+            self.write_candles(directory, candles)
+            filenames = os.path.join(directory, '*.json')
+            expected = BacktestExchange(filenames, {})
+            exchange = StreamingBacktestExchange(filenames, {},
+                                                 chunk_size=50)
+            self.assertEqual(exchange.pairs, expected.pairs)
+
+            num_ticks = 1
+            while True:
+                self.assertEqual(exchange.time,
+                                 expected.history.times[num_ticks - 1])
+                self.assertEqual(exchange.rates, expected.rates)
+                try:
+                    exchange.tick()
+                except StopIteration:
+                    break
+                expected.tick()
+                num_ticks += 1
+            self.assertEqual(num_ticks, len(expected.history))
+
+    def test_balance(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.write_candles(directory, random_candles(100))
+            exchange = StreamingBacktestExchange(
+                os.path.join(directory, '*.json'),
+                {'XRP': 0.0, 'USD': 1000.0})
+            portfolio = ArrayPortfolio.make_portfolio(
+                {'XRP': 50, 'USD': 50}, exchange, quote_currency='USD')
+            res = SimpleBalancer().balance(portfolio, exchange)
+            self.assertEqual([x.pair for x in res['orders']], ['XRP/USD'])
+
+
+class test_Backtest(unittest.TestCase):
+
+    targets = {'XRP': 40,
+               'BTC': 20,
+               'ETH': 20,
+               'USD': 20, }
+    balances = {'XRP': 0.0,
+                'BTC': 0.0,
+                'ETH': 0.0,
+                'USD': 10000.0, }
+
+    def reference(self, history, threshold, start):
+        # The backtest done the slow way, valuing a portfolio at every tick
+        exchange = HistoryExchange(history, dict(self.balances), tick=start)
+        portfolio = ArrayPortfolio.make_portfolio(self.targets, exchange,
+                                                  threshold, 'USD')
+        balancer = SimpleBalancer()
+        res = {'num_trades': 0, 'num_rebalances': 0}
+
+        def rebalance(max_orders):
+            portfolio.sync_balances()
+            portfolio.sync_rates()
+            orders = balancer.balance(portfolio, exchange,
+                                      max_orders=max_orders)
+            num_trades = 0
+            for order in orders['orders']:
+                try:
+                    exchange.execute_order(order)
+                    num_trades += 1
+                except ValueError:
+                    pass
+            res['num_trades'] += num_trades
+            res['num_rebalances'] += 1
+            return num_trades
+
+        while portfolio.needs_balancing:
+            if not rebalance(4):
+                break
+            portfolio.sync_balances()
+        while True:
+            portfolio.sync_balances()
+            portfolio.sync_rates()
+            if portfolio.needs_balancing:
+                rebalance(2)
+            try:
+                exchange.tick()
+            except StopIteration:
+                break
+        res['final_balances'] = exchange.balances
+        return res
+
+    def test_same_as_portfolio(self):
+        history = random_history(300)
+        backtest = Backtest(history, self.targets, self.balances, 2.0,
+                            quote_currency='USD')
+        res = backtest.run()
+        # ETH only has a price once ETH/BTC starts
+        self.assertEqual(res['start'], 37)
+        self.assertEqual(res['stop'], 300)
+        self.assertGreater(res['num_rebalances'], 5)
+
+        expected = self.reference(history, 2.0, res['start'])
+        self.assertEqual(res['num_trades'], expected['num_trades'])
+        self.assertEqual(res['num_rebalances'], expected['num_rebalances'])
+        self.assertEqual(res['final_balances'], expected['final_balances'])
+        self.assertEqual(self.balances['USD'], 10000.0)
+
+    def test_fast_forward(self):
+        # Jumping to each crossing rebalances on the same ticks as checking
+        # every one, including crossings well past the first look ahead
+        history = random_history(2000)
+        for threshold in [5.0, 20.0, 1000.0]:
+            res = Backtest(history, self.targets, self.balances, threshold,
+                           quote_currency='USD').run()
+            expected = Backtest(history, self.targets, self.balances,
+                                threshold, quote_currency='USD',
+                                fast_forward=False).run()
+            self.assertEqual(res, expected)
+
+    def test_valuations(self):
+        history = random_history(100)
+        backtest = Backtest(history, {'XRP': 50, 'USD': 50},
+                            {'XRP': 0.0, 'USD': 1000.0}, 1000.0,
+                            quote_currency='USD')
+        res = backtest.run()
+        # Never drifts that far, so never trades
+        self.assertEqual(res['num_trades'], 0)
+        self.assertEqual(res['initial_valuation'], 1000.0)
+        self.assertEqual(res['final_valuation'], 1000.0)
+        self.assertEqual(res['hold_valuation'], 1000.0)
+
+    def test_no_prices(self):
+        history = random_history(10)
+        backtest = Backtest(history, {'XLM': 50, 'USD': 50},
+                            {'XLM': 0.0, 'USD': 1000.0}, 1.0,
+                            quote_currency='USD')
+        with self.assertRaises(ValueError):
+            backtest.run()
+
+
+class test_Sweep(unittest.TestCase):
+
+    def test_grid(self):
+        configs = grid(threshold=[1.0, 2.0], max_orders=[2, 4, 6])
+        self.assertEqual(len(configs), 6)
+        self.assertEqual(configs[0], {'threshold': 1.0, 'max_orders': 2})
+        self.assertEqual(configs[-1], {'threshold': 2.0, 'max_orders': 6})
+
+    def test_sweep(self):
+        history = random_history(500)
+        configs = grid(targets=[test_Backtest.targets,
+                                {'XRP': 50, 'USD': 50}],
+                       balances=[test_Backtest.balances],
+                       threshold=[2.0, 5.0],
+                       max_orders=[2, 4],
+                       quote_currency=['USD'])
+        rows = sweep(history, configs, workers=2)
+        self.assertEqual(len(rows), 8)
+        for config, row in zip(configs, rows):
+            expected = Backtest(history, **config).run()
+            self.assertEqual(row, dict(config, **expected))
+        self.assertEqual(sweep(history, configs, workers=1), rows)
+
+    def test_sweep_balances(self):
+        # Rows keep the balances they started from as well as the ones
+        # they ended up with
+        history = random_history(200)
+        starts = [{'XRP': 0.0, 'USD': 1000.0},
+                  {'XRP': 2000.0, 'USD': 0.0}]
+        configs = grid(targets=[{'XRP': 50, 'USD': 50}],
+                       balances=starts,
+                       threshold=[1.0],
+                       quote_currency=['USD'])
+        rows = sweep(history, configs, workers=1)
+        self.assertEqual([row['balances'] for row in rows], starts)
+        for row in rows:
+            self.assertNotEqual(row['final_balances'], row['balances'])
+
+
 class test_DummyExchange(unittest.TestCase):
     def setUp(self):
         balances = {'XRP': 100.0,
@@ -953,6 +2799,131 @@ class test_DummyExchange(unittest.TestCase):
         order = Order('ZEC/USDT', 'BUY', 10, 0.32)
         self.assertIsNone(self.exchange.preprocess_order(order))
 
+    def test_preprocess_orders(self):
+        orders = [Order('XRP/USDT', 'BUY', 50, 0.32),
+                  Order('XRP/USDT', 'BUY', 0.1, 0.32),
+                  Order('ZEC/USDT', 'BUY', 10, 0.32),
+                  Order('XRP/USDT', 'SELL', 100, 0.32),
+                  Order('XRP/USDT', 'SELL', 101, 0.32),
+                  Order('BTC/USDT', 'BUY', 0.1, 3500.0),
+                  Order('BTC/USDT', 'sell', 0.01, 3500.0), ]
+        expected = [orders[0], None, None, orders[3], None, None, orders[6]]
+        self.assertEqual(self.exchange.preprocess_orders(orders), expected)
+        self.assertEqual(orders[0].type_, 'LIMIT')
+        self.assertIsNone(orders[1].type_)
+        self.assertEqual(self.exchange.preprocess_orders([]), [])
+
+    def test_preprocess_orders_batch(self):
+        # Big batches go through numpy, and should agree with the orders
+        # checked one at a time
+        orders = [Order(pair, direction, amount, price)
+                  for pair, price in [('XRP/USDT', 0.32),
+                                      ('BTC/USDT', 3500.0),
+                                      ('ZEC/USDT', 1.0)]
+                  for direction in ['BUY', 'SELL']
+                  for amount in [0.000001, 0.01, 0.1, 1, 31.25, 100, 1000]]
+        self.assertGreaterEqual(len(orders), BATCH_MIN_ORDERS)
+        expected = [self.exchange.preprocess_order(order) for order in orders]
+        self.assertTrue(any(expected))
+        self.assertFalse(all(expected))
+        self.assertEqual(self.exchange.preprocess_orders(orders), expected)
+
+
+
+class StubExch():
+    # Just the markets of a ccxt exchange, without talking to it
+
+    def __init__(self, markets, precision_mode):
+        self.markets = markets
+        self.precisionMode = precision_mode
+
+
+@unittest.skipIf(ccxt is None, "ccxt isn't installed")
+class test_CCXTExchange(unittest.TestCase):
+
+    def precise(self, value, precision, mode, truncate):
+        if mode != ccxt.TICK_SIZE:
+            precision = int(precision)
+        return float(ccxt.decimal_to_precision(
+            value, ccxt.TRUNCATE if truncate else ccxt.ROUND, precision,
+            mode, ccxt.NO_PADDING))
+
+    def test_to_precision(self):
+        rng = random.Random(1)
+        for mode, precisions in [(ccxt.DECIMAL_PLACES, [0, 2, 5, 8]),
+                                 (ccxt.SIGNIFICANT_DIGITS, [1, 3, 8]),
+                                 (ccxt.TICK_SIZE, [1e-8, 0.01, 0.05, 5.0])]:
+            values = []
+            for i in range(2000):
+                value = 10 ** rng.uniform(-6, 6)
+                if i % 2:
+                    # Values already on or near a step
+                    value = round(value, rng.randint(0, 12))
+                values.append(value or 1.0)
+            values.append(12345.678912345)
+            precision = np.array([rng.choice(precisions) for x in values],
+                                 dtype=float)
+
+            for truncate in [True, False]:
+                res = to_precision(np.array(values), precision, mode,
+                                   truncate).tolist()
+                expected = [self.precise(x, p, mode, truncate)
+                            for x, p in zip(values, precision.tolist())]
+                self.assertEqual(res, expected)
+                if truncate:
+                    self.assertTrue(all(x <= y for x, y in zip(res, values)))
+
+        # No precision leaves it as it is
+        self.assertEqual(to_precision(np.array([1.23456]), np.array([np.nan]),
+                                      ccxt.DECIMAL_PLACES, True).tolist(),
+                         [1.23456])
+
+    def test_preprocess_orders(self):
+        def market(amount, price, min_amount, min_cost):
+            return {'precision': {'amount': amount, 'price': price},
+                    'limits': {'amount': {'min': min_amount},
+                               'cost': {'min': min_cost}},
+                    'active': True}
+        markets = {'XRP/USDT': market(1, 5, 0.1, 10.0),
+                   'BTC/USDT': market(6, 2, 1e-06, 10.0),
+                   'XRP/BTC': market(0, 8, 1.0, 0.001), }
+        exchange = CCXTExchange.__new__(CCXTExchange)
+        exchange.name = 'stub'
+        exchange.currencies = ['XRP', 'BTC', 'USDT']
+        exchange.exch = StubExch(markets, ccxt.DECIMAL_PLACES)
+
+        orders = [Order('XRP/USDT', 'BUY', 12345.678912345, 0.3207649),
+                  Order('XRP/USDT', 'SELL', 31.29, 0.32076),
+                  Order('XRP/USDT', 'SELL', 0.05, 0.32),
+                  Order('BTC/USDT', 'BUY', 0.0123456789, 3968.135),
+                  Order('BTC/USDT', 'BUY', 0.0000019, 3968.13),
+                  Order('XRP/BTC', 'SELL', 100.9, 0.000081029),
+                  Order('ZEC/USDT', 'BUY', 10, 0.32), ]
+        expected = []
+        for order in orders:
+            if order.pair not in markets:
+                expected.append(None)
+                continue
+            precision = markets[order.pair]['precision']
+            limits = markets[order.pair]['limits']
+            amount = self.precise(order.amount, precision['amount'],
+                                  ccxt.DECIMAL_PLACES, True)
+            price = self.precise(order.price, precision['price'],
+                                 ccxt.DECIMAL_PLACES, False)
+            if amount >= limits['amount']['min'] and \
+               amount * price >= limits['cost']['min']:
+                expected.append((order.pair, order.direction, amount, price))
+            else:
+                expected.append(None)
+
+        res = exchange.preprocess_orders(orders)
+        self.assertEqual([x and x.key for x in res], expected)
+        self.assertEqual(res[0].amount, 12345.6)
+        self.assertEqual([x.type_ for x in res if x], ['LIMIT'] * 4)
+        self.assertIsNone(res[2])
+        self.assertIsNone(res[4])
+        self.assertEqual(exchange.preprocess_order(
+            Order('XRP/BTC', 'SELL', 100.9, 0.000081029)).amount, 100.0)
 
 if __name__ == '__main__':  # pragma: no cover
     unittest.main()
@@ -24,6 +24,7 @@ setup(name='crypto_balancer',
       keywords = ['cryptocurrency', 'portfolio', 'xrp', 'ethereum', 'bitcoin', 'btc', 'eth'],
       install_requires=[
           'ccxt',
+          'numpy',
       ],
       classifiers=[
           'Development Status :: 5 - Production/Stable',